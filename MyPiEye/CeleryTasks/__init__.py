@@ -1,10 +1,6 @@
 from functools import partial
 from datetime import datetime
 
-import pickle
-import json
-import pytz
-
 from celery import Celery
 from celery.utils.log import get_task_logger
 
@@ -12,67 +8,249 @@ import redis
 
 from MyPiEye.Storage.minio_storage import MinioStorage
 from MyPiEye.CLI import get_config_value
+from MyPiEye.CeleryTasks.payload import unpack_capture, KIND_JPEG, KIND_REF
+from MyPiEye.CeleryTasks.blob_stage import blob_stage
+from MyPiEye.CeleryTasks.capture_index import CaptureIndex
 
+# msgpack is compact, handles the JPEG bytes without escaping, and can't run code like pickle.
+# Task arguments are limited to bytes, strings, and numbers. Times are sent as ISO strings.
 celery_app = Celery('imghandler')
 celery_app.config_from_object({
-    'task_serializer': 'pickle',
-    'accept_content': ['json', 'pickle']
+    'task_serializer': 'msgpack',
+    'result_serializer': 'msgpack',
+    'accept_content': ['msgpack', 'json'],
+
+    # nothing waits on the storage tasks, so don't write their results to redis
+    'task_ignore_result': True
 })
 log = get_task_logger(__name__)
 
 # this has to be set to the global config on initialization of celery_app
 app_config = {}
 
+# kept for the life of the worker, see ``get_minio``, ``get_redis``, ``get_blob_stage``, and ``get_capture_index``
+_minio = None
+_redis_pool = None
+_blob_stage = None
+_capture_index = None
+
+
+def get_minio():
+    """
+    The worker's minio client, created on first use.
+
+    :return: ``MinioStorage``
+    """
+
+    global _minio
+
+    if _minio is None:
+        log.info('Connecting to minio')
+        _minio = MinioStorage(app_config)
+
+    return _minio
+
+
+def get_redis():
+    """
+    A redis client for the capture db. Connections come from a pool shared by the worker.
+
+    :return: ``redis.Redis``
+    """
+
+    global _redis_pool
+
+    if _redis_pool is None:
+        rcfg = partial(get_config_value, app_config, 'db_redis')
+
+        _redis_pool = redis.ConnectionPool(
+            host=rcfg('host', 'DB_REDIS_HOST'),
+            port=int(rcfg('port', 'DB_REDIS_PORT', 6379)),
+            db=int(rcfg('db', 'DB_REDIS_DB', 0)),
+            password=rcfg('password', 'DB_REDIS_PASSWORD'))
+
+    return redis.Redis(connection_pool=_redis_pool)
+
+
+def parse_time(dt_stamp):
+    """
+    Capture times are sent as ``isoformat(timespec='microseconds')``.
+
+    :param dt_stamp: ISO string, or a datetime
+    :return: datetime
+    """
+
+    if isinstance(dt_stamp, datetime):
+        return dt_stamp
+
+    return datetime.strptime(dt_stamp, '%Y-%m-%dT%H:%M:%S.%f')
+
+
+def get_blob_stage():
+    """
+    Where claim-checked captures are fetched from, see ``blob_stage``.
+
+    :return: the blob stage, or None if claim checks are off
+    """
+
+    global _blob_stage
+
+    if _blob_stage is None:
+        _blob_stage = blob_stage(app_config)
+
+    return _blob_stage
+
+
+def store(payload):
+    """
+    Uploads a capture to minio. Claim-checked blobs are removed once they're stored.
+
+    :param payload: from ``pack_capture``, with the JPEG, or the key of the JPEG in the blob stage
+    :return: tuple of (capture datetime, camera id), or None if there was nothing to store
+    """
 
-@celery_app.task()
-def store_capture(img_bytes, dt_stamp: datetime, cam_id: str):
     # bout-time/cam0/20190907/23/15/2019.09.07.23.15.49.220779.jpg
 
+    kind, dt_stamp, cam_id, body = unpack_capture(payload)
+
+    key = None
+    if kind == KIND_JPEG:
+        jpg = body
+    elif kind == KIND_REF:
+        key = body.tobytes().decode('utf-8')
+
+        stage = get_blob_stage()
+        if stage is None:
+            log.error('Got a claim check for {}, but claim_check is off'.format(key))
+            return None
+
+        jpg = stage.get(key)
+        if jpg is None:
+            log.error('Blob {} is gone, it may have expired'.format(key))
+            return None
+    else:
+        log.error('Unexpected capture payload kind {}'.format(kind))
+        return None
+
     log.info('Storing capture to minio')
 
-    cv2img = pickle.loads(img_bytes)
+    mio = get_minio()
+    mio.upload_jpeg(jpg, dt_stamp, cam_id)
 
-    mio = MinioStorage(app_config)
-    mio.upload(cv2img, dt_stamp, cam_id)
+    # only once it's safely stored
+    if key is not None:
+        get_blob_stage().delete(key)
 
     log.info('Stored {} capture to minio'.format(dt_stamp.isoformat()))
 
+    return dt_stamp, cam_id
+
+
+def get_capture_index():
+    """
+    The worker's capture index writer, on the pooled redis connections.
+
+    :return: ``CaptureIndex``
+    """
+
+    global _capture_index
+
+    if _capture_index is None:
+        rcfg = partial(get_config_value, app_config, 'db_redis')
+
+        _capture_index = CaptureIndex(
+            get_redis(),
+            rcfg('db_prefix', 'DB_REDIS_PREFIX'),
+            get_config_value(app_config, 'global', 'timezone', 'TIMEZONE', 'US/Central'))
+
+    return _capture_index
+
+
+def register(captures):
+    """
+    Adds captures to the redis db, in one round trip.
+
+    :param captures: list of (capture datetime, camera id)
+    :return: None
+    """
+
+    if not captures:
+        return
+
+    index = get_capture_index()
+
+    for dt_stamp, cam_id in captures:
+        index.add(parse_time(dt_stamp), cam_id)
+
+    index.flush()
+
 
 @celery_app.task()
-def register_capture(dt_stamp: datetime, cam_id: str):
+def store_capture(payload):
+    """
+    Uploads a capture to minio, without registering it. See ``store_and_register``.
+
+    :param payload: from ``pack_capture``
+    """
 
-    log.warning('Adding capture to redis db')
-    rcfg = partial(get_config_value, app_config, 'db_redis')
+    store(payload)
 
-    redis_host = rcfg('host', 'DB_REDIS_HOST')
-    redis_port = rcfg('port', 'DB_REDIS_PORT')
-    redis_db = rcfg('db', 'DB_REDIS_DB')
 
-    redis_password = rcfg('password', 'DB_REDIS_PASSWORD')
-    timezone = get_config_value(app_config, 'global', 'timezone', 'TIMEZONE', 'US/Central')
+@celery_app.task()
+def register_capture(dt_stamp, cam_id: str):
+    """
+    Adds a capture to the redis db. See ``store_and_register``.
+
+    :param dt_stamp: ISO capture time
+    :param cam_id: camera id
+    """
 
-    redis_prefix = rcfg('db_prefix', 'DB_REDIS_PREFIX')
+    register([(dt_stamp, cam_id)])
 
-    rsrv = redis.Redis(redis_host, redis_port, redis_db, redis_password)
-    fmt = '%Y%m%d/%H/%M/%Y.%m.%d.%H.%M.%S.%f'
-    key = '{}/{}/{}'.format(redis_prefix, cam_id, dt_stamp.strftime(fmt))
 
-    tz = pytz.timezone(timezone)
-    local_time = tz.localize(dt_stamp)
+@celery_app.task()
+def store_and_register(payload):
+    """
+    Uploads a capture, then adds it to the redis db. If the upload fails, it isn't registered,
+    so the db only points at captures that exist.
 
-    val = {
-        'utc_time': dt_stamp.isoformat(timespec='microseconds'),
-        'local_time': local_time.isoformat(timespec='microseconds'),
-        'camera_id': cam_id
-    }
+    :param payload: from ``pack_capture``
+    """
 
-    val = json.dumps(val)
+    stored = store(payload)
 
-    ret = rsrv.set(key, val)
-    log.warn('Redis updated with {}'.format(dt_stamp.isoformat()))
+    if stored is not None:
+        register([stored])
 
 
 @celery_app.task()
+def store_and_register_batch(payloads):
+    """
+    ``store_and_register`` for several captures. The stored ones are registered together.
+
+    :param payloads: list of ``pack_capture`` payloads
+    """
+
+    stored = []
+
+    for payload in payloads:
+        try:
+            captured = store(payload)
+        except Exception as e:
+            # the rest can still go
+            log.error('Failed to store capture: {}'.format(e))
+            continue
+
+        if captured is not None:
+            stored.append(captured)
+
+    register(stored)
+
+    if len(stored) < len(payloads):
+        log.warning('Stored {} of {} captures'.format(len(stored), len(payloads)))
+
+
+@celery_app.task(ignore_result=False)
 def ping(txt):
     log.info('Received ping')
     return '{}: pong!'.format(txt)
@@ -0,0 +1,154 @@
+import logging
+from functools import partial
+from os import makedirs, remove, replace, scandir
+from os.path import join, abspath
+from time import time
+
+from MyPiEye.CLI import get_config_value
+
+log = logging.getLogger(__name__)
+
+# [celery] claim_check values
+CLAIM_CHECK_OFF = 'off'
+CLAIM_CHECK_FILE = 'file'
+CLAIM_CHECK_REDIS = 'redis'
+
+
+def blob_key(cam_id, dt_stamp):
+    """
+    The key a capture is staged under.
+
+    :param cam_id: camera id
+    :param dt_stamp: capture datetime
+    :return: str
+    """
+
+    return '{}/{}'.format(cam_id, dt_stamp.strftime('%Y%m%d.%H%M%S.%f'))
+
+
+class FileBlobStage(object):
+    """
+    Stages blobs as files. The producer and the workers have to share the folder.
+
+    Files older than ``ttl`` seconds are removed the next time something is staged, so blobs whose task never ran
+    don't pile up.
+    """
+
+    def __init__(self, folder, ttl=3600):
+        """
+        :param folder: where to put the files
+        :param ttl: seconds to keep a blob that was never fetched
+        """
+
+        self.folder = abspath(folder)
+        self.ttl = ttl
+
+        self._last_sweep = time()
+
+        makedirs(self.folder, exist_ok=True)
+
+    def path(self, key):
+        return join(self.folder, key.replace('/', '_'))
+
+    def put(self, key, data):
+        path = self.path(key)
+
+        # so a worker never sees half of it
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        replace(path + '.tmp', path)
+
+        if time() - self._last_sweep > self.ttl:
+            self.sweep()
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        try:
+            remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        """
+        Removes blobs older than ``ttl``.
+        """
+
+        self._last_sweep = time()
+        cutoff = self._last_sweep - self.ttl
+
+        for entry in scandir(self.folder):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                log.warning('Removing expired blob {}'.format(entry.name))
+                try:
+                    remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class RedisBlobStage(object):
+    """
+    Stages blobs in redis, with a TTL so blobs whose task never ran expire.
+    """
+
+    def __init__(self, rds, prefix='blob', ttl=3600):
+        """
+        :param rds: ``redis.Redis``
+        :param prefix: added to the keys
+        :param ttl: seconds to keep a blob that was never fetched
+        """
+
+        self.rds = rds
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def path(self, key):
+        return '{}/{}'.format(self.prefix, key)
+
+    def put(self, key, data):
+        self.rds.set(self.path(key), bytes(data), ex=self.ttl)
+
+    def get(self, key):
+        return self.rds.get(self.path(key))
+
+    def delete(self, key):
+        self.rds.delete(self.path(key))
+
+
+def blob_stage(config):
+    """
+    The blob stage set by ``[celery] claim_check``.
+
+    :param config: the global config
+    :return: ``FileBlobStage``, ``RedisBlobStage``, or None when captures go through the broker
+    """
+
+    cfg = partial(get_config_value, config, 'celery')
+
+    mode = cfg('claim_check', 'CELERY_CLAIM_CHECK', CLAIM_CHECK_OFF)
+    ttl = int(cfg('blob_ttl', 'CELERY_BLOB_TTL', 3600))
+
+    if mode in [None, CLAIM_CHECK_OFF]:
+        return None
+
+    if mode == CLAIM_CHECK_FILE:
+        return FileBlobStage(cfg('blob_dir', 'CELERY_BLOB_DIR', './blobs'), ttl)
+
+    if mode == CLAIM_CHECK_REDIS:
+        # only needed for this
+        import redis
+
+        rds = redis.Redis(
+            host=cfg('host', 'CELERY_REDIS_HOST'),
+            port=int(cfg('port', 'CELERY_REDIS_PORT', 6379)),
+            db=int(cfg('db', 'CELERY_REDIS_DB', 0)))
+
+        return RedisBlobStage(rds, cfg('blob_prefix', 'CELERY_BLOB_PREFIX', 'blob'), ttl)
+
+    log.error('Unknown claim_check {}, should be off, file, or redis'.format(mode))
+    return None
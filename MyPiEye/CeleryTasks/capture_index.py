@@ -0,0 +1,191 @@
+import json
+import logging
+from datetime import datetime, timedelta
+
+import pytz
+
+log = logging.getLogger(__name__)
+
+# the capture's key, under the prefix and camera id. Matches the minio object names.
+KEY_FORMAT = '%Y%m%d/%H/%M/%Y.%m.%d.%H.%M.%S.%f'
+
+# the last part of the key, which has the whole time
+NAME_FORMAT = '%Y.%m.%d.%H.%M.%S.%f'
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def capture_score(dt_stamp: datetime):
+    """
+    A capture's score in the per-camera index: seconds since the epoch, UTC.
+
+    :param dt_stamp: naive UTC datetime
+    :return: float
+    """
+    return (dt_stamp - _EPOCH).total_seconds()
+
+
+def capture_time(score):
+    """
+    The reverse of ``capture_score``.
+
+    :param score: seconds since the epoch
+    :return: naive UTC datetime, to the microsecond
+    """
+    return _EPOCH + timedelta(microseconds=round(score * 1000000))
+
+
+class CaptureIndex(object):
+    """
+    Writes captures to the redis db.
+
+    Capture times are naive, in the camera's local time, as the camera stamps them. They're taken to be in
+    ``timezone``, and converted to UTC for the ``utc_time`` field and the scores. Keys keep the local time,
+    like the minio object names.
+
+    Each capture is a string key with its details as JSON, as before. Each camera also gets a sorted set of
+    its capture keys, scored by capture time (see ``capture_score``), so a time range is one ``ZRANGEBYSCORE``
+    instead of a scan over every key. The cameras are kept in a set.
+
+    Captures are buffered by :func:`add`, and written with one pipeline by :func:`flush`.
+
+    Layout, under ``prefix``:
+     - ``<prefix>/<cam_id>/<KEY_FORMAT>``: JSON with ``utc_time``, ``local_time``, and ``camera_id``
+     - ``<prefix>/index/<cam_id>``: sorted set of those keys
+     - ``<prefix>/cameras``: set of camera ids
+    """
+
+    def __init__(self, rds, prefix, timezone='UTC', batch_size=100):
+        """
+        :param rds: ``redis.Redis``
+        :param prefix: key prefix, ``db_prefix`` in ``[db_redis]``
+        :param timezone: the cameras' timezone, the capture times are in it
+        :param batch_size: captures to buffer before writing, even if :func:`flush` isn't called
+        """
+
+        self.rds = rds
+        self.prefix = prefix
+        self.batch_size = max(1, int(batch_size))
+
+        # looked up once
+        self.tz = pytz.timezone(timezone)
+
+        self._pending = []
+
+    def key(self, cam_id, dt_stamp: datetime):
+        return '{}/{}/{}'.format(self.prefix, cam_id, dt_stamp.strftime(KEY_FORMAT))
+
+    def index_key(self, cam_id):
+        return '{}/index/{}'.format(self.prefix, cam_id)
+
+    def cameras_key(self):
+        return '{}/cameras'.format(self.prefix)
+
+    def utc_time(self, dt_stamp: datetime):
+        """
+        :param dt_stamp: naive capture time, in ``timezone``
+        :return: naive UTC datetime
+        """
+        return self.tz.localize(dt_stamp).astimezone(pytz.utc).replace(tzinfo=None)
+
+    def add(self, dt_stamp: datetime, cam_id):
+        """
+        Buffers a capture.
+
+        :param dt_stamp: naive capture time, in ``timezone``
+        :param cam_id: camera id
+        :return: None
+        """
+
+        self._pending.append((dt_stamp, cam_id))
+
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered captures, in one round trip.
+
+        :return: the number written
+        """
+
+        if not self._pending:
+            return 0
+
+        pending = self._pending
+        self._pending = []
+
+        pipe = self.rds.pipeline(transaction=False)
+
+        # one ZADD and SADD per camera
+        index = {}
+
+        for dt_stamp, cam_id in pending:
+            key = self.key(cam_id, dt_stamp)
+
+            local_time = self.tz.localize(dt_stamp)
+            utc_time = local_time.astimezone(pytz.utc).replace(tzinfo=None)
+
+            val = {
+                'utc_time': utc_time.isoformat(timespec='microseconds'),
+                'local_time': local_time.isoformat(timespec='microseconds'),
+                'camera_id': cam_id
+            }
+
+            pipe.set(key, json.dumps(val))
+            index.setdefault(cam_id, {})[key] = capture_score(utc_time)
+
+        for cam_id, members in index.items():
+            pipe.zadd(self.index_key(cam_id), members)
+
+        pipe.sadd(self.cameras_key(), *index.keys())
+
+        pipe.execute()
+
+        log.info('Indexed {} captures'.format(len(pending)))
+
+        return len(pending)
+
+    def rebuild(self, cam_id, batch=1000):
+        """
+        Adds a camera's existing capture keys to its sorted set, for captures registered before there was one.
+
+        :param cam_id: camera id
+        :param batch: keys per ``SCAN`` and pipeline
+        :return: the number of captures indexed
+        """
+
+        prefix = '{}/{}/'.format(self.prefix, cam_id)
+        count = 0
+
+        members = {}
+
+        def write():
+            pipe = self.rds.pipeline(transaction=False)
+            pipe.zadd(self.index_key(cam_id), members)
+            pipe.sadd(self.cameras_key(), cam_id)
+            pipe.execute()
+
+        for key in self.rds.scan_iter(match=prefix + '*', count=batch):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+
+            try:
+                dt_stamp = datetime.strptime(key.rsplit('/', 1)[-1], NAME_FORMAT)
+            except ValueError:
+                continue
+
+            members[key] = capture_score(self.utc_time(dt_stamp))
+
+            if len(members) >= batch:
+                write()
+                count += len(members)
+                members = {}
+
+        if members:
+            write()
+            count += len(members)
+
+        log.info('Indexed {} existing captures for {}'.format(count, cam_id))
+
+        return count
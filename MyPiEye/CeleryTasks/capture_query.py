@@ -0,0 +1,188 @@
+import logging
+from datetime import timedelta
+from functools import partial
+
+import pytz
+
+from MyPiEye.CLI import get_config_value
+from MyPiEye.CeleryTasks.capture_index import capture_score, capture_time
+
+log = logging.getLogger(__name__)
+
+HOUR = 'hour'
+DAY = 'day'
+
+
+class CaptureQuery(object):
+    """
+    Looks up captures in the per-camera sorted sets written by ``CaptureIndex``.
+
+    Times passed in and returned are naive UTC, like the scores. The cameras stamp captures in local time,
+    so use :func:`to_utc` and :func:`local_time` to convert. Each capture is a dict with ``key``, the capture's
+    key in redis, ``name``, the key without the prefix, which has the local time, and ``utc_time``.
+    """
+
+    def __init__(self, rds, prefix, timezone='UTC'):
+        """
+        :param rds: ``redis.Redis``
+        :param prefix: key prefix, ``db_prefix`` in ``[db_redis]``
+        :param timezone: the cameras' timezone, and where the hour and day boundaries are for :func:`counts`
+        """
+
+        self.rds = rds
+        self.prefix = prefix
+        self.tz = pytz.timezone(timezone)
+
+    def index_key(self, cam_id):
+        return '{}/index/{}'.format(self.prefix, cam_id)
+
+    def _capture(self, member, score):
+        if isinstance(member, bytes):
+            member = member.decode('utf-8')
+
+        return {
+            'key': member,
+            'name': member[len(self.prefix) + 1:],
+            'utc_time': capture_time(score)
+        }
+
+    def cameras(self):
+        """
+        :return: sorted list of the camera ids with captures
+        """
+
+        cams = self.rds.smembers('{}/cameras'.format(self.prefix))
+        return sorted(cam.decode('utf-8') if isinstance(cam, bytes) else cam for cam in cams)
+
+    def between(self, cam_id, start=None, end=None, offset=0, limit=100):
+        """
+        Captures from ``start`` up to, but not including, ``end``, oldest first.
+
+        :param cam_id: camera id
+        :param start: UTC datetime, None for the first capture
+        :param end: UTC datetime, None for the last
+        :param offset: captures to skip, for paging
+        :param limit: the most to return
+        :return: list of captures
+        """
+
+        low = '-inf' if start is None else capture_score(start)
+        high = '+inf' if end is None else '({}'.format(capture_score(end))
+
+        found = self.rds.zrangebyscore(
+            self.index_key(cam_id), low, high, start=offset, num=limit, withscores=True)
+
+        return [self._capture(member, score) for member, score in found]
+
+    def latest(self, cam_id, count=10, offset=0):
+        """
+        The newest captures, newest first.
+
+        :param cam_id: camera id
+        :param count: how many
+        :param offset: captures to skip, for paging
+        :return: list of captures
+        """
+
+        found = self.rds.zrevrange(self.index_key(cam_id), offset, offset + count - 1, withscores=True)
+
+        return [self._capture(member, score) for member, score in found]
+
+    def count(self, cam_id, start=None, end=None):
+        """
+        The number of captures from ``start`` up to, but not including, ``end``.
+        """
+
+        low = '-inf' if start is None else capture_score(start)
+        high = '+inf' if end is None else '({}'.format(capture_score(end))
+
+        return self.rds.zcount(self.index_key(cam_id), low, high)
+
+    def buckets(self, start, end, size=HOUR):
+        """
+        The hour or day boundaries from ``start`` to ``end``, in local time.
+
+        :param start: UTC datetime
+        :param end: UTC datetime
+        :param size: ``HOUR`` or ``DAY``
+        :return: list of UTC datetimes, the start of each bucket followed by the end of the last one
+        """
+
+        if size not in [HOUR, DAY]:
+            raise ValueError('Unknown bucket size {}, should be {} or {}'.format(size, HOUR, DAY))
+
+        local = pytz.utc.localize(start).astimezone(self.tz).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+        if size == DAY:
+            local = local.replace(hour=0)
+
+        ret = []
+
+        while True:
+            # so daylight saving time changes land on the right hour
+            utc = self.tz.localize(local).astimezone(pytz.utc).replace(tzinfo=None)
+            ret.append(utc)
+
+            if utc >= end:
+                break
+
+            local += timedelta(hours=1) if size == HOUR else timedelta(days=1)
+
+        return ret
+
+    def counts(self, cam_id, start, end, size=HOUR):
+        """
+        Captures per hour or day, with one round trip.
+
+        :param cam_id: camera id
+        :param start: UTC datetime
+        :param end: UTC datetime
+        :param size: ``HOUR`` or ``DAY``
+        :return: list of (bucket start as a UTC datetime, count)
+        """
+
+        bounds = self.buckets(start, end, size)
+
+        pipe = self.rds.pipeline(transaction=False)
+        for low, high in zip(bounds, bounds[1:]):
+            pipe.zcount(self.index_key(cam_id), capture_score(low), '({}'.format(capture_score(high)))
+
+        return list(zip(bounds, pipe.execute()))
+
+    def local_time(self, dt_stamp):
+        """
+        :param dt_stamp: UTC datetime
+        :return: the aware datetime in ``timezone``
+        """
+        return pytz.utc.localize(dt_stamp).astimezone(self.tz)
+
+    def to_utc(self, dt_stamp):
+        """
+        :param dt_stamp: naive datetime in ``timezone``
+        :return: naive UTC datetime
+        """
+        return self.tz.localize(dt_stamp).astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def capture_query(config):
+    """
+    A ``CaptureQuery`` on the ``[db_redis]`` db.
+
+    :param config: the global config
+    :return: ``CaptureQuery``
+    """
+
+    # only needed for this
+    import redis
+
+    rcfg = partial(get_config_value, config, 'db_redis')
+
+    rds = redis.Redis(
+        host=rcfg('host', 'DB_REDIS_HOST'),
+        port=int(rcfg('port', 'DB_REDIS_PORT', 6379)),
+        db=int(rcfg('db', 'DB_REDIS_DB', 0)),
+        password=rcfg('password', 'DB_REDIS_PASSWORD'))
+
+    return CaptureQuery(
+        rds,
+        rcfg('db_prefix', 'DB_REDIS_PREFIX'),
+        get_config_value(config, 'global', 'timezone', 'TIMEZONE', 'US/Central'))
@@ -0,0 +1,72 @@
+import struct
+from datetime import datetime, timedelta
+
+# what follows the header
+# jpeg: the encoded image
+# ref: the key of the JPEG in the blob stage, see ``blob_stage``
+KIND_JPEG = 1
+KIND_REF = 2
+
+# magic, version, kind, camera id length, capture time (microseconds since 1970-01-01, naive camera local time),
+# body length
+_HEADER = struct.Struct('!4sBBHqI')
+_MAGIC = b'MPE1'
+_VERSION = 1
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def pack_capture(body, dt_stamp: datetime, cam_id: str, kind=KIND_JPEG):
+    """
+    Packs a capture for a Celery task: a small fixed header, the camera id, then the body as is.
+
+    :param body: the JPEG as bytes or a uint8 array, or the blob key for ``KIND_REF``
+    :param dt_stamp: capture time, naive, in the camera's local time
+    :param cam_id: camera id
+    :param kind: what the body is, e.g. ``KIND_JPEG``
+    :return: bytes
+    """
+
+    cam = cam_id.encode('utf-8')
+
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    body = memoryview(body).cast('B')
+
+    micros = (dt_stamp - _EPOCH) // timedelta(microseconds=1)
+
+    header = _HEADER.pack(_MAGIC, _VERSION, kind, len(cam), micros, len(body))
+
+    return b''.join([header, cam, body])
+
+
+def unpack_capture(payload):
+    """
+    The reverse of :func:`pack_capture`.
+
+    :param payload: bytes from :func:`pack_capture`
+    :return: tuple of (kind, capture datetime, camera id, body as a memoryview into ``payload``)
+    """
+
+    view = memoryview(payload)
+
+    if len(view) < _HEADER.size:
+        raise PayloadError('Capture payload is too short: {} bytes'.format(len(view)))
+
+    magic, version, kind, cam_len, micros, body_len = _HEADER.unpack_from(view)
+
+    if magic != _MAGIC or version != _VERSION:
+        raise PayloadError('Not a capture payload, or an unknown version: {} {}'.format(magic, version))
+
+    start = _HEADER.size + cam_len
+    if len(view) != start + body_len:
+        raise PayloadError('Capture payload is {} bytes, expected {}'.format(len(view), start + body_len))
+
+    cam_id = view[_HEADER.size:start].tobytes().decode('utf-8')
+    dt_stamp = _EPOCH + timedelta(microseconds=micros)
+
+    return kind, dt_stamp, cam_id, view[start:]
@@ -1,16 +1,15 @@
 from os import environ
 import logging
 from functools import partial
-from time import sleep
+from time import sleep, monotonic
 from datetime import datetime
 import pytz
 
-from io import BytesIO
-
-import numpy as np
-
 from MyPiEye.CeleryTasks import celery_app
+from MyPiEye.CeleryTasks.payload import pack_capture, KIND_REF
+from MyPiEye.CeleryTasks.blob_stage import blob_stage, blob_key
 import MyPiEye.CeleryTasks as mycel
+from MyPiEye.encoder import JpegEncoder, ARCHIVE
 
 from MyPiEye.CLI import get_config_value, enable_log, set_loglevel
 
@@ -28,6 +27,20 @@ class CeleryStorage(object):
 
         self.redis_url = f'redis://{self.host}:{self.port}/{self.db}'
 
+        # only used when the frames aren't already encoded, see ``start``
+        self.encoder = JpegEncoder(config)
+
+        # with claim checks, the JPEGs are staged here and the tasks only carry the key
+        self.blobs = blob_stage(config)
+
+        # captures per task. With more than one, captures are held for up to batch_wait seconds to fill a batch.
+        self.batch_size = max(1, int(self.cfg('batch_size', 'CELERY_BATCH_SIZE', 1)))
+        self.batch_wait = float(self.cfg('batch_wait', 'CELERY_BATCH_WAIT', 1))
+        self._batch = []
+
+        # when the oldest capture in the batch has waited long enough, from ``monotonic()``
+        self._batch_deadline = None
+
         celery_app.conf.broker_url = self.redis_url
         celery_app.conf.result_backend = self.redis_url
 
@@ -59,36 +72,98 @@ class CeleryStorage(object):
     def configure(self):
         return True
 
-    def start(self, shared_obj, shared_lock, storage_queues: dict):
-        pri_storage_queue = storage_queues.get('celery')
-        if pri_storage_queue is None:
-            log.error('No message queue for celery')
+    def start(self, channel):
+        cursor = channel.cursors.get('celery')
+        if cursor is None:
+            log.error('No frame cursor for celery')
             sleep(1)
             return
 
         while True:
 
-            # blocks until a message is ready
-            dt_pic = pri_storage_queue.get()
+            # blocks until a frame is ready, or it's time to send a partial batch
+            wait = None
+            if self._batch:
+                wait = max(0, self._batch_deadline - monotonic())
 
-            log.info('processing incoming capture')
+            frame = cursor.get(wait)
+            if frame is None:
+                self.flush()
+                continue
 
-            # block until it's not in use
-            with shared_lock:
-                curdt: datetime = shared_obj['img_captured']
-                imgbuf = shared_obj['imgbuf']
+            seq, imgbuf, curdt = frame
 
-                # if the current image datetime doesn't match the message
-                # then this message is stale. We can skip it and pull the next.
-                if curdt != dt_pic['dt']:
-                    log.warning('Skipping stale message')
-                    continue
+            # shared with the other backends, when there's a JPEG cache
+            if channel.jpegs is not None:
+                jpg = channel.jpegs.get(seq, imgbuf, ARCHIVE, 'celery')
+            else:
+                jpg = self.encoder.encode(imgbuf, ARCHIVE)
 
+                # the camera may have overwritten it while it was being encoded
+                if not channel.frames.valid(seq):
+                    log.warning('Frame {} was overwritten while it was encoded, dropping it'.format(seq))
+                    jpg = None
+
+            if jpg is not None:
                 log.info('Sending message to celery worker: {}'.format(curdt.isoformat()))
-                self.upload(imgbuf, curdt)
+                self.upload_jpeg(jpg, curdt)
+
+            if channel.jpegs is not None:
+                channel.jpegs.ack(seq, ARCHIVE, 'celery')
+
+            # a steady trickle of frames doesn't hold the batch any longer
+            if self._batch and monotonic() >= self._batch_deadline:
+                self.flush()
 
     def upload(self, cv2_imgbytes, dt_stamp):
+        jpg = self.encoder.encode(cv2_imgbytes, ARCHIVE)
+        if jpg is None:
+            return False
+
+        return self.upload_jpeg(jpg, dt_stamp)
+
+    def upload_jpeg(self, jpg, dt_stamp):
+        """
+        Sends an encoded capture to the workers.
+
+        :param jpg: the JPEG, as bytes or a uint8 array
+        :param dt_stamp: capture datetime
+        :return: True
+        """
+
+        if self.blobs is not None:
+            # keeps the image off the broker
+            key = blob_key(self.camid, dt_stamp)
+            self.blobs.put(key, jpg)
+            payload = pack_capture(key, dt_stamp, self.camid, KIND_REF)
+        else:
+            # the JPEG with a small header, rather than the raw frame
+            payload = pack_capture(jpg, dt_stamp, self.camid)
+
+        if self.batch_size == 1:
+            # stored, then registered, in one message
+            mycel.store_and_register.delay(payload)
+            return True
+
+        self._batch.append(payload)
+        if len(self._batch) == 1:
+            self._batch_deadline = monotonic() + self.batch_wait
+
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+        return True
+
+    def flush(self):
+        """
+        Sends the captures waiting for a batch.
+        """
+
+        if not self._batch:
+            return
+
+        log.info('Sending {} captures to celery'.format(len(self._batch)))
 
-        imgstr = cv2_imgbytes.dumps()
-        mycel.store_capture.delay(imgstr, dt_stamp, self.camid)
-        mycel.register_capture.delay(dt_stamp, self.camid)
+        mycel.store_and_register_batch.delay(self._batch)
+        self._batch = []
+        self._batch_deadline = None
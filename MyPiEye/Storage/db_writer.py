@@ -0,0 +1,236 @@
+import threading
+from time import monotonic
+
+import multiprocessing
+
+log = multiprocessing.get_logger()
+
+
+class DynamoDbWriter(object):
+    """
+    Batches the DynamoDB writes for uploaded images.
+
+    Image rows are queued, and written with the table's ``batch_writer`` once ``batch_size`` are waiting,
+    or ``flush_interval`` seconds after the first one was queued, whichever comes first.
+
+    The camera table only keeps the latest update for each camera, so it's written at most once
+    every ``camera_interval`` seconds per camera. Updates in between replace each other, the last one is
+    written when the interval is up.
+
+    Anything still waiting is written by :func:`flush`, and from a timer thread, so nothing is left behind
+    when the uploads stop.
+    """
+
+    def __init__(self, image_table=None, camera_table=None, batch_size=25, flush_interval=5.0, camera_interval=30.0):
+        """
+        :param image_table: boto3 ``Table`` for the images, None to skip them
+        :param camera_table: boto3 ``Table`` for the camera status, None to skip it
+        :param batch_size: image rows to collect before writing
+        :param flush_interval: the longest an image row waits, in seconds
+        :param camera_interval: the least time between writes for a camera, in seconds
+        """
+
+        self.image_table = image_table
+        self.camera_table = camera_table
+
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.camera_interval = float(camera_interval)
+
+        # image rows waiting to be written
+        self._images = []
+        self._images_since = None
+
+        # cam_id: latest row, not written yet
+        self._cameras = {}
+
+        # cam_id: when it was last written
+        self._camera_written = {}
+
+        # writes and rows, to see how much batching saves
+        self.stats = {'image_rows': 0, 'image_batches': 0, 'camera_rows': 0, 'camera_writes': 0}
+
+        self._lock = threading.RLock()
+        self._timer = None
+
+        # monotonic time the timer goes off
+        self._timer_due = None
+
+    @staticmethod
+    def from_config(s3_config, image_table=None, camera_table=None):
+        """
+        A writer using the ``db_batch_size``, ``db_flush_interval``, and ``db_camera_interval`` settings.
+
+        :param s3_config: the ``[s3]`` section
+        :param image_table: boto3 ``Table`` for the images
+        :param camera_table: boto3 ``Table`` for the camera status
+        :return: ``DynamoDbWriter``
+        """
+
+        return DynamoDbWriter(
+            image_table,
+            camera_table,
+            batch_size=int(s3_config.get('db_batch_size', 25)),
+            flush_interval=float(s3_config.get('db_flush_interval', 5)),
+            camera_interval=float(s3_config.get('db_camera_interval', 30)))
+
+    def add_image(self, item):
+        """
+        Queues a row for the image table.
+
+        :param item: the row
+        :return: None
+        """
+
+        if self.image_table is None:
+            return
+
+        with self._lock:
+            if not self._images:
+                self._images_since = monotonic()
+
+            self._images.append(item)
+
+            if len(self._images) >= self.batch_size:
+                self._flush_images()
+
+            self._schedule()
+
+    def update_camera(self, cam_id, item):
+        """
+        Sets the camera's latest row. Written now if the camera hasn't been for ``camera_interval`` seconds,
+        otherwise when the interval is up, unless a newer one replaces it first.
+
+        :param cam_id: the camera
+        :param item: the row
+        :return: None
+        """
+
+        if self.camera_table is None:
+            return
+
+        with self._lock:
+            self._cameras[cam_id] = item
+            self.stats['camera_rows'] += 1
+
+            self._flush_cameras()
+            self._schedule()
+
+    def flush(self, force=True):
+        """
+        Writes what's waiting.
+
+        :param force: write camera rows even if their interval isn't up
+        :return: None
+        """
+
+        with self._lock:
+            if self._images:
+                self._flush_images()
+
+            self._flush_cameras(force)
+
+    def _flush_images(self):
+        items = self._images
+        self._images = []
+        self._images_since = None
+
+        try:
+            # de-duplicates by key, and retries unprocessed items
+            with self.image_table.batch_writer(overwrite_by_pkeys=['s3key']) as batch:
+                for item in items:
+                    batch.put_item(Item=item)
+        except Exception as e:
+            log.error('Failed to write {} image rows: {}'.format(len(items), e))
+            return
+
+        self.stats['image_rows'] += len(items)
+        self.stats['image_batches'] += 1
+
+        log.debug('Wrote {} image rows'.format(len(items)))
+
+    def _flush_cameras(self, force=False):
+        now = monotonic()
+
+        for cam_id in list(self._cameras.keys()):
+            last = self._camera_written.get(cam_id, None)
+            if not force and last is not None and now - last < self.camera_interval:
+                continue
+
+            item = self._cameras.pop(cam_id)
+            self._camera_written[cam_id] = now
+
+            try:
+                self.camera_table.put_item(Item=item)
+            except Exception as e:
+                log.error('Failed to update camera {}: {}'.format(cam_id, e))
+                continue
+
+            self.stats['camera_writes'] += 1
+
+    def _next_flush(self):
+        """
+        Seconds until something waiting is due, or None if nothing is. Must hold ``_lock``.
+        """
+
+        due = []
+
+        if self._images:
+            due.append(self._images_since + self.flush_interval)
+
+        for cam_id in self._cameras:
+            due.append(self._camera_written.get(cam_id, 0) + self.camera_interval)
+
+        if not due:
+            return None
+
+        return max(0.0, min(due) - monotonic())
+
+    def _schedule(self):
+        delay = self._next_flush()
+        if delay is None:
+            return
+
+        due = monotonic() + delay
+
+        if self._timer is not None:
+            if self._timer_due <= due:
+                return
+
+            # something new is due sooner
+            self._timer.cancel()
+
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer_due = due
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            # replaced while it was waiting for the lock
+            if self._timer is not threading.current_thread():
+                return
+
+            self._timer = None
+
+            if self._images and monotonic() - self._images_since >= self.flush_interval:
+                self._flush_images()
+
+            self._flush_cameras()
+            self._schedule()
+
+    def close(self):
+        """
+        Writes everything waiting, and stops the timer.
+        """
+
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            self.flush()
+
+            log.info('Wrote {} image rows in {} batches, {} camera updates as {} writes'.format(
+                self.stats['image_rows'], self.stats['image_batches'],
+                self.stats['camera_rows'], self.stats['camera_writes']))
@@ -3,7 +3,7 @@ from requests_toolbelt.multipart.encoder import MultipartEncoder
 import json
 import logging
 from os.path import exists, basename, abspath, join
-from time import sleep
+from time import sleep, monotonic
 
 import multiprocessing
 
@@ -33,9 +33,12 @@ class GDriveStorage(object):
 
         self.gauth = gauth
 
-        self.headers = {
-            'Authorization': 'Bearer {}'.format(self.gauth.access_token)
-        }
+        # keeps the connection to Google open between uploads
+        self.session = requests.Session()
+
+        # folder ids don't change, so they're only looked up once
+        self._folder_id = None
+        self._subfolders = {}
 
         self.credentiall_folder = self.config.get('credential_folder')
 
@@ -43,9 +46,26 @@ class GDriveStorage(object):
         self.client_id = self.gconfig.get('client_id', None)
         self.client_secret = self.gconfig.get('client_secret', None)
 
+        # which image to upload, see ``IMAGE_VARIANTS``
+        self.variant = self.gconfig.get('variant', 'full')
+
+    @property
+    def headers(self):
+        """
+        Auth headers, with the token refreshed if it's about to expire.
+        """
+        self.gauth.ensure_token()
+
+        return {
+            'Authorization': 'Bearer {}'.format(self.gauth.access_token)
+        }
+
     @property
     def folder_id(self):
-        return self.main_folder(create=False)
+        if self._folder_id is None:
+            self._folder_id = self.main_folder(create=False)
+
+        return self._folder_id
 
     def check(self):
 
@@ -103,7 +123,7 @@ class GDriveStorage(object):
             name = self.folder_name
             parent_id = 'root'
 
-            retval = GDriveStorage.find_folders(self.gauth, parent_id, name)
+            retval = GDriveStorage.find_folders(self.gauth, parent_id, name, self.session)
 
             if retval is None:
                 log.error('Cannot find main folder.')
@@ -120,12 +140,14 @@ class GDriveStorage(object):
                 if create:
                     log.warning('Main folder {} does not exist. Creating.'.format(name))
 
-                    folder_id = GDriveStorage.create_folder(self.gauth, name, parent_id='root')
+                    folder_id = GDriveStorage.create_folder(self.gauth, name, parent_id='root', session=self.session)
                     return folder_id
                 else:
                     log.error('main folder not found')
                     return None
 
+            return files[0]['id']
+
         finally:
             GDriveStorage.folder_lock.release()
 
@@ -134,22 +156,32 @@ class GDriveStorage(object):
         Finds or creates a subfolder off of the main folder.
 
         :param folder_name:
-        :return: the ID of the folder
+        :return: the ID of the folder, or None if it couldn't be found or created
         """
 
-        assert self.folder_id is not None, 'folder id is None'
+        if self.folder_id is None:
+            log.error('GDrive folder is not found')
+            return None
+
+        fid = self._subfolders.get(folder_name, None)
+        if fid is not None:
+            return fid
 
         GDriveStorage.folder_lock.acquire()
 
         try:
-            folders = GDriveStorage.find_folders(self.gauth, self.folder_id, folder_name)
+            folders = GDriveStorage.find_folders(self.gauth, self.folder_id, folder_name, self.session)
+            if folders is None:
+                log.error('Cannot look up subfolder {}'.format(folder_name))
+                return None
+
             files = folders.get('files', [])
 
             fid = None
 
             if len(files) == 0:
                 log.warning('Creating subfolder {}'.format(folder_name))
-                fid = GDriveStorage.create_folder(self.gauth, folder_name, self.folder_id)
+                fid = GDriveStorage.create_folder(self.gauth, folder_name, self.folder_id, self.session)
                 sleep(.5)
             elif len(files) == 1:
                 fid = files[0]['id']
@@ -159,55 +191,76 @@ class GDriveStorage(object):
         finally:
             GDriveStorage.folder_lock.release()
 
+        if fid is not None:
+            self._subfolders[folder_name] = fid
+
         return fid
 
     @staticmethod
-    def save(filename, metadata, headers):
+    def save(fdata, filename, metadata, headers, session=None):
+        """
+        Uploads the image.
+
+        :param fdata: the JPEG, as bytes
+        :param filename: the name to give it
+        :param metadata: GDrive file metadata
+        :param headers: request headers, with the auth
+        :param session: a ``requests.Session`` to reuse its connection
+        :return: True on success
+        """
+        if session is None:
+            session = requests
+
         url = 'https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart'
 
-        with open(filename, 'rb') as ifile:
-            fdata = ifile.read()
+        files = {
+            'data': ('metadata', json.dumps(metadata), 'application/json; charset=UTF-8'),
+            'file': (filename, fdata, 'image/jpeg')
+        }
 
-            files = {
-                'data': ('metadata', json.dumps(metadata), 'application/json; charset=UTF-8'),
-                'file': (filename, fdata, 'image/jpeg')
-            }
+        menc = MultipartEncoder(
+            fields=files)
 
-            menc = MultipartEncoder(
-                fields=files)
+        headers.update({'Content-Type': 'multipart/related; boundary={}'.format(menc.boundary_value)})
 
-            headers.update({'Content-Type': 'multipart/related; boundary={}'.format(menc.boundary_value)})
+        upload_res = session.post(url, data=menc, headers=headers)
 
-            upload_res = requests.post(url, data=menc, headers=headers)
+        if upload_res.ok:
+            log.debug('Upload responded ok: {}'.format(upload_res.status_code))
+            return True
+        else:
+            log.error('Error ({})_uploading {}'.format(upload_res.status_code, filename))
+            content = upload_res.json()
+            log.error(content['error']['message'])
+            return False
 
-            if upload_res.ok:
-                log.debug('Upload responded ok: {}'.format(upload_res.status_code))
-                return True
-            else:
-                log.error('Error ({})_uploading {}'.format(upload_res.status_code, filename))
-                content = upload_res.json()
-                log.error(content['error']['message'])
-                return False
+    def upload_file(self, img_capture, variant=None):
+        """
+        Uploads an image into the subfolder for its day.
 
-    def upload_file(self, img_capture):
-        assert self.folder_id is not None, 'GDrive folder is not found'
+        :param img_capture: ``ImageCapture`` object.
+        :param variant: the image to upload, None for ``variant`` from the config
+        :return: True on success
+        """
 
-        filename = img_capture.full_fname
-        subdir = img_capture.subdir
+        if variant is None:
+            variant = self.variant
 
-        log.debug('Uploading {}'.format(filename))
+        filename = img_capture.filename(variant)
+        fdata = img_capture.jpg(variant)
+        subdir = img_capture.subdir
 
-        parent_id = None
-        parent = GDriveStorage.find_folders(self.gauth, parent_id=self.folder_id, folder_name=subdir)
+        if fdata is None:
+            log.error('No {} image for {}'.format(variant, filename))
+            return False
 
-        if len(parent['files']) == 0:
-            ret = self.subfolder(subdir)
-            assert ret is not None
-            parent_id = ret
-        else:
-            parent_id = parent['files'][0]['id']
+        log.debug('Uploading {}'.format(filename))
 
-        assert parent_id is not None, 'Parent id is None'
+        # finds or creates it, then remembers it
+        parent_id = self.subfolder(subdir)
+        if parent_id is None:
+            log.error('No GDrive folder for {}'.format(filename))
+            return False
 
         metadata = {
             'name': basename(filename),
@@ -216,19 +269,25 @@ class GDriveStorage(object):
         }
 
         retry = 0
+        saved = False
 
-        while retry < 1:
-
-            if GDriveStorage.save(filename, metadata, dict(self.headers)):
-                break
+        while not saved and retry < 1:
+            saved = GDriveStorage.save(fdata, filename, metadata, self.headers, self.session)
             retry += 1
 
+        if not saved:
+            return False
+
         log.info('Upload {} complete'.format(filename))
 
         return True
 
     @staticmethod
-    def find_folders(gauth, parent_id, folder_name):
+    def find_folders(gauth, parent_id, folder_name, session=None):
+        if session is None:
+            session = requests
+
+        gauth.ensure_token()
 
         headers = {
             'Authorization': 'Bearer {}'.format(gauth.access_token),
@@ -239,7 +298,7 @@ class GDriveStorage(object):
         qry = "mimeType = 'application/vnd.google-apps.folder' " \
               "and '{}' in parents and trashed = false and name = '{}'".format(parent_id, folder_name)
 
-        folder_res = requests.get(url, headers=headers, params={'q': qry})
+        folder_res = session.get(url, headers=headers, params={'q': qry})
 
         if folder_res.ok:
             return folder_res.json()
@@ -251,7 +310,11 @@ class GDriveStorage(object):
             return None
 
     @staticmethod
-    def create_folder(gauth, folder_name, parent_id='root'):
+    def create_folder(gauth, folder_name, parent_id='root', session=None):
+        if session is None:
+            session = requests
+
+        gauth.ensure_token()
 
         headers = {
             'Authorization': 'Bearer {}'.format(gauth.access_token),
@@ -266,7 +329,7 @@ class GDriveStorage(object):
 
         url = 'https://www.googleapis.com/drive/v3/files'
 
-        create_res = requests.post(url, headers=headers, data=json.dumps(data))
+        create_res = session.post(url, headers=headers, data=json.dumps(data))
         create_res.raise_for_status()
 
         retval = create_res.json()
@@ -275,6 +338,7 @@ class GDriveStorage(object):
 
     @staticmethod
     def delete_folder(gauth, folder_id):
+        gauth.ensure_token()
 
         headers = {
             'Authorization': 'Bearer {}'.format(gauth.access_token)
@@ -330,6 +394,12 @@ class GDriveAuth(object):
         self.refresh_token = None
         self.token_expires = None
 
+        # monotonic time the access token was last known good
+        self.token_time = None
+
+        # refresh this many seconds before the token expires
+        self.refresh_margin = 300
+
     def check(self):
         ret = True
 
@@ -392,6 +462,7 @@ class GDriveAuth(object):
 
         if self.try_auth():
             log.info('Authentication success')
+            self.token_time = monotonic()
             return True
 
         log.warning('access_token is invalid, attempting refresh')
@@ -482,6 +553,7 @@ class GDriveAuth(object):
             resdata = refresh_response.json()
             self.access_token = resdata['access_token']
             self.token_expires = resdata['expires_in']
+            self.token_time = monotonic()
 
             self.save_auth()
 
@@ -491,6 +563,21 @@ class GDriveAuth(object):
         log.warning('Token refresh failed')
         return False
 
+    def ensure_token(self):
+        """
+        Refreshes the access token if it's expired, or about to.
+
+        :return: True if the token should be good
+        """
+
+        if self.token_time is None or self.token_expires is None:
+            return self.refresh_auth_token()
+
+        if monotonic() - self.token_time < int(self.token_expires) - self.refresh_margin:
+            return True
+
+        return self.refresh_auth_token()
+
     def init_token(self):
         """
         Begin the validation flow for user confirmation and permission. Used for "new" installations.
@@ -541,6 +628,7 @@ class GDriveAuth(object):
             self.access_token = validation_response['access_token']
             self.token_expires = validation_response['expires_in']
             self.refresh_token = validation_response['refresh_token']
+            self.token_time = monotonic()
             self.save_auth()
 
             return True
@@ -559,18 +647,16 @@ class GDriveAuth(object):
         return False
 
     @classmethod
-    def init_gauth(cls, client_id, client_secret, filename):
+    def init_gauth(cls, config):
         """
         Helper for getting an initialized object. This will prompt the user at the command line with validation code
         if one has not been set.
 
-        :param client_id:
-        :param client_secret:
-        :param filename: the filename for the saved tokens. Used by :func:__init__
+        :param config: global config dictionary, see :func:`__init__`
         :return: None on failure, initialized :class:`GDriveAuth` object
         """
 
-        gauth = cls(client_id, client_secret, filename)
+        gauth = cls(config)
 
         if gauth.init_auth():
             return gauth
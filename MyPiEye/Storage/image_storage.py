@@ -1,22 +1,57 @@
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from collections import deque
+from functools import partial
+from time import time
 import asyncio
+import threading
 
 import multiprocessing
+import multiprocessing.util
 
 from os.path import join, abspath
 from os import remove
 
+import cv2
+import numpy as np
+
 from .google_drive import GDriveAuth, GDriveStorage
 from .s3_storage import S3Storage
 from .local_storage import LocalStorage
 
-from MyPiEye.motion_detect import ImageCapture
+from MyPiEye.motion_detect import ImageCapture, CaptureTask, IMAGE_VARIANTS, CLEAN, TIMESTAMP, FULL, THUMB
+from MyPiEye.encoder import JpegEncoder, THUMBNAIL
 
 log = multiprocessing.get_logger()
 
+# what to do when a backend has ``max_in_flight`` images queued
+# oldest: cancel the oldest image that hasn't started uploading
+# newest: skip the new image
+# thumbnail: send a thumbnail of the new image instead, up to ``max_in_flight`` more, then skip.
+#            The thumbnail is only made when it's needed.
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+DROP_THUMBNAIL = 'thumbnail'
+
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, DROP_THUMBNAIL)
+
+# in the order they're checked
+BACKENDS = ('local', 's3', 'gdrive')
+
+# set in each worker process by ``ImageStorage.init_worker``
+_worker_config = None
+
+# storage clients, kept for the life of the worker process. See ``ImageStorage.client``.
+_worker_clients = {}
+
 
 class ImageStorage(object):
-    executor = ProcessPoolExecutor(max_workers=4)
+    """
+    Saves motion images to the storage backends, in worker processes.
+
+    Each backend gets its own upload job per image, and has its own limit on how many can be queued or running.
+    Once a backend is at its limit, its ``drop_policy`` decides what happens to new images,
+    so a slow backend can't make the queue, and memory, grow without bound.
+    """
 
     def __init__(self, config, creds_folder='.'):
         """
@@ -32,82 +67,395 @@ class ImageStorage(object):
         self.fs_path = self.config['savedir']
         self.gdrive_settings = self.config.get('gdrive', None)
         self.s3_config = self.config.get('s3', None)
-        self.futures = []
 
-        # how many items to have queued and processing.
-        self.process_limit = multiprocessing.Semaphore(30)
-        self._pcount = 0
+        # the workers get the config once, when they start, rather than with every image
+        self.executor = ProcessPoolExecutor(
+            max_workers=4,
+            initializer=ImageStorage.init_worker,
+            initargs=(config,))
+
+        self.backends = [name for name in BACKENDS if config.get(name, None) is not None]
+
+        self.limits = {}
+        self.policies = {}
+        for name in self.backends:
+            self.limits[name], self.policies[name] = ImageStorage.backend_limits(config, name)
+
+        # done callbacks run on the executor's thread, and cancelling runs them right away
+        self._lock = threading.RLock()
+
+        # per backend, the futures queued or running, oldest first
+        self.in_flight = {name: deque() for name in self.backends}
+
+        # per backend counters, see ``stats``
+        self._stats = {
+            name: {'submitted': 0, 'completed': 0, 'dropped': 0, 'degraded': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for name in self.backends}
+
+        # shared memory name: number of jobs still using it
+        self._task_refs = {}
+
+        # log the stats every this many images, 0 to disable
+        self.stats_interval = int(config.get('multi', {}).get('storage_stats_interval', '50'))
+        self._saved = 0
+
+        # for thumbnails, created the first time a backend falls behind
+        self._encoder = None
 
         log.debug('ImageStorage initialized')
 
     @staticmethod
-    def save(config, img_capture: ImageCapture):
+    def backend_limits(config, name):
+        """
+        Reads ``max_in_flight`` and ``drop_policy`` from the backend's section.
+
+        :param config: main config dictionary
+        :param name: backend section name
+        :return: tuple of (max_in_flight, drop_policy)
+        """
+
+        section = config.get(name, {})
+
+        limit = max(1, int(section.get('max_in_flight', 4)))
+
+        policy = section.get('drop_policy', DROP_OLDEST)
+        if policy not in DROP_POLICIES:
+            log.error('Unknown drop_policy {} in [{}], using {}'.format(policy, name, DROP_OLDEST))
+            policy = DROP_OLDEST
+
+        return limit, policy
+
+    @staticmethod
+    def init_worker(config):
+        """
+        Runs once in each worker process.
+
+        :param config: main config dictionary
+        :return: None
+        """
+
+        global _worker_config
+        _worker_config = config
+
+    @staticmethod
+    def save_task(task: CaptureTask, name, variant, submitted):
+        """
+        Entry point for the workers.
+
+        :param task: ``CaptureTask`` for the images
+        :param name: the backend to save to
+        :param variant: the image to save, None for the backend's ``variant``
+        :param submitted: when the job was queued, from ``time()``
+        :return: how long the job waited to start, in seconds
+        """
+
+        waited = time() - submitted
+
+        if variant is None:
+            variant = ImageStorage.backend_variant(_worker_config, name)
+
+        # only the image it needs is copied out of shared memory
+        ImageStorage.save_to(_worker_config, name, task.load(_worker_config, [variant]), variant)
+
+        return waited
+
+    @staticmethod
+    def client(config, name):
+        """
+        A storage client for this process, created the first time it's asked for and reused after that,
+        along with its connections.
+
+        :param config: main config dictionary
+        :param name: ``local``, ``s3``, or ``gdrive``
+        :return: the client, or None if it couldn't be set up
+        """
+
+        client = _worker_clients.get(name, None)
+        if client is not None:
+            return client
+
+        log.info('Setting up {} storage client'.format(name))
+
+        if name == 'local':
+            client = LocalStorage(config)
+        elif name == 's3':
+            client = S3Storage(config)
+
+            # writes the batched db rows when the worker exits
+            multiprocessing.util.Finalize(None, client.close, exitpriority=10)
+        elif name == 'gdrive':
+            gauth = GDriveAuth.init_gauth(config)
+            if gauth is None:
+                log.error('Unable to authenticate with Google Drive')
+                return None
+            client = GDriveStorage(gauth, config)
+        else:
+            raise ValueError('Unknown storage client {}'.format(name))
+
+        _worker_clients[name] = client
+
+        return client
+
+    @staticmethod
+    def backend_variant(config, name):
+        """
+        The image variant a backend uploads, set with ``variant`` in its section.
+
+        :param config: main config dictionary
+        :param name: backend section name
+        :return: one of ``IMAGE_VARIANTS``
+        """
+
+        section = config.get(name, {})
+
+        variant = section.get('variant', FULL)
+        if variant not in IMAGE_VARIANTS:
+            log.error('Unknown image variant {} in [{}], using {}'.format(variant, name, FULL))
+            variant = FULL
+            section['variant'] = variant
+
+        return variant
+
+    @staticmethod
+    def variants(config):
         """
-        Entry point for Executor. Deletes the ImageCapture on completion.
+        The image variants the enabled backends upload. Thumbnails for backends that are behind aren't included,
+        see :func:`make_thumbnail`.
 
         :param config: main config dictionary
+        :return: set of ``IMAGE_VARIANTS``
+        """
+
+        enabled = [name for name in BACKENDS if config.get(name, None) is not None]
+
+        return set(ImageStorage.backend_variant(config, name) for name in enabled)
+
+    @staticmethod
+    def save_to(config, name, img_capture: ImageCapture, variant=None):
+        """
+        Saves to one backend.
+
+        :param config: main config dictionary
+        :param name: ``local``, ``s3``, or ``gdrive``
         :param img_capture: ``ImageCapture`` object.
-        :return:
+        :param variant: the image to save, None for the backend's ``variant``
+        :return: True on success
         """
 
-        localstorage = config.get('local', None)
-        if localstorage is not None:
+        if name == 'local':
             log.info('Saving to local filesystem {}'.format(img_capture.base_filename))
-            # local_save(fs_path, img_capture)
-            fs = LocalStorage(config)
-            fs.upload(img_capture)
-
-        s3_config = config.get('s3', None)
-        if s3_config is not None:
-            s3 = S3Storage(config)
-            if not s3.upload(img_capture):
+            fs = ImageStorage.client(config, 'local')
+            return fs.upload_jpeg(img_capture.jpg(variant or fs.variant), img_capture.capture_dt, img_capture.cam_id)
+
+        if name == 's3':
+            s3 = ImageStorage.client(config, 's3')
+            if not s3.upload(img_capture, variant):
                 log.error('Error uploading to AWS')
+                return False
+            return True
+
+        if name == 'gdrive':
+            log.info('Saving to Google Drive {}'.format(config['gdrive']['folder_name']))
+            gstorage = ImageStorage.client(config, 'gdrive')
+            if gstorage is None:
+                return False
+            return gstorage.upload_file(img_capture, variant)
+
+        raise ValueError('Unknown storage backend {}'.format(name))
+
+    @staticmethod
+    def save(config, img_capture: ImageCapture):
+        """
+        Saves to each of the backends, one after the other. Releases the ImageCapture on completion.
+
+        :param config: main config dictionary
+        :param img_capture: ``ImageCapture`` object.
+        :return:
+        """
+
+        for name in BACKENDS:
+            if config.get(name, None) is not None:
+                ImageStorage.save_to(config, name, img_capture)
+
+        img_capture.release()
+
+        return True
+
+    def _make_room(self, name):
+        """
+        Applies the backend's drop policy, if it's at its limit. Must hold ``_lock``.
+
+        :param name: backend name
+        :return: tuple of (accepted, variant). variant is None for the backend's usual one.
+        """
+
+        queue = self.in_flight[name]
+        limit = self.limits[name]
+        policy = self.policies[name]
+
+        if len(queue) < limit:
+            return True, None
+
+        if policy == DROP_OLDEST:
+            for fut in list(queue):
+                # only works if it hasn't started. The done callback takes it out of the queue.
+                if fut.cancel():
+                    self._stats[name]['dropped'] += 1
+                    log.warning('{} is behind, dropped its oldest queued image'.format(name))
+                    return True, None
 
-        gdrive_settings = config.get('gdrive', None)
-        creds_folder = config.get('credential_folder', '.')
+        if policy == DROP_THUMBNAIL and len(queue) < limit * 2:
+            self._stats[name]['degraded'] += 1
+            log.warning('{} is behind, sending a thumbnail'.format(name))
+            return True, THUMB
 
-        if gdrive_settings is not None:
-            creds_file = abspath(join(creds_folder, 'google_auth.json'))
-            folder_name = gdrive_settings['folder_name']
-            client_id = gdrive_settings['client_id']
-            client_secret = gdrive_settings['client_secret']
+        self._stats[name]['dropped'] += 1
+        log.warning('{} is behind, skipping the new image'.format(name))
 
-            log.info('Saving to Google Drive {}'.format(folder_name))
-            gauth = GDriveAuth.init_gauth(client_id, client_secret, creds_file)
-            gstorage = GDriveStorage(gauth, folder_name)
-            gstorage.upload_file(img_capture)
+        return False, None
 
-        del img_capture
+    def make_thumbnail(self, img_capture: ImageCapture):
+        """
+        Adds the ``THUMB`` image, shrunk from one that's already encoded. The clean image is gone by the time
+        the images are saved, and a thumbnail is rarely needed, so it isn't made up front.
+
+        :param img_capture: ``ImageCapture`` object.
+        :return: True if the capture has a thumbnail
+        """
+
+        if img_capture.jpg(THUMB) is not None:
+            return True
+
+        source = None
+        for variant in [FULL, TIMESTAMP, CLEAN]:
+            source = img_capture.jpg(variant)
+            if source is not None:
+                break
+
+        if source is None:
+            log.error('No image to make a thumbnail from for {}'.format(img_capture.base_filename))
+            return False
+
+        if self._encoder is None:
+            self._encoder = JpegEncoder(self.config)
+
+        cv_image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+        jpg = None if cv_image is None else self._encoder.encode(cv_image, THUMBNAIL)
+        if jpg is None:
+            log.error('Failed to make a thumbnail for {}'.format(img_capture.base_filename))
+            return False
+
+        img_capture.jpgs[THUMB] = jpg.tobytes()
 
         return True
 
+    def _job_done(self, name, task: CaptureTask, fut):
+        with self._lock:
+            self.in_flight[name].remove(fut)
+
+            stats = self._stats[name]
+            if not fut.cancelled():
+                if fut.exception() is not None:
+                    log.error('Saving to {} failed: {}'.format(name, fut.exception()))
+                else:
+                    waited = fut.result()
+                    stats['completed'] += 1
+                    stats['wait_total'] += waited
+                    stats['wait_max'] = max(stats['wait_max'], waited)
+
+            self._task_refs[task.shm_name] -= 1
+            last = self._task_refs[task.shm_name] == 0
+            if last:
+                del self._task_refs[task.shm_name]
+
+        # the images can go, everyone is done with them
+        if last:
+            task.unlink()
+
     def save_files(self, img_capture: ImageCapture):
         """
-        Launches the processes to save files.
+        Queues the image for each backend, subject to the backend's limit and drop policy.
 
         :param img_capture: ``ImageCapture`` object.
         :return:
         """
 
-        # img_capture.full_image = None
-        # img_capture.clean_image = None
-        # img_capture.ts_image = None
+        jobs = []
 
-        lock = self.process_limit.acquire(False)
-        if lock:
+        with self._lock:
+            for name in self.backends:
+                accepted, variant = self._make_room(name)
+                if accepted:
+                    jobs.append((name, variant))
 
-            self._pcount = self._pcount + 1
-            log.info('pcount: {}'.format(self._pcount))
+        # only made when a backend is behind
+        if any(variant == THUMB for name, variant in jobs) and not self.make_thumbnail(img_capture):
+            with self._lock:
+                for name, variant in jobs:
+                    if variant == THUMB:
+                        self._stats[name]['degraded'] -= 1
+                        self._stats[name]['dropped'] += 1
 
-            fut = ImageStorage.executor.submit(ImageStorage.save, self.config, img_capture)
-            self.futures.append(fut)
-            _, waiting = wait(self.futures, .1)
-            self.futures = list(waiting)
+            jobs = [(name, variant) for name, variant in jobs if variant != THUMB]
 
-            self.process_limit.release()
-            self._pcount = self._pcount - 1
-            log.info('pcount: {}'.format(self._pcount))
-        else:
-            log.warning('Too many images queued, skipping {}'.format(img_capture.base_filename))
+        if not jobs:
+            log.warning('All backends are behind, skipping {}'.format(img_capture.base_filename))
+            return
+
+        # only a handle to the images is sent, they're released when the last job is done
+        task = CaptureTask(img_capture)
+
+        with self._lock:
+            self._task_refs[task.shm_name] = len(jobs)
+
+            for name, variant in jobs:
+                fut = self.executor.submit(ImageStorage.save_task, task, name, variant, time())
+                self.in_flight[name].append(fut)
+                self._stats[name]['submitted'] += 1
+
+                fut.add_done_callback(partial(self._job_done, name, task))
+
+            self._saved += 1
+            if self.stats_interval > 0 and self._saved % self.stats_interval == 0:
+                self.log_stats()
 
         return
+
+    def stats(self):
+        """
+        Per backend counters.
+
+        :return: dict of backend name to a dict of ``depth`` (queued or running), ``submitted``, ``completed``,
+            ``dropped``, ``degraded``, ``wait_avg``, and ``wait_max``, in seconds
+        """
+
+        ret = {}
+
+        with self._lock:
+            for name in self.backends:
+                stats = self._stats[name]
+                ret[name] = {
+                    'depth': len(self.in_flight[name]),
+                    'submitted': stats['submitted'],
+                    'completed': stats['completed'],
+                    'dropped': stats['dropped'],
+                    'degraded': stats['degraded'],
+                    'wait_avg': stats['wait_total'] / max(1, stats['completed']),
+                    'wait_max': stats['wait_max']
+                }
+
+        return ret
+
+    def log_stats(self):
+        for name, stats in self.stats().items():
+            log.info('{}: {} queued, {} saved, {} dropped, {} thumbnails, waited {:.2f}s on average, {:.2f}s max'.format(
+                name, stats['depth'], stats['completed'], stats['dropped'], stats['degraded'],
+                stats['wait_avg'], stats['wait_max']))
+
+    def shutdown(self):
+        """
+        Waits for the queued images to be saved, and stops the workers.
+        """
+
+        self.executor.shutdown()
+        self.log_stats()
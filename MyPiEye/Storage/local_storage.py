@@ -3,8 +3,7 @@ from os.path import basename, exists, split
 from os import makedirs, environ
 from io import BytesIO
 
-import cv2
-
+from MyPiEye.encoder import JpegEncoder
 from MyPiEye.CLI import get_self_config_value
 
 import multiprocessing
@@ -22,9 +21,29 @@ class LocalStorage(object):
         self.static_web_dir = get_self_config_value(self, 'static_web_dir', 'LOCAL_STATIC')
         self.filename_format = get_self_config_value(self, 'filename_format', 'LOCAL_FMT')
 
+        self.encoder = JpegEncoder(config)
+
+        # which motion image to save, see ``IMAGE_VARIANTS``
+        self.variant = self.self_config.get('variant', 'full')
+
     def upload(self, cv2_imgbuf, dt_stamp, camera_id):
-        log.info('Uploading to file system {}')
+        jpg = self.encoder.encode(cv2_imgbuf)
+        if jpg is None:
+            return False
+
+        return self.upload_jpeg(jpg, dt_stamp, camera_id)
+
+    def upload_jpeg(self, jpg, dt_stamp, camera_id):
+        """
+        Writes an already encoded image.
+
+        :param jpg: the JPEG, as a uint8 array or bytes
+        :param dt_stamp: capture datetime
+        :param camera_id: camera id, the top level directory
+        :return: True on success
+        """
         filename = '{}/{}.jpg'.format(camera_id, dt_stamp.strftime(self.filename_format))
+        log.info('Uploading to file system {}'.format(filename))
 
         fdir, fname = split(filename)
 
@@ -32,9 +51,11 @@ class LocalStorage(object):
             log.info('Creating directory {}'.format(fdir))
             makedirs(fdir)
 
-        ok = cv2.imwrite(filename)
-        if not ok:
-            log.error('Error writing file')
+        try:
+            with open(filename, 'wb') as f:
+                f.write(jpg)
+        except OSError as e:
+            log.error('Error writing file: {}'.format(e))
             return False
 
         return True
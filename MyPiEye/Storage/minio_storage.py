@@ -1,12 +1,13 @@
 from datetime import datetime, timedelta
 from os.path import basename
+from os import fstat
 import logging
 from functools import partial
-from io import BytesIO
 
 from minio import Minio
-import cv2
 
+from MyPiEye.encoder import JpegEncoder
+from .transfer import TransferSettings, BufferReader
 from MyPiEye.CLI import get_self_config_value, get_config_value
 
 log = logging.getLogger(__name__)
@@ -45,6 +46,11 @@ class MinioStorage(object):
         if self.filename_format is None:
             self.filename_format = '%Y%m%d/%H%M%S.%f'
 
+        self.encoder = JpegEncoder(global_config)
+
+        # multipart thresholds and such, see ``TransferSettings``
+        self.transfer = TransferSettings(global_config, 'minio')
+
         self.mclient = Minio(
             self.url,
             access_key=self.access_key,
@@ -72,6 +78,12 @@ class MinioStorage(object):
 
         return ret
 
+    def connect(self):
+        """
+        The client connects on demand, this just checks the settings.
+        """
+        return self.check()
+
     def configure(self):
 
         exists = self.mclient.bucket_exists(self.bucket_name)
@@ -82,13 +94,22 @@ class MinioStorage(object):
 
     def upload(self, cv2_imgbuf, dt_stamp, camera_id):
 
-        (ok, jpg) = cv2.imencode('.jpg', cv2_imgbuf)
+        jpg = self.encoder.encode(cv2_imgbuf)
 
-        if not ok:
-            log.error('Error encoding file to jpeg')
+        if jpg is None:
             return False
 
-        bio = BytesIO(jpg)
+        return self.upload_jpeg(jpg, dt_stamp, camera_id)
+
+    def upload_jpeg(self, jpg, dt_stamp, camera_id):
+        """
+        Uploads an already encoded image.
+
+        :param jpg: the JPEG, as a uint8 array or bytes
+        :param dt_stamp: capture datetime
+        :param camera_id: camera id, the top level "folder"
+        :return: True on success
+        """
 
         filename = '{}/{}.jpg'.format(camera_id, dt_stamp.strftime(self.filename_format))
         dtstr = dt_stamp.isoformat()
@@ -96,16 +117,20 @@ class MinioStorage(object):
         log.info('Uploading to minio {}'.format(filename))
         print('uploading to minio')
 
+        # read straight from the encoded buffer, no copy
+        reader = BufferReader(jpg)
+
         self.mclient.put_object(
             self.bucket_name,
             filename,
-            bio,
-            len(jpg),
+            reader,
+            len(reader),
             content_type='image/jpg',
             metadata={
                 'timestamp': dtstr,
                 'camera_id': camera_id
-            }
+            },
+            part_size=self.transfer.minio_part_size(len(reader))
         )
 
         log.info('Upload complete {}'.format(filename))
@@ -115,6 +140,31 @@ class MinioStorage(object):
         return True
 
 
+    def upload_file(self, object_name, path):
+        """
+        Uploads a file, in parts if it's large.
+
+        :param object_name: where to put it in the bucket
+        :param path: the local file
+        :return: True on success
+        """
+
+        log.info('Uploading {} to minio {}'.format(path, object_name))
+
+        with open(path, 'rb') as f:
+            length = fstat(f.fileno()).st_size
+
+            self.mclient.put_object(
+                self.bucket_name,
+                object_name,
+                f,
+                length,
+                content_type='image/jpg',
+                part_size=self.transfer.minio_part_size(length)
+            )
+
+        return True
+
     def download_img(self, dt_stamp: datetime, camera_id):
 
         path = '{}/{}.jpg'.format(camera_id, dt_stamp.strftime(self.filename_format))
@@ -61,7 +61,7 @@ class S3Archive(object):
         for f in older_files:
             log.info('downloading {}'.format(f['remote']))
 
-            self.s3.download_image(f['remote'])
+            self.s3.download_image(f['remote'], self.backup_dir)
 
             obj = '{}/{}/{}'.format(
                 f['cam_id'],
@@ -70,7 +70,7 @@ class S3Archive(object):
             )
 
             log.info('uploading {}'.format(f['filename']))
-            self.mc.upload(obj, '{}/{}'.format(self.backup_dir, f['filename']))
+            self.mc.upload_file(obj, '{}/{}'.format(self.backup_dir, f['filename']))
 
             if self.remove_local:
                 log.debug('removing local file {}'.format(f['filename']))
@@ -1,4 +1,4 @@
-from os.path import basename, dirname
+from os.path import dirname, basename, join
 from datetime import datetime
 from dateutil import tz
 
@@ -7,6 +7,9 @@ import multiprocessing
 import logging
 import boto3
 
+from .db_writer import DynamoDbWriter
+from .transfer import TransferSettings, BufferReader
+
 boto3.set_stream_logger('', logging.INFO)
 
 log = multiprocessing.get_logger()
@@ -30,6 +33,9 @@ class S3Storage(object):
         self.bucket_name = self.s3_config.get('bucket_name', None)
         self.region = self.s3_config.get('aws_region')
 
+        # which image to upload, see ``IMAGE_VARIANTS``
+        self.variant = self.s3_config.get('variant', 'full')
+
         # if this camera has a different prefix, use it
         self.prefix = self.s3_config.get('prefix', None)
         if self.prefix is None:
@@ -41,6 +47,9 @@ class S3Storage(object):
                 log.info('prefix is not found. Using camera_id {}'.format(camera_id))
                 self.prefix = camera_id
 
+        # multipart thresholds and such, see ``TransferSettings``
+        self.transfer = TransferSettings(config, 's3')
+
         # dynamodb settings
         self.camera_table_name = self.s3_config.get('camera_table_name', None)
         self.image_table_name = self.s3_config.get('image_table_name', None)
@@ -53,6 +62,9 @@ class S3Storage(object):
         self.camera_table = None
         self.image_table = None
 
+        # batches the table writes, set up in ``connect``
+        self.db_writer = None
+
     def connect(self):
 
         log.info('Connecting to AWS')
@@ -79,6 +91,8 @@ class S3Storage(object):
         if self.image_table_name is not None:
             self.image_table = db.Table(self.image_table_name)
 
+        self.db_writer = DynamoDbWriter.from_config(self.s3_config, self.image_table, self.camera_table)
+
         log.info('Connection to AWS complete')
 
         return True
@@ -89,15 +103,17 @@ class S3Storage(object):
             log.info('Db not enabled. Skipping.')
             return True
 
-        log.info('Updating db for {}'.format(upload_path))
+        log.info('Queueing db update for {}'.format(upload_path))
 
         if self.session is None and not self.connect():
             log.error('Unable to connect to AWS')
             return False
 
+        # written in batches, see ``DynamoDbWriter``
         if self.camera_table is not None:
-            self.camera_table.put_item(
-                Item={
+            self.db_writer.update_camera(
+                self.prefix,
+                {
                     'cam_id': self.prefix,
                     'last_update_utc': datetime.utcnow().strftime('%Y/%m/%d %H:%M:%S'),
                     'last_update': datetime.now(self.local_tz).strftime('%Y/%m/%d %H:%M:%S'),
@@ -106,8 +122,8 @@ class S3Storage(object):
             )
 
         if self.image_table is not None:
-            self.image_table.put_item(
-                Item={
+            self.db_writer.add_image(
+                {
                     's3key': upload_path,
                     'path': dirname(upload_path),
                     'bucket': self.bucket_name,
@@ -115,34 +131,103 @@ class S3Storage(object):
                 }
             )
 
-        log.info('Db updated for {}'.format(upload_path))
         return True
 
-    def upload(self, img_capture):
+    def close(self):
+        """
+        Writes any db rows still waiting.
+        """
+
+        if self.db_writer is not None:
+            self.db_writer.close()
+
+    def upload(self, img_capture, variant=None):
+        """
+        Uploads one of the capture's images, and updates the db.
+
+        :param img_capture: ``ImageCapture``
+        :param variant: which image, None for ``variant`` from the config
+        :return: True on success
+        """
+
+        if variant is None:
+            variant = self.variant
 
-        log.info('Uploading {} to S3 prefix {}'.format(img_capture.full_fname, self.prefix))
+        bname = img_capture.filename(variant)
+        jpg = img_capture.jpg(variant)
+
+        if jpg is None:
+            log.error('No {} image for {}'.format(variant, bname))
+            return False
+
+        log.info('Uploading {} to S3 prefix {}'.format(bname, self.prefix))
 
         if self.session is None and not self.connect():
             log.error('Unable to connect to AWS')
             return None
 
         subdir = img_capture.subdir
-        box_name = img_capture.full_fname
         capture_dt = img_capture.capture_dt
 
-        bname = basename(box_name)
-
         upload_path = '{}/{}'.format(subdir, bname)
         if self.prefix != '':
             upload_path = '{}/{}/{}'.format(self.prefix, subdir, bname)
 
-        self.bucket.upload_file(Filename=box_name, Key=upload_path, ExtraArgs={'ContentType': 'image/jpeg'})
+        # straight from memory, in parts if it's large
+        self.bucket.upload_fileobj(
+            BufferReader(jpg),
+            Key=upload_path,
+            ExtraArgs={'ContentType': 'image/jpeg'},
+            Config=self.transfer.s3_config())
 
         log.info('Upload to S3 complete: {}'.format(upload_path))
 
         self.update_db(upload_path, capture_dt)
 
-        log.info('Upload complete {}'.format(box_name))
+        log.info('Upload complete {}'.format(bname))
+        return True
+
+    def list_cam_images(self):
+        """
+        Everything under this camera's prefix.
+
+        :return: list of dicts with ``Key``, ``Size``, and ``LastModified``
+        """
+
+        if self.session is None and not self.connect():
+            log.error('Unable to connect to AWS')
+            return []
+
+        ret = []
+        for obj in self.bucket.objects.filter(Prefix='{}/'.format(self.prefix)):
+            ret.append({'Key': obj.key, 'Size': obj.size, 'LastModified': obj.last_modified})
+
+        return ret
+
+    def download_image(self, key, folder='.'):
+        """
+        Downloads an object, in parts if it's large.
+
+        :param key: the object key
+        :param folder: where to save it, as the key's base name
+        :return: the local path
+        """
+
+        if self.session is None and not self.connect():
+            log.error('Unable to connect to AWS')
+            return None
+
+        path = join(folder, basename(key))
+        self.bucket.download_file(key, path, Config=self.transfer.s3_config())
+
+        return path
+
+    def delete_image(self, key):
+        if self.session is None and not self.connect():
+            log.error('Unable to connect to AWS')
+            return False
+
+        self.bucket.Object(key).delete()
         return True
 
     def check(self):
@@ -0,0 +1,155 @@
+import io
+
+import multiprocessing
+
+log = multiprocessing.get_logger()
+
+MB = 1024 * 1024
+
+# multipart_threshold: objects this size or larger are uploaded in parts, in bytes
+# part_size: the size of each part, in bytes. S3 requires at least 5MB.
+# part_concurrency: parts uploaded at once
+DEFAULT_TRANSFER = {
+    'multipart_threshold': 8 * MB,
+    'part_size': 8 * MB,
+    'part_concurrency': 4
+}
+
+# S3's smallest part, except the last one
+MIN_PART_SIZE = 5 * MB
+
+
+class TransferSettings(object):
+    """
+    Upload settings shared by the S3 and minio backends.
+
+    Read from the backend's section, then ``[transfer]``, then ``DEFAULT_TRANSFER``.
+    """
+
+    def __init__(self, config, section_name=None):
+        """
+        :param config: the global config
+        :param section_name: the backend's section, for its overrides
+        """
+
+        sections = [config.get('transfer', {})]
+        if section_name is not None:
+            sections.insert(0, config.get(section_name, {}))
+
+        def setting(key):
+            for section in sections:
+                value = section.get(key, None)
+                if value not in [None, '']:
+                    return int(value)
+            return DEFAULT_TRANSFER[key]
+
+        self.multipart_threshold = setting('multipart_threshold')
+        self.part_concurrency = max(1, setting('part_concurrency'))
+
+        self.part_size = setting('part_size')
+        if self.part_size < MIN_PART_SIZE:
+            log.warning('part_size {} is too small, using {}'.format(self.part_size, MIN_PART_SIZE))
+            self.part_size = MIN_PART_SIZE
+
+    def s3_config(self):
+        """
+        The settings for boto3's managed transfers.
+
+        :return: ``boto3.s3.transfer.TransferConfig``
+        """
+
+        # only needed when uploading
+        from boto3.s3.transfer import TransferConfig
+
+        return TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.part_size,
+            max_concurrency=self.part_concurrency,
+            use_threads=self.part_concurrency > 1)
+
+    def minio_part_size(self, length):
+        """
+        The minio client uploads anything larger than its part size in parts,
+        so the part size is the threshold for small objects.
+
+        :param length: the object size, in bytes
+        :return: part size for ``put_object``
+        """
+
+        if length < self.multipart_threshold:
+            return max(self.part_size, length)
+
+        return self.part_size
+
+
+class BufferReader(io.RawIOBase):
+    """
+    A read-only file over an in-memory buffer, e.g. an encoded JPEG, without copying it first like ``BytesIO`` does.
+
+    Seekable, so the S3 transfer manager can read parts from it, and retry them.
+    """
+
+    def __init__(self, buf):
+        """
+        :param buf: anything supporting the buffer protocol: bytes, a numpy array, a shared memory view
+        """
+
+        super(BufferReader, self).__init__()
+
+        self._view = memoryview(buf).cast('B')
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError('Invalid whence {}'.format(whence))
+
+        if pos < 0:
+            raise ValueError('Negative seek position {}'.format(pos))
+
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, b):
+        data = self._view[self._pos:self._pos + len(b)]
+        count = len(data)
+
+        memoryview(b).cast('B')[:count] = data
+        self._pos += count
+
+        return count
+
+    def read(self, size=-1):
+        end = len(self._view)
+        if size is not None and size >= 0:
+            end = min(end, self._pos + size)
+
+        data = self._view[self._pos:end].tobytes()
+        self._pos += len(data)
+
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super(BufferReader, self).close()
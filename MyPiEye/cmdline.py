@@ -2,6 +2,7 @@ import logging
 import click
 import sys
 import platform
+from datetime import datetime
 
 from functools import partial
 
@@ -12,6 +13,7 @@ from MyPiEye.configure_app import ConfigureApp
 from MyPiEye.multi.supervisor import Supervisor
 
 import MyPiEye.CeleryTasks
+from MyPiEye.CeleryTasks.capture_query import capture_query, HOUR, DAY
 
 # log = logging.getLogger('mypieye')
 log = logging.getLogger(__name__)
@@ -145,6 +147,65 @@ def worker(ctx, appargs):
     MyPiEye.CeleryTasks.celery_app.worker_main(args)
 
 
+@mypieye.command()
+@click.argument('camera_id', required=False)
+@click.option('--start', type=click.DateTime(), default=None, help='local time, e.g. "2019-09-07 18:00"')
+@click.option('--end', type=click.DateTime(), default=None, help='local time, not included')
+@click.option('--latest', type=int, default=None, help='the newest N captures')
+@click.option('--counts', type=click.Choice([HOUR, DAY]), default=None, help='captures per hour or day')
+@click.option('--page', type=int, default=1, help='page of results, from 1')
+@click.option('--page-size', type=int, default=100, help='results per page')
+@click.pass_context
+def captures(ctx, camera_id, start, end, latest, counts, page, page_size):
+    """
+    Lists captures from the capture index. Without a camera id, lists the cameras.
+
+    ```
+    python -m MyPiEye captures server/cam0 --start "2019-09-07" --end "2019-09-08"
+    python -m MyPiEye captures server/cam0 --latest 10
+    python -m MyPiEye captures server/cam0 --start "2019-09-01" --counts day
+    ```
+    """
+
+    query = capture_query(ctx.obj)
+
+    if camera_id is None:
+        for cam in query.cameras():
+            print(cam)
+        return
+
+    if start is not None:
+        start = query.to_utc(start)
+    if end is not None:
+        end = query.to_utc(end)
+
+    offset = (max(1, page) - 1) * page_size
+
+    if counts is not None:
+        if start is None:
+            log.critical('--counts needs --start')
+            sys.exit(-1)
+
+        if end is None:
+            end = datetime.utcnow()
+
+        for bucket, count in query.counts(camera_id, start, end, counts):
+            print('{}  {}'.format(query.local_time(bucket).isoformat(), count))
+        return
+
+    if latest is not None:
+        found = query.latest(camera_id, min(latest, page_size), offset)
+    else:
+        found = query.between(camera_id, start, end, offset, page_size)
+        total = query.count(camera_id, start, end)
+        pages = max(1, (total + page_size - 1) // page_size)
+        log.info('{} captures, page {} of {}'.format(total, page, pages))
+
+    for capture in found:
+        print('{}  {}'.format(query.local_time(capture['utc_time']).isoformat(timespec='microseconds'),
+                              capture['name']))
+
+
 @mypieye.command()
 @click.pass_context
 def run(ctx, **cli_flags):
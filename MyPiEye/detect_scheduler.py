@@ -0,0 +1,186 @@
+import multiprocessing
+from time import monotonic
+
+log = multiprocessing.get_logger()
+
+
+class DetectScheduler(object):
+    """
+    Decides how often frames are checked for motion.
+
+    While the scene is quiet, frames are checked every ``idle_interval`` seconds. Once motion is seen,
+    every frame the camera produces (or one every ``active_interval`` seconds) is checked,
+    until there's been nothing for ``hold_time`` seconds.
+
+    If detection takes longer than the interval, the interval is stretched to match, up to ``max_interval``,
+    and measured from the end of each check rather than the start, so a slow box gets real idle time instead
+    of queueing up work. It recovers as detection speeds up. When checking every frame, the interval is the
+    camera's frame period, learned from the frames passed to :func:`frame`.
+
+    Settings are in the ``[motion]`` section.
+    """
+
+    def __init__(self, config):
+        """
+        :param config: the global config
+        """
+
+        motion_config = config.get('motion', {})
+
+        # seconds between checks while nothing is happening
+        self.idle_interval = float(motion_config.get('idle_interval', '0.5'))
+
+        # seconds between checks after motion, 0 for every frame
+        self.active_interval = float(motion_config.get('active_interval', '0'))
+
+        # how long to stay at the active rate after the last motion
+        self.hold_time = float(motion_config.get('hold_time', '10'))
+
+        # the longest the interval will be stretched to when detection is slow
+        self.max_interval = float(motion_config.get('max_interval', '5'))
+
+        # how quickly the latency average follows changes, 0 to 1
+        self.latency_weight = 0.2
+
+        # running average of detection latency, in seconds
+        self.latency = 0.0
+
+        # running average of the time between camera frames, None until there have been two
+        self.frame_period = None
+
+        # (seq, capture datetime) of the last frame seen
+        self._last_frame = None
+
+        self._last_start = None
+        self._last_finish = None
+        self._last_motion = None
+        self._backing_off = False
+
+    def active(self, now=None):
+        """
+        Whether motion was seen in the last ``hold_time`` seconds.
+
+        :param now: monotonic time, for testing
+        :return: True if checking at the active rate
+        """
+
+        if self._last_motion is None:
+            return False
+
+        if now is None:
+            now = monotonic()
+
+        return now - self._last_motion < self.hold_time
+
+    def interval(self, now=None):
+        """
+        The time between checks right now, including any back-off.
+
+        :param now: monotonic time, for testing
+        :return: seconds
+        """
+
+        target = self.active_interval if self.active(now) else self.idle_interval
+
+        # every frame, so detection has to keep up with the camera
+        every_frame = target <= 0
+        if every_frame and self.frame_period is not None:
+            target = self.frame_period
+
+        backoff = target > 0 and self.latency > target
+        if backoff != self._backing_off:
+            if backoff:
+                log.warning('Motion detection is taking {:.3f}s, more than the {:.3f}s interval. Backing off.'.format(
+                    self.latency, target))
+            else:
+                log.info('Motion detection is keeping up again')
+            self._backing_off = backoff
+
+        if backoff:
+            return min(self.latency, max(target, self.max_interval))
+
+        if every_frame:
+            return 0.0
+
+        return target
+
+    def delay(self, now=None):
+        """
+        How long to wait before the next check.
+
+        :param now: monotonic time, for testing
+        :return: seconds, 0 if it's time now
+        """
+
+        if self._last_start is None:
+            return 0.0
+
+        if now is None:
+            now = monotonic()
+
+        interval = self.interval(now)
+
+        # from the start, the check itself would use up the whole wait
+        if self._backing_off and self._last_finish is not None:
+            return max(0.0, self._last_finish + interval - now)
+
+        return max(0.0, self._last_start + interval - now)
+
+    def frame(self, seq, captured):
+        """
+        Call with each frame taken from the camera, so the frame period is known.
+
+        :param seq: the frame's sequence number. Frames skipped in between are accounted for.
+        :param captured: capture datetime
+        :return: None
+        """
+
+        last = self._last_frame
+        self._last_frame = (seq, captured)
+
+        if last is None or seq <= last[0] or captured <= last[1]:
+            return
+
+        period = (captured - last[1]).total_seconds() / (seq - last[0])
+
+        if self.frame_period is None:
+            self.frame_period = period
+        else:
+            self.frame_period += (period - self.frame_period) * self.latency_weight
+
+    def start(self, now=None):
+        """
+        Call just before checking a frame.
+
+        :param now: monotonic time, for testing
+        :return: the start time, to pass to :func:`finish`
+        """
+
+        if now is None:
+            now = monotonic()
+
+        self._last_start = now
+
+        return now
+
+    def finish(self, started, motion, now=None):
+        """
+        Call once a frame has been checked.
+
+        :param started: the value returned by :func:`start`
+        :param motion: True if motion was found
+        :param now: monotonic time, for testing
+        :return: None
+        """
+
+        if now is None:
+            now = monotonic()
+
+        elapsed = now - started
+        self.latency += (elapsed - self.latency) * self.latency_weight
+        self._last_finish = now
+
+        if motion:
+            if not self.active(now):
+                log.info('Motion detected, checking at the active rate for {}s'.format(self.hold_time))
+            self._last_motion = now
@@ -0,0 +1,280 @@
+import multiprocessing
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+# optional, libjpeg-turbo is faster than OpenCV's encoder
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+log = multiprocessing.get_logger()
+
+# full quality, for the permanent copy
+ARCHIVE = 'archive'
+
+# small, for listings
+THUMBNAIL = 'thumbnail'
+
+# low bitrate, for watching live
+PREVIEW = 'preview'
+
+# quality: 0 - 100
+# progressive: progressive JPEG, larger to encode but renders sooner
+# optimize: optimized Huffman tables, a little smaller, a little slower
+# subsampling: chroma subsampling, 444 (none), 422, or 420
+# max_width: shrunk to this width, 0 to keep the full size
+DEFAULT_PROFILES = {
+    ARCHIVE: {
+        'quality': 95,
+        'progressive': False,
+        'optimize': True,
+        'subsampling': '444',
+        'max_width': 0
+    },
+    THUMBNAIL: {
+        'quality': 75,
+        'progressive': False,
+        'optimize': True,
+        'subsampling': '420',
+        'max_width': 320
+    },
+    PREVIEW: {
+        'quality': 60,
+        'progressive': True,
+        'optimize': False,
+        'subsampling': '420',
+        'max_width': 640
+    }
+}
+
+_CV_SAMPLING = {
+    '444': 'IMWRITE_JPEG_SAMPLING_FACTOR_444',
+    '422': 'IMWRITE_JPEG_SAMPLING_FACTOR_422',
+    '420': 'IMWRITE_JPEG_SAMPLING_FACTOR_420'
+}
+
+_TJ_SAMPLING = {
+    '444': 'TJSAMP_444',
+    '422': 'TJSAMP_422',
+    '420': 'TJSAMP_420'
+}
+
+
+class JpegEncoder(object):
+    """
+    Encodes CV images to JPEG, using named profiles.
+
+    Profiles are set in the ``[encoder]`` section, as ``<profile>_<setting>``, e.g. ``thumbnail_quality = 70``.
+    See ``DEFAULT_PROFILES`` for the settings. New profiles can be added the same way.
+
+    ``engine`` is ``opencv``, ``turbojpeg``, or ``auto``. ``auto`` uses libjpeg-turbo through PyTurboJPEG
+    when it's installed, OpenCV otherwise.
+
+    Each encode is timed. The totals per profile are in ``stats``.
+    """
+
+    def __init__(self, config):
+        """
+        :param config: the global config
+        """
+
+        enc_config = config.get('encoder', {})
+
+        self.engine = enc_config.get('engine', 'auto')
+        if self.engine not in ['auto', 'opencv', 'turbojpeg']:
+            log.warning('Unknown JPEG engine {}, using auto'.format(self.engine))
+            self.engine = 'auto'
+
+        names = set(DEFAULT_PROFILES.keys())
+        for key in enc_config.keys():
+            if key.endswith('_quality'):
+                names.add(key[:-len('_quality')])
+
+        self.profiles = {}
+        for name in names:
+            self.profiles[name] = JpegEncoder.read_profile(enc_config, name)
+
+        # per profile: encodes, bytes out, and seconds spent
+        self.stats = {}
+
+        # log the stats every this many encodes of a profile, 0 to never
+        self.stats_interval = int(enc_config.get('stats_interval', '500'))
+
+        # loaded when first used, it can't be pickled
+        self._turbo = None
+        self._turbo_failed = self.engine == 'opencv'
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_turbo'] = None
+        return state
+
+    @staticmethod
+    def read_profile(enc_config, name):
+        """
+        Reads a profile's settings, falling back to ``DEFAULT_PROFILES``, then the archive settings.
+
+        :param enc_config: the ``[encoder]`` section
+        :param name: the profile name
+        :return: dict of settings
+        """
+
+        profile = dict(DEFAULT_PROFILES.get(name, DEFAULT_PROFILES[ARCHIVE]))
+
+        def setting(key, default):
+            return enc_config.get('{}_{}'.format(name, key), default)
+
+        profile['quality'] = int(setting('quality', profile['quality']))
+        profile['progressive'] = setting('progressive', profile['progressive']) in [True, 'True']
+        profile['optimize'] = setting('optimize', profile['optimize']) in [True, 'True']
+        profile['max_width'] = int(setting('max_width', profile['max_width']))
+
+        subsampling = str(setting('subsampling', profile['subsampling']))
+        if subsampling not in _CV_SAMPLING:
+            log.warning('Unknown chroma subsampling {} for {}, using 420'.format(subsampling, name))
+            subsampling = '420'
+        profile['subsampling'] = subsampling
+
+        return profile
+
+    def _turbojpeg(self):
+        if self._turbo is None and not self._turbo_failed:
+            try:
+                if turbojpeg is None:
+                    raise RuntimeError('PyTurboJPEG is not installed')
+
+                # finds the library
+                self._turbo = turbojpeg.TurboJPEG()
+                log.info('Using libjpeg-turbo for JPEG encoding')
+            except (OSError, RuntimeError) as e:
+                if self.engine == 'turbojpeg':
+                    log.warning('libjpeg-turbo is not available, using OpenCV: {}'.format(e))
+                self._turbo_failed = True
+
+        return self._turbo
+
+    @staticmethod
+    def cv_params(profile):
+        """
+        The ``cv2.imencode`` parameters for a profile.
+
+        :param profile: dict of settings
+        :return: list of parameters
+        """
+
+        params = [
+            cv2.IMWRITE_JPEG_QUALITY, profile['quality'],
+            cv2.IMWRITE_JPEG_PROGRESSIVE, int(profile['progressive']),
+            cv2.IMWRITE_JPEG_OPTIMIZE, int(profile['optimize'])
+        ]
+
+        # only in newer versions of OpenCV
+        sampling = getattr(cv2, _CV_SAMPLING[profile['subsampling']], None)
+        if sampling is not None:
+            params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, sampling]
+
+        return params
+
+    @staticmethod
+    def shrink(cv_image, max_width):
+        """
+        Scales the image down to ``max_width``, keeping the aspect ratio.
+
+        :param cv_image: CV image
+        :param max_width: the widest it can be, 0 for no limit
+        :return: the image, the same one if it's already small enough
+        """
+
+        height, width = cv_image.shape[:2]
+        if max_width <= 0 or width <= max_width:
+            return cv_image
+
+        new_height = max(1, int(round(height * max_width / width)))
+        return cv2.resize(cv_image, (max_width, new_height), interpolation=cv2.INTER_AREA)
+
+    def encode(self, cv_image, profile=ARCHIVE):
+        """
+        Encodes the image.
+
+        :param cv_image: CV image
+        :param profile: profile name
+        :return: the JPEG as a uint8 array, or None on failure
+        """
+
+        settings = self.profiles.get(profile, None)
+        if settings is None:
+            log.error('Unknown JPEG profile {}'.format(profile))
+            return None
+
+        start_time = perf_counter()
+
+        img = JpegEncoder.shrink(cv_image, settings['max_width'])
+
+        jpg = None
+        turbo = self._turbojpeg()
+
+        if turbo is not None:
+            flags = 0
+            if settings['progressive']:
+                flags |= turbojpeg.TJFLAG_PROGRESSIVE
+
+            jpg = np.frombuffer(
+                turbo.encode(
+                    np.ascontiguousarray(img),
+                    quality=settings['quality'],
+                    jpeg_subsample=getattr(turbojpeg, _TJ_SAMPLING[settings['subsampling']]),
+                    flags=flags),
+                dtype=np.uint8)
+        else:
+            ok, jpg = cv2.imencode('.jpg', img, JpegEncoder.cv_params(settings))
+            if not ok:
+                log.error('Error encoding image to jpeg')
+                return None
+
+            jpg = jpg.reshape(-1)
+
+        elapsed = perf_counter() - start_time
+
+        stats = self.stats.setdefault(profile, {'count': 0, 'bytes': 0, 'seconds': 0.0})
+        stats['count'] += 1
+        stats['bytes'] += len(jpg)
+        stats['seconds'] += elapsed
+
+        log.debug('Encoded {} JPEG: {} bytes in {:.4f}s'.format(profile, len(jpg), elapsed))
+
+        if self.stats_interval > 0 and stats['count'] % self.stats_interval == 0:
+            self.log_stats()
+
+        return jpg
+
+    def save(self, cv_image, filename, profile=ARCHIVE):
+        """
+        Encodes the image, and writes it to a file.
+
+        :param cv_image: CV image
+        :param filename: where to write it
+        :param profile: profile name
+        :return: True on success
+        """
+
+        jpg = self.encode(cv_image, profile)
+        if jpg is None:
+            return False
+
+        with open(filename, 'wb') as f:
+            f.write(jpg)
+
+        return True
+
+    def log_stats(self):
+        """
+        Logs the average size and encode time of each profile.
+        """
+
+        for profile, stats in sorted(self.stats.items()):
+            count = max(1, stats['count'])
+            log.info('{}: {} JPEGs, {:.0f} bytes and {:.4f}s on average'.format(
+                profile, stats['count'], stats['bytes'] / count, stats['seconds'] / count))
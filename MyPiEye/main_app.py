@@ -5,7 +5,9 @@ from os.path import abspath
 from concurrent.futures import ProcessPoolExecutor
 
 from MyPiEye.Storage import ImageStorage, S3Archive
-from MyPiEye.motion_detect import MotionDetect, ImageCapture
+from MyPiEye.motion_detect import MotionDetect, ImageCapture, CLEAN, TIMESTAMP, FULL, THUMB
+from MyPiEye.detect_scheduler import DetectScheduler
+from MyPiEye.encoder import JpegEncoder, ARCHIVE, THUMBNAIL
 
 from MyPiEye.usbcamera import UsbCamera
 
@@ -34,12 +36,22 @@ class MainApp(object):
             config
         )
 
+        # slows down checking while nothing is happening
+        self.scheduler = DetectScheduler(config)
+
         # self.check should have ensured it exists
         self.savedir = config['savedir']
         self.executor = ProcessPoolExecutor(max_workers=2)
 
         self.storage = ImageStorage(config)
 
+        self.encoder = JpegEncoder(config)
+
+        self.camera_id = config.get('camera', {}).get('camera_id', 'unknown/unknown')
+
+        # only make the images the storage backends use
+        self.variants = ImageStorage.variants(config)
+
     def start(self):
         """
         Initializes the camera, and starts the main loop. Cleans up when it stops.
@@ -57,45 +69,55 @@ class MainApp(object):
             self.camera.close_camera()
             log.warning('Waiting on external process shutdown')
             self.executor.shutdown()
+            self.storage.shutdown()
 
         return True
 
-    def save_images(self, motion: ImageCapture):
+    def save_images(self, motion: ImageCapture, variants=None):
         """
-        Saves CV2 image to various locations, with annotations.
+        Encodes the CV2 image, with annotations.
+
+        The annotations are drawn on one copy of the image: the timestamp first, then the boxes.
+        Each variant is encoded in memory as soon as it's drawn.
 
         :param motion: an ImageCapture object with at least capture_dt, clean_image, and motions populated.
-        :return: an ImageCapture object (the same one) with temp file names populated
+        :param variants: the ``IMAGE_VARIANTS`` to make, defaults to what the storage backends use
+        :return: an ImageCapture object (the same one) with jpgs populated
         """
 
-        # unaltered
-        log.info('Saving clean image')
-        start_time = datetime.now()
-        motion.clean_fname = '{}/{}.jpg'.format(self.workdir, motion.base_filename)
-        MotionDetect.save_cv_image(motion.clean_image, motion.clean_fname)
-        end_time = datetime.now()
-        tot_time = end_time - start_time
-        log.info('Saved tmpfile ({}) {}'.format(tot_time, motion.clean_fname))
-
-        # timestamp
-        log.info('Saving timestamp image')
-        start_time = datetime.now()
-        motion.ts_fname = '{}/{}.ts.jpg'.format(self.workdir, motion.base_filename)
-        motion.ts_image = MotionDetect.add_timestamp(motion.clean_image, motion.timestamp_local)
-        MotionDetect.save_cv_image(motion.ts_image, motion.ts_fname)
-        end_time = datetime.now()
-        tot_time = end_time - start_time
-        log.info('Saved tmpfile ({}) {}'.format(tot_time, motion.ts_fname))
-
-        # fully annotated
-        log.info('Saving full annotated image')
+        if variants is None:
+            variants = self.variants
+
         start_time = datetime.now()
-        motion.full_fname = '{}/{}.box.jpg'.format(self.workdir, motion.base_filename)
-        motion.full_image = MotionDetect.add_motion_boxes(motion.ts_image, motion.motions)
-        MotionDetect.save_cv_image(motion.full_image, motion.full_fname)
-        end_time = datetime.now()
-        tot_time = end_time - start_time
-        log.info('Saved tmpfile ({}) {}'.format(tot_time, motion.full_fname))
+
+        def encode(variant, cv_image, profile=ARCHIVE):
+            jpg = self.encoder.encode(cv_image, profile)
+            if jpg is not None:
+                motion.jpgs[variant] = jpg.tobytes()
+
+        if CLEAN in variants:
+            # unaltered
+            encode(CLEAN, motion.clean_image)
+
+        if TIMESTAMP in variants or FULL in variants or THUMB in variants:
+            working = motion.clean_image.copy()
+
+            MotionDetect.draw_timestamp(working, motion.timestamp_local)
+            if TIMESTAMP in variants:
+                encode(TIMESTAMP, working)
+
+            if FULL in variants or THUMB in variants:
+                # fully annotated
+                MotionDetect.draw_motion_boxes(working, motion.motions)
+
+                if FULL in variants:
+                    encode(FULL, working)
+
+                if THUMB in variants:
+                    encode(THUMB, working, THUMBNAIL)
+
+        tot_time = datetime.now() - start_time
+        log.info('Encoded {} ({}) {}'.format(', '.join(sorted(motion.jpgs.keys())), tot_time, motion.base_filename))
 
         return motion
 
@@ -108,9 +130,12 @@ class MainApp(object):
 
         retries = 0
 
+        # frames read, so the scheduler knows the camera's frame period
+        frame_seq = 0
+
         while True and retries < 3:
             # Note: this is a CV2 image.
-            current_img = self.camera.get_image()
+            current_img, captured = self.camera.get_frame()
             if current_img is None:
                 log.error('Failed to get image')
                 sleep(1)
@@ -119,23 +144,34 @@ class MainApp(object):
 
             retries = 0
 
+            frame_seq += 1
+            self.scheduler.frame(frame_seq, captured)
+
+            started = self.scheduler.start()
             motion = self.motiondetect.motions(current_img)
+            self.scheduler.finish(started, motion is not None)
 
             if motion is not None:
                 log.debug('Motion detected.')
 
                 # the object only has motion object right now.
                 motion.clean_image = current_img
+                motion.cam_id = self.camera_id
+
+                # annotate and encode
+                self.save_images(motion)
 
-                # process and save temp images
-                files = self.save_images(motion)
+                # the raw image isn't needed anymore, and shouldn't be sent to the storage process
+                motion.clean_image = None
 
-                # store the temp files in their permanent locations
+                # store the images in their permanent locations
                 self.storage.save_files(motion)
+                motion.release()
 
-            else:
-                # nothing to do, so goof off a fraction of a second
-                sleep(.1)
+            # quiet scenes are checked less often
+            delay = self.scheduler.delay()
+            if delay > 0:
+                sleep(delay)
 
         if retries >= 2:
             log.error('Failed to get image after {} attempts'.format(retries + 1))
@@ -1,17 +1,90 @@
 from datetime import datetime
-from os.path import exists, abspath
-from os import remove
+from os.path import abspath
 from ast import literal_eval
+from math import log2
 import multiprocessing
+import threading
+from multiprocessing import shared_memory
 
 from dateutil import tz
 
 import cv2
+import numpy as np
+
+from MyPiEye.CLI import get_config_value
 
 log = multiprocessing.get_logger()
 
+# one row per motion box, in full resolution pixels
+MOTION_DTYPE = np.dtype([
+    ('x', np.int32),
+    ('y', np.int32),
+    ('w', np.int32),
+    ('h', np.int32),
+    ('size', np.float64)
+])
+
+
+# the images made for each motion event
+# clean: as captured
+# ts: with the timestamp
+# full: with the timestamp and motion boxes
+# thumb: a thumbnail of full, sent instead when a backend is falling behind
+CLEAN = 'clean'
+TIMESTAMP = 'ts'
+FULL = 'full'
+THUMB = 'thumb'
+
+IMAGE_VARIANTS = (CLEAN, TIMESTAMP, FULL, THUMB)
+
+# added to the base filename of each variant
+VARIANT_SUFFIXES = {
+    CLEAN: '',
+    TIMESTAMP: '.ts',
+    FULL: '.box',
+    THUMB: '.thumb'
+}
+
+
+def as_motion_array(movements):
+    """
+    Converts a list of ``{'rect': (x, y, w, h), 'size': size}`` dicts to a ``MOTION_DTYPE`` array.
+    Arrays are returned as-is.
+
+    :param movements: list of dicts, or a ``MOTION_DTYPE`` array
+    :return: ``MOTION_DTYPE`` array
+    """
+
+    if isinstance(movements, np.ndarray):
+        return movements
+
+    return np.array(
+        [tuple(m['rect']) + (m['size'],) for m in movements or []],
+        dtype=MOTION_DTYPE)
+
+
+def motions_to_list(movements):
+    """
+    Converts motion boxes to ``{'rect': [x, y, w, h], 'size': size}`` dicts, for JSON and such.
+
+    :param movements: ``MOTION_DTYPE`` array
+    :return: list of dicts
+    """
+
+    return [
+        {'rect': [int(m['x']), int(m['y']), int(m['w']), int(m['h'])], 'size': float(m['size'])}
+        for m in as_motion_array(movements)
+    ]
+
 
 class ImageCapture(object):
+    """
+    A motion event: when, where, and the encoded images.
+
+    The images are only held in memory. Whoever hands the capture off to something that runs later
+    should :func:`retain` it first, and :func:`release` it when that's done. The images are dropped
+    when the last reference is released. A copy sent to another process starts with one reference of its own.
+    """
 
     def __init__(self, config):
 
@@ -21,34 +94,113 @@ class ImageCapture(object):
 
         self.capture_dt = None
 
-        # images, ie numpy arrays
+        # the captured image, ie numpy array
         self.clean_image = None
-        self.ts_image = None
-        self.full_image = None
 
-        # filenames
-        self.clean_fname = None
-        self.ts_fname = None
-        self.full_fname = None
+        # encoded images as bytes, by variant. See ``IMAGE_VARIANTS``.
+        self.jpgs = {}
 
-        # list of co-ordinate lists
+        # ``MOTION_DTYPE`` array of boxes
         self.motions = None
 
-    def __del__(self):
+        self._refs = 1
+        self._refs_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_refs'] = 1
+        del state['_refs_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._refs_lock = threading.Lock()
+
+    def retain(self):
+        """
+        Adds a reference to the images.
+
+        :return: self
+        """
 
-        log.info('Removing temp files')
+        with self._refs_lock:
+            self._refs += 1
 
-        if self.clean_fname is not None and exists(self.clean_fname):
-            log.debug('Removing {}'.format(self.clean_fname))
-            remove(self.clean_fname)
+        return self
 
-        if self.ts_fname is not None and exists(self.ts_fname):
-            log.debug('Removing {}'.format(self.ts_fname))
-            remove(self.ts_fname)
+    def release(self):
+        """
+        Drops a reference. The images are dropped with the last one.
 
-        if self.full_fname is not None and exists(self.full_fname):
-            log.debug('Removing {}'.format(self.full_fname))
-            remove(self.full_fname)
+        :return: True if the images were dropped
+        """
+
+        with self._refs_lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return False
+
+        log.debug('Releasing images captured at {}'.format(self.capture_dt))
+        self.clean_image = None
+        self.jpgs = {}
+
+        return True
+
+    def jpg(self, variant):
+        """
+        An encoded image.
+
+        :param variant: one of ``IMAGE_VARIANTS``
+        :return: the JPEG as bytes, or None if it wasn't made
+        """
+
+        if variant not in IMAGE_VARIANTS:
+            raise ValueError('Unknown image variant {}'.format(variant))
+
+        return self.jpgs.get(variant, None)
+
+    def to_meta(self):
+        """
+        The capture metadata, without the images. Suitable for JSON.
+
+        :return: dict
+        """
+
+        return {
+            'cam_id': self.cam_id,
+            'motions': motions_to_list(self.motions if self.motions is not None else [])
+        }
+
+    @classmethod
+    def from_meta(cls, config, meta: dict, capture_dt: datetime):
+        """
+        Rebuilds an ImageCapture from :func:`to_meta` output.
+
+        :param config: global config
+        :param meta: dict from :func:`to_meta`
+        :param capture_dt: capture datetime
+        :return: ImageCapture, without images
+        """
+
+        ret = cls(config)
+        ret.capture_dt = capture_dt
+        ret.cam_id = meta.get('cam_id', None)
+        ret.motions = as_motion_array(meta.get('motions', []))
+
+        return ret
+
+    def filename(self, variant):
+        """
+        The filename of an image variant, for storage. Does not include a directory.
+
+        :param variant: one of ``IMAGE_VARIANTS``
+        :return: the filename
+        """
+
+        if variant not in IMAGE_VARIANTS:
+            raise ValueError('Unknown image variant {}'.format(variant))
+
+        return '{}{}.jpg'.format(self.base_filename, VARIANT_SUFFIXES[variant])
 
     @property
     def subdir(self):
@@ -96,6 +248,77 @@ class ImageCapture(object):
         return local_dt.strftime('%y/%m/%d %H:%M:%S.%f')
 
 
+class CaptureTask(object):
+    """
+    A small, picklable handle to an :class:`ImageCapture`, for sending to storage workers.
+
+    The encoded images are copied into one shared memory block. Only its name, where each image is in it,
+    and the capture metadata are pickled. The worker already has the config, so it isn't sent either.
+
+    The creator calls :func:`unlink` once the worker is done.
+    """
+
+    def __init__(self, img_capture: ImageCapture):
+        """
+        :param img_capture: the capture, with its images encoded
+        """
+
+        self.capture_dt = img_capture.capture_dt
+        self.meta = img_capture.to_meta()
+
+        # variant: (offset, length)
+        self.layout = {}
+
+        offset = 0
+        for variant, jpg in img_capture.jpgs.items():
+            self.layout[variant] = (offset, len(jpg))
+            offset += len(jpg)
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, offset))
+        self.shm_name = self._shm.name
+
+        for variant, jpg in img_capture.jpgs.items():
+            start, length = self.layout[variant]
+            self._shm.buf[start:start + length] = jpg
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        return state
+
+    def load(self, config, variants=None):
+        """
+        Rebuilds the capture, in the worker.
+
+        :param config: global config
+        :param variants: the images to copy out, None for all of them
+        :return: ImageCapture, with its images
+        """
+
+        ret = ImageCapture.from_meta(config, self.meta, self.capture_dt)
+
+        shm = shared_memory.SharedMemory(name=self.shm_name)
+        try:
+            for variant, (start, length) in self.layout.items():
+                if variants is not None and variant not in variants:
+                    continue
+                ret.jpgs[variant] = bytes(shm.buf[start:start + length])
+        finally:
+            shm.close()
+
+        return ret
+
+    def unlink(self):
+        """
+        Releases the shared memory. Only the creator should call this.
+        """
+
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
 class MotionDetect:
     """
     Interface to OpenCV
@@ -113,7 +336,12 @@ class MotionDetect:
 
         self.config = config
 
-        self.workdir = abspath(config['workdir'])
+        # the single-process app keeps it at the top level
+        workdir = config.get('workdir', None)
+        if workdir is None:
+            workdir = get_config_value(config, 'global', 'workdir', 'WORKDIR', '.')
+
+        self.workdir = abspath(workdir)
 
         minsizes = config.get('minsizes', {})
 
@@ -122,23 +350,63 @@ class MotionDetect:
         if isinstance(self.minsize, str):
             self.minsize = literal_eval(self.minsize)
 
-        self.min_width = literal_eval(minsizes.get('min_width', 0))
-        self.min_height = literal_eval(minsizes.get('min_height', 0))
+        self.min_width = literal_eval(minsizes.get('min_width', '0'))
+        self.min_height = literal_eval(minsizes.get('min_height', '0'))
 
-        ignore_dict = self.config.get('ignore', {})
-        ignore_boxes = []
+        # polygons, drawn into a mask the first time it's needed
+        self.ignore_regions = []
+        self._mask_key = None
+        self._mask = None
 
-        for _, v in ignore_dict.items():
-            val = literal_eval(v)
-            ignore_boxes.append(val)
+        # crops of the mask, per region and detection size
+        self._region_masks = {}
 
-        self.ignore_boxes = ignore_boxes
+        self.set_ignore(self.config.get('ignore', {}))
+
+        # only these parts of the frame are checked. The whole frame, if there aren't any.
+        self.roi = MotionDetect.parse_roi(self.config.get('roi', {}))
+        self._regions_key = None
+        self._regions = None
 
         self.prev_filename = None
         self.current_filename = None
         self.del_filename = None
 
-        self.prev_image = None
+        motion_config = config.get('motion', {})
+
+        # ``previous`` compares against the last frame, ``average`` against a running average of them
+        self.background_mode = motion_config.get('background', 'previous')
+        if self.background_mode not in ['previous', 'average']:
+            log.warning('Unknown background mode {}, using previous'.format(self.background_mode))
+            self.background_mode = 'previous'
+
+        # how much each new frame counts towards the running average
+        self.average_weight = float(motion_config.get('average_weight', '0.1'))
+
+        # per region, the blurred grayscale of the previous frame, or the float32 running average
+        self.backgrounds = {}
+
+        # detection runs on a smaller copy of the image, boxes are mapped back to full size
+        self.detect_scale = float(motion_config.get('detect_scale', '1'))
+        if not 0 < self.detect_scale <= 1:
+            log.warning('detect_scale must be between 0 and 1, not {}. Using 1.'.format(self.detect_scale))
+            self.detect_scale = 1.0
+
+        # ``resize`` or ``pyramid``. The pyramid halves the image each level, so the scale is rounded to a power of 2.
+        self.scale_method = motion_config.get('scale_method', 'resize')
+        self.pyramid_levels = 0
+        if self.scale_method == 'pyramid':
+            self.pyramid_levels = int(round(log2(1 / self.detect_scale)))
+            self.detect_scale = 1 / (2 ** self.pyramid_levels)
+
+        # the blur is sized for full resolution, shrink it to match. It has to be odd.
+        self.blur_size = max(3, int(round(21 * self.detect_scale)) // 2 * 2 + 1)
+
+        # actual (x, y) scale of the last prepared image, rounding included
+        self.scale_xy = (1.0, 1.0)
+
+        # shape of the last full resolution frame
+        self.frame_shape = None
 
         self.false_return = (False, None, None, None)
 
@@ -150,33 +418,247 @@ class MotionDetect:
 
         :param img1: the previous image
         :param img2: the current image
-        :return: Tuple with result, and changes if any
+        :return: Tuple with result, and a ``MOTION_DTYPE`` array of changes
+        """
+        gray1 = MotionDetect.make_gray(img1)
+        gray2 = MotionDetect.make_gray(img2)
+
+        stats = MotionDetect.find_blobs(gray1, gray2, self.detect_mask(img1.shape, img1.shape))
+        movements = self.filter_blobs(stats, (1.0, 1.0))
+
+        return len(movements) > 0, movements
+
+    def compare_gray(self, gray1, gray2, region=None):
+        """
+        Same as :func:`compare_images`, for images already passed through :func:`prepare`.
+        Boxes are mapped back to full resolution frame co-ordinates before they are filtered.
+
+        :param gray1: the previous gray image, or the background
+        :param gray2: the current gray image
+        :param region: the (x, y, w, h) part of the frame the images were cropped from, None for all of it
+        :return: Tuple with result, and a ``MOTION_DTYPE`` array of changes
+        """
+        mask = self.detect_mask(self.frame_shape, gray2.shape, region)
+        stats = MotionDetect.find_blobs(gray1, gray2, mask)
+        movements = self.filter_blobs(stats, self.scale_xy)
+
+        if region is not None:
+            movements['x'] += region[0]
+            movements['y'] += region[1]
+
+        return len(movements) > 0, movements
+
+    def filter_blobs(self, stats, scale_xy):
+        """
+        Maps blobs back to full resolution, and drops those under the minimum size, width, or height.
+        Done on the whole array at once.
+
+        :param stats: int32 array of (x, y, w, h, area) rows, from :func:`find_blobs`
+        :param scale_xy: the (x, y) scale of the image the blobs were found in
+        :return: ``MOTION_DTYPE`` array
+        """
+
+        sx, sy = scale_xy
+
+        x = stats[:, cv2.CC_STAT_LEFT]
+        y = stats[:, cv2.CC_STAT_TOP]
+
+        # round outwards, so the box still covers the blob
+        fx = np.floor(x / sx)
+        fy = np.floor(y / sy)
+        fw = np.ceil((x + stats[:, cv2.CC_STAT_WIDTH]) / sx) - fx
+        fh = np.ceil((y + stats[:, cv2.CC_STAT_HEIGHT]) / sy) - fy
+        size = stats[:, cv2.CC_STAT_AREA] / (sx * sy)
+
+        keep = (fw > self.min_width) & (fh > self.min_height)
+        if self.minsize != 0:
+            keep &= size >= self.minsize
+
+        movements = np.empty(np.count_nonzero(keep), dtype=MOTION_DTYPE)
+        movements['x'] = fx[keep]
+        movements['y'] = fy[keep]
+        movements['w'] = fw[keep]
+        movements['h'] = fh[keep]
+        movements['size'] = size[keep]
+
+        return movements
+
+    def set_ignore(self, ignore_dict):
+        """
+        Sets the regions to ignore. The mask is rebuilt the next time it's needed.
+
+        :param ignore_dict: the ``[ignore]`` section, see :func:`parse_ignore`
+        :return: None
+        """
+        self.ignore_regions = MotionDetect.parse_ignore(ignore_dict)
+        self._mask_key = None
+        self._mask = None
+        self._region_masks = {}
+
+    @staticmethod
+    def parse_ignore(ignore_dict):
+        """
+        Reads ignored regions. Each value is either an (x, y, w, h) box,
+        or a polygon as a list of at least three (x, y) points.
+
+        :param ignore_dict: name to region. Strings are evaluated.
+        :return: list of polygons, as int32 point arrays
+        """
+
+        regions = []
+
+        for name, val in ignore_dict.items():
+            try:
+                if isinstance(val, str):
+                    val = literal_eval(val)
+
+                if len(val) == 4 and all(isinstance(v, (int, float)) for v in val):
+                    x, y, w, h = val
+                    points = [(x, y), (x + w - 1, y), (x + w - 1, y + h - 1), (x, y + h - 1)]
+                elif len(val) >= 3 and all(len(p) == 2 for p in val):
+                    points = val
+                else:
+                    raise ValueError(val)
+
+            except (ValueError, SyntaxError, TypeError):
+                log.warning('Skipping ignore region {}, expected (x, y, w, h) or a list of (x, y): {}'.format(
+                    name, val))
+                continue
+
+            regions.append(np.array(points, dtype=np.int32))
+
+        return regions
+
+    def detect_mask(self, frame_shape, detect_shape, region=None):
+        """
+        The ignore mask for an image. Built once, and again only if the sizes change.
+
+        :param frame_shape: shape of the full resolution frame, ignore regions are in these units
+        :param detect_shape: shape of the image being checked
+        :param region: the (x, y, w, h) part of the frame being checked, None for all of it
+        :return: uint8 mask, 0 where ignored, or None if nothing is ignored
+        """
+
+        if not self.ignore_regions:
+            return None
+
+        frame_key = tuple(frame_shape[:2])
+        if frame_key != self._mask_key:
+            height, width = frame_key
+            log.info('Building ignore mask for {}x{}'.format(width, height))
+
+            self._mask = np.full((height, width), 255, dtype=np.uint8)
+            cv2.fillPoly(self._mask, self.ignore_regions, 0)
+
+            self._mask_key = frame_key
+            self._region_masks = {}
+
+        if region is None:
+            region = (0, 0, frame_key[1], frame_key[0])
+
+        key = (region, tuple(detect_shape[:2]))
+        mask = self._region_masks.get(key, None)
+        if mask is not None:
+            return mask
+
+        x, y, w, h = region
+        mask = self._mask[y:y + h, x:x + w]
+
+        if (h, w) != key[1]:
+            mask = cv2.resize(mask, (detect_shape[1], detect_shape[0]), interpolation=cv2.INTER_NEAREST)
+
+        self._region_masks[key] = mask
+
+        return mask
+
+    @staticmethod
+    def parse_roi(roi_dict):
         """
-        movements = []
+        Reads the regions of interest, as (x, y, w, h) boxes.
 
-        contours = MotionDetect.find_contours(img1, img2)
+        :param roi_dict: the ``[roi]`` section. Strings are evaluated.
+        :return: list of (x, y, w, h) tuples
+        """
+
+        ret = []
 
-        # we may not want some of these to count
-        for size, rect in list(contours):
+        for name, val in roi_dict.items():
+            try:
+                if isinstance(val, str):
+                    val = literal_eval(val)
 
-            # is this one being ignored?
-            if self.ignore(rect, size):
+                x, y, w, h = [int(v) for v in val]
+            except (ValueError, SyntaxError, TypeError):
+                log.warning('Skipping region of interest {}, expected (x, y, w, h): {}'.format(name, val))
                 continue
 
-            # add it to the list
-            movements.append({
-                'rect': rect,
-                'size': size
-            })
+            ret.append((x, y, w, h))
+
+        return ret
+
+    def regions(self, frame_shape):
+        """
+        The parts of the frame to check, clipped to the frame.
+
+        :param frame_shape: shape of the full resolution frame
+        :return: list of (x, y, w, h) tuples. The whole frame if there are no regions of interest.
+        """
 
-        if 0 == len(movements):
-            return False, []
+        key = tuple(frame_shape[:2])
+        if key == self._regions_key:
+            return self._regions
 
-        return True, movements
+        height, width = key
+
+        if not self.roi:
+            regions = [(0, 0, width, height)]
+        else:
+            regions = []
+            for x, y, w, h in self.roi:
+                x0 = min(max(0, x), width)
+                y0 = min(max(0, y), height)
+                x1 = min(max(0, x + w), width)
+                y1 = min(max(0, y + h), height)
+
+                if x1 <= x0 or y1 <= y0:
+                    log.warning('Region of interest {} is outside of the {}x{} frame'.format(
+                        (x, y, w, h), width, height))
+                    continue
+
+                regions.append((x0, y0, x1 - x0, y1 - y0))
+
+        self._regions_key = key
+        self._regions = regions
+
+        return regions
+
+    def prepare(self, cv_image):
+        """
+        Shrinks the image to ``detect_scale``, then converts it to gray and blurs it.
+
+        :param cv_image: full resolution CV image
+        :return: gray CV image
+        """
+
+        small = cv_image
+
+        if self.pyramid_levels > 0:
+            for _ in range(self.pyramid_levels):
+                small = cv2.pyrDown(small)
+        elif self.detect_scale < 1:
+            small = cv2.resize(
+                cv_image, None, fx=self.detect_scale, fy=self.detect_scale, interpolation=cv2.INTER_AREA)
+
+        self.scale_xy = (
+            small.shape[1] / cv_image.shape[1],
+            small.shape[0] / cv_image.shape[0])
+
+        return MotionDetect.make_gray(small, self.blur_size)
 
     def ignore(self, movement, size):
         """
-        Checks movement box against list of ignored boxes, and minimum size, width, height
+        Checks movement box against minimum size, width, height.
+        Ignored regions are masked out before the boxes are found.
 
         :param movement:
         :param size:
@@ -194,18 +676,15 @@ class MotionDetect:
         if h <= self.min_height:
             return True
 
-        for igbox in self.ignore_boxes:
-            (ix, iy, iw, ih) = igbox
-            if ix <= x and (ix + iw) >= (x + w) and \
-                    iy <= y and (iy + ih) >= (y + h):
-                return True
-
         return False
 
     def motions(self, current_img):
         """
-        Compares passed in image with stored previous image.
-        If previous image does not exist, then a negative result (no changes) is returned.
+        Compares passed in image with the background, either the previous image or the running average.
+        If there is no background yet, then a negative result (no changes) is returned.
+
+        Only the regions of interest are checked, each with its own background.
+        Each one is converted to gray and blurred once, and that's kept as the background.
 
         when motion is detected, returns an ImageCapture object with capture_dt and motions set.
 
@@ -220,34 +699,85 @@ class MotionDetect:
 
         if 0 == len(current_img):
             log.error('Invalid image: {}'.format(current_img))
-            # if the resolution changes, we'll blow up
-            self.prev_filename = None
+            self.backgrounds = {}
 
             return None
 
-        if self.prev_image is not None:
+        # the resolution changed, start over
+        if self.frame_shape is not None and self.frame_shape != current_img.shape:
+            log.warning('Image size changed to {}, resetting background'.format(current_img.shape))
+            self.backgrounds = {}
+
+        self.frame_shape = current_img.shape
+
+        found = []
+
+        for region in self.regions(current_img.shape):
+            x, y, w, h = region
+
+            # a view, not a copy
+            gray = self.prepare(current_img[y:y + h, x:x + w])
+
+            if region in self.backgrounds:
+                _, movements = self.compare_gray(self.background_image(region), gray, region)
+                found.append(movements)
+
+            self.update_background(gray, region)
 
-            motion, movements = self.compare_images(
-                self.prev_image, current_img)
+        if found:
+            movements = np.concatenate(found)
 
-            if motion:
+            if len(movements) > 0:
                 ret_img = ImageCapture(self.config)  # (dtnow, movements)
                 ret_img.capture_dt = dtnow
                 ret_img.motions = movements
-            else:
-                ret_img = None
-
-        self.prev_image = current_img.copy()
 
         return ret_img
 
+    def background_image(self, region):
+        """
+        The background as a gray CV image.
+
+        :param region: the (x, y, w, h) region
+        :return: gray CV image, or None if there isn't one yet.
+        """
+
+        background = self.backgrounds.get(region, None)
+
+        if background is None or self.background_mode == 'previous':
+            return background
+
+        return cv2.convertScaleAbs(background)
+
+    def update_background(self, gray, region):
+        """
+        Adds a gray image to the background.
+
+        :param gray: gray CV image, from :func:`prepare`
+        :param region: the (x, y, w, h) region it came from
+        :return: None
+        """
+
+        if self.background_mode == 'previous':
+            # prepare returns a new image, no need to copy it
+            self.backgrounds[region] = gray
+            return
+
+        background = self.backgrounds.get(region, None)
+
+        if background is None:
+            self.backgrounds[region] = gray.astype(np.float32)
+        else:
+            cv2.accumulateWeighted(gray, background, self.average_weight)
+
     @staticmethod
-    def find_contours(img1, img2):
+    def find_contours(img1, img2, mask=None):
         """
         Relies on OpenCV to do the hard work.
 
         :param img1: cv image
         :param img2: cv image
+        :param mask: optional uint8 mask, changes are only looked for where it's non-zero
         :return: A list of (size, rect) tuples.
         """
         # CV voodoo happens here
@@ -256,6 +786,61 @@ class MotionDetect:
         gray1 = MotionDetect.make_gray(img1)
         gray2 = MotionDetect.make_gray(img2)
 
+        return MotionDetect.find_gray_contours(gray1, gray2, mask)
+
+    @staticmethod
+    def find_gray_contours(gray1, gray2, mask=None):
+        """
+        Same as :func:`find_contours`, for images already passed through :func:`make_gray`.
+
+        :param gray1: gray cv image
+        :param gray2: gray cv image
+        :param mask: optional uint8 mask, the same size as the images
+        :return: A list of (size, rect) tuples.
+        """
+
+        thresh = MotionDetect.diff_threshold(gray1, gray2, mask)
+
+        # these are ulitmately what we want
+        contours = cv2.findContours(
+            thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+        for c in contours:
+            # get measurements we can use
+            size = cv2.contourArea(c)
+            rect = cv2.boundingRect(c)
+            yield (size, rect)
+
+    @staticmethod
+    def find_blobs(gray1, gray2, mask=None):
+        """
+        Finds all of the changed areas in one call.
+        Sizes are pixel counts, rather than contour areas.
+
+        :param gray1: gray cv image
+        :param gray2: gray cv image
+        :param mask: optional uint8 mask, the same size as the images
+        :return: int32 array of rows indexed by ``cv2.CC_STAT_*``: x, y, w, h, area
+        """
+
+        thresh = MotionDetect.diff_threshold(gray1, gray2, mask)
+
+        _, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
+
+        # the first one is the background
+        return stats[1:]
+
+    @staticmethod
+    def diff_threshold(gray1, gray2, mask=None):
+        """
+        The changed areas between two gray images, as a binary image.
+
+        :param gray1: gray cv image
+        :param gray2: gray cv image
+        :param mask: optional uint8 mask, the same size as the images
+        :return: uint8 image, 255 where changed
+        """
+
         # finds differences as blobs
         frame_diff = cv2.absdiff(gray1, gray2)
         # refines those blobs to make them blocky
@@ -266,34 +851,30 @@ class MotionDetect:
         # make those blocks really stand out.
         thresh = cv2.dilate(thresh, None, iterations=2)
 
-        # these are ulitmately what we want
-        contours = cv2.findContours(
-            thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[1]
+        # ignored regions can't generate contours
+        if mask is not None:
+            thresh = cv2.bitwise_and(thresh, mask)
 
-        ret_ = []
-        for c in contours:
-            # get measurements we can use
-            size = cv2.contourArea(c)
-            rect = cv2.boundingRect(c)
-            yield (size, rect)
+        return thresh
 
     @staticmethod
-    def make_gray(cv_image):
+    def make_gray(cv_image, blur_size=21):
         """
         Converts image to grayscale.
 
         :param cv_image: CV image
+        :param blur_size: Gaussian blur kernel size, must be odd
         :return: gray CV image
         """
         g = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
-        g = cv2.GaussianBlur(g, (21, 21), 0)
+        g = cv2.GaussianBlur(g, (blur_size, blur_size), 0)
         return g
 
     @staticmethod
     def save_cv_image(cv_image, filename):
         """
         Write the image as a file.
-        This is being deprecated. Use the one in usbcamera.py.
+        This is being deprecated. Use :class:`MyPiEye.encoder.JpegEncoder`.
 
         :param cv_image:
         :param filename:
@@ -307,16 +888,29 @@ class MotionDetect:
         Adds white boxes where motion was detected
 
         :param cv_image: CV2 image to copy and modify
-        :param movements: a list of movement lists.
+        :param movements: ``MOTION_DTYPE`` array, or a list of movement dicts.
         :return: a copy CV2 image with boxes.
         """
         copied = cv_image.copy()
-        for b in movements:
-            (x, y, w, h) = b['rect']
-            cv2.rectangle(copied, (x, y), (x + w, y + h), (192, 192, 192), 1)
+        MotionDetect.draw_motion_boxes(copied, movements)
 
         return copied
 
+    @staticmethod
+    def draw_motion_boxes(cv_image, movements):
+        """
+        Same as :func:`add_motion_boxes`, but draws on the image itself.
+
+        :param cv_image: CV2 image to modify
+        :param movements: ``MOTION_DTYPE`` array, or a list of movement dicts.
+        :return: the same image
+        """
+        for b in as_motion_array(movements).tolist():
+            (x, y, w, h, _) = b
+            cv2.rectangle(cv_image, (x, y), (x + w, y + h), (192, 192, 192), 1)
+
+        return cv_image
+
     @staticmethod
     def add_timestamp(cv_image, dtstamp):
         """
@@ -327,8 +921,21 @@ class MotionDetect:
         :return:
         """
         copied = cv_image.copy()
+        MotionDetect.draw_timestamp(copied, dtstamp)
+
+        return copied
+
+    @staticmethod
+    def draw_timestamp(cv_image, dtstamp):
+        """
+        Same as :func:`add_timestamp`, but draws on the image itself.
 
-        cv2.putText(copied, dtstamp,
+        :param cv_image: The image to modify
+        :param dtstamp: the timestamp text
+        :return: the same image
+        """
+
+        cv2.putText(cv_image, dtstamp,
                     (10, 20),  # start location
                     cv2.FONT_HERSHEY_SIMPLEX,
                     .7,  # font scale?
@@ -336,4 +943,4 @@ class MotionDetect:
                     2  # the width of the lines to draw the font
                     )
 
-        return copied
+        return cv_image
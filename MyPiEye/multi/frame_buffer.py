@@ -0,0 +1,249 @@
+import json
+import logging
+from datetime import datetime, timedelta
+from multiprocessing import shared_memory
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# capture timestamps are stored as microseconds from this.
+# naive in, naive out, so whatever the camera used is preserved.
+_EPOCH = datetime(1970, 1, 1)
+_USEC = timedelta(microseconds=1)
+
+
+def dt_to_usec(dt_stamp: datetime):
+    return (dt_stamp - _EPOCH) // _USEC
+
+
+def usec_to_dt(usec):
+    return _EPOCH + timedelta(microseconds=int(usec))
+
+
+class FrameRingBuffer(object):
+    """
+    Fixed-size camera frames in shared memory, so they don't have to be pickled
+    through the manager process.
+
+    There is only one writer, the camera or motion detection. Each frame gets a monotonically increasing sequence number,
+    and is stored in slot ``seq % slots``. Readers get a read-only NumPy view of the slot, no copying.
+
+    A slot is overwritten once the writer has written ``slots`` more frames. Readers that hang on
+    to a view should call :func:`valid` when they're done with it, to make sure it wasn't
+    overwritten while they were using it.
+
+    Each slot can also hold a small JSON-able dict of metadata, up to ``meta_size`` bytes encoded.
+
+    Layout of the shared block:
+     - head: int64, the last sequence number written, -1 if nothing has been written
+     - seqs: int64[slots], the sequence number held by each slot, -1 while it's being written
+     - captured: int64[slots], capture timestamps, in microseconds
+     - meta_lens: int64[slots], the length of the encoded metadata
+     - frames: uint8[slots, height, width, channels]
+     - meta: uint8[slots, meta_size]
+
+    Passing it to a ``Process`` is fine. It is re-attached by name on the other side.
+    """
+
+    def __init__(self, shape, slots=4, name=None, meta_size=0):
+        """
+        Creates a new buffer, or attaches to an existing one.
+
+        :param shape: the frame shape, as (height, width, channels)
+        :param slots: the number of frames kept
+        :param name: the name of an existing buffer to attach to. If None, a new one is created.
+        :param meta_size: the most metadata, in bytes, each slot can hold
+        """
+
+        self.shape = tuple(int(x) for x in shape)
+        self.slots = int(slots)
+        self.meta_size = int(meta_size)
+
+        if self.slots < 2:
+            raise ValueError('At least two frame slots are required')
+
+        self.frame_size = int(np.prod(self.shape))
+        header_size = (1 + 3 * self.slots) * 8
+        frames_size = self.slots * self.frame_size
+
+        self._owner = name is None
+
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(
+                create=True,
+                size=header_size + frames_size + self.slots * self.meta_size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+
+        self.name = self._shm.name
+
+        header = np.ndarray((1 + 3 * self.slots,), dtype=np.int64, buffer=self._shm.buf)
+
+        self._head = header[0:1]
+        self._seqs = header[1:1 + self.slots]
+        self._captured = header[1 + self.slots:1 + 2 * self.slots]
+        self._meta_lens = header[1 + 2 * self.slots:]
+
+        self._frames = np.ndarray(
+            (self.slots,) + self.shape,
+            dtype=np.uint8,
+            buffer=self._shm.buf,
+            offset=header_size)
+
+        self._meta = np.ndarray(
+            (self.slots, self.meta_size),
+            dtype=np.uint8,
+            buffer=self._shm.buf,
+            offset=header_size + frames_size)
+
+        if self._owner:
+            header[:] = -1
+            log.info('Created {} slot frame buffer {} for {}'.format(self.slots, self.name, self.shape))
+
+    def __getstate__(self):
+        return {
+            'name': self.name,
+            'shape': self.shape,
+            'slots': self.slots,
+            'meta_size': self.meta_size
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state['shape'], state['slots'], name=state['name'], meta_size=state['meta_size'])
+
+    @property
+    def head(self):
+        """
+        The last sequence number written, -1 if nothing has been written yet.
+        """
+        return int(self._head[0])
+
+    def write(self, cv_image, captured: datetime, meta: dict = None):
+        """
+        Copies the image into the next slot. Only the writer should call this.
+
+        :param cv_image: CV image, must match ``shape``
+        :param captured: capture datetime
+        :param meta: optional JSON-able dict, stored with the frame
+        :return: the sequence number of the frame
+        """
+
+        if cv_image.shape != self.shape:
+            raise ValueError('Frame shape {} does not match buffer {}'.format(cv_image.shape, self.shape))
+
+        meta_bytes = b''
+        if meta is not None:
+            meta_bytes = json.dumps(meta).encode('utf-8')
+            if len(meta_bytes) > self.meta_size:
+                raise ValueError('Frame metadata is {} bytes, the limit is {}'.format(
+                    len(meta_bytes), self.meta_size))
+
+        seq = self.head + 1
+        slot = seq % self.slots
+
+        # mark it as in-progress, so readers don't trust it
+        self._seqs[slot] = -1
+        np.copyto(self._frames[slot], cv_image)
+        self._captured[slot] = dt_to_usec(captured)
+
+        meta_len = len(meta_bytes)
+        self._meta[slot, :meta_len] = np.frombuffer(meta_bytes, dtype=np.uint8)
+        self._meta_lens[slot] = meta_len
+
+        self._seqs[slot] = seq
+
+        self._head[0] = seq
+
+        return seq
+
+    def valid(self, seq):
+        """
+        Checks that the frame is still in its slot.
+
+        :param seq: frame sequence number
+        :return: True if it has not been overwritten
+        """
+        if seq < 0:
+            return False
+
+        return int(self._seqs[seq % self.slots]) == seq
+
+    def frame(self, seq):
+        """
+        Maps a frame without copying it.
+
+        :param seq: frame sequence number
+        :return: tuple of (read-only view, capture datetime), or None if the frame has been overwritten
+        """
+
+        if not self.valid(seq):
+            return None
+
+        slot = seq % self.slots
+
+        captured = usec_to_dt(self._captured[slot])
+        view = self._frames[slot].view()
+        view.flags.writeable = False
+
+        # it may have been replaced while we were looking
+        if not self.valid(seq):
+            return None
+
+        return view, captured
+
+    def meta(self, seq):
+        """
+        The metadata stored with a frame.
+
+        :param seq: frame sequence number
+        :return: dict, empty if there isn't any. None if the frame has been overwritten.
+        """
+
+        if not self.valid(seq):
+            return None
+
+        slot = seq % self.slots
+        meta_bytes = self._meta[slot, :self._meta_lens[slot]].tobytes()
+
+        if not self.valid(seq):
+            return None
+
+        if len(meta_bytes) == 0:
+            return {}
+
+        return json.loads(meta_bytes.decode('utf-8'))
+
+    def latest(self):
+        """
+        Maps the newest frame.
+
+        :return: tuple of (seq, view, capture datetime), or None if there isn't one
+        """
+
+        seq = self.head
+        ret = self.frame(seq)
+        if ret is None:
+            return None
+
+        return (seq,) + ret
+
+    def close(self):
+        """
+        Detaches from the shared block. Views returned by :func:`frame` are invalid after this.
+        """
+        self._head = None
+        self._seqs = None
+        self._captured = None
+        self._meta_lens = None
+        self._frames = None
+        self._meta = None
+        self._shm.close()
+
+    def unlink(self):
+        """
+        Releases the shared block. Only the creator should call this, once everything is shut down.
+        """
+        if self._owner:
+            log.info('Releasing frame buffer {}'.format(self.name))
+            self._shm.unlink()
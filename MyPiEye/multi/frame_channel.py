@@ -0,0 +1,257 @@
+import logging
+import multiprocessing
+from time import monotonic
+from datetime import datetime
+
+from MyPiEye.multi.frame_buffer import FrameRingBuffer
+
+log = logging.getLogger(__name__)
+
+# only the newest frame is delivered, anything older is dropped
+LAG_LATEST = 'latest'
+
+# up to ``backlog`` frames are kept for the consumer, older ones are dropped
+LAG_BACKLOG = 'backlog'
+
+# the camera waits for the consumer rather than overwrite a frame it hasn't read
+LAG_BLOCK = 'block'
+
+LAG_POLICIES = (LAG_LATEST, LAG_BACKLOG, LAG_BLOCK)
+
+
+class FrameCursor(object):
+    """
+    A consumer's read position in a :class:`FrameChannel`.
+
+    All of the processes for one backend share the cursor, so each frame is claimed by only one of them.
+    """
+
+    def __init__(self, channel, name, policy, backlog):
+        self.channel = channel
+        self.name = name
+        self.policy = policy
+        self.backlog = backlog
+
+        # guarded by the channel condition
+        self._next = multiprocessing.RawValue('q', 0)
+        self._delivered = multiprocessing.RawValue('q', 0)
+        self._dropped = multiprocessing.RawValue('q', 0)
+
+    @property
+    def next_seq(self):
+        return self._next.value
+
+    @property
+    def delivered(self):
+        return self._delivered.value
+
+    @property
+    def dropped(self):
+        return self._dropped.value
+
+    def claim(self, timeout=None):
+        """
+        Waits for a frame, and claims it according to the lag policy. Frames skipped over are counted as dropped.
+
+        :param timeout: seconds to wait, None to wait forever
+        :return: the sequence number, or None on timeout
+        """
+
+        channel = self.channel
+        slots = channel.frames.slots
+
+        with channel.cond:
+            while True:
+                head = channel.head
+                nxt = self._next.value
+
+                if head >= nxt:
+                    if self.policy == LAG_LATEST:
+                        seq = head
+                    elif self.policy == LAG_BACKLOG:
+                        seq = max(nxt, head - self.backlog + 1)
+                    else:
+                        # anything older has already been overwritten
+                        seq = max(nxt, head - slots + 1)
+
+                    self._dropped.value += seq - nxt
+                    self._delivered.value += 1
+                    self._next.value = seq + 1
+
+                    # nobody else is holding on to the skipped JPEGs for us
+                    if seq > nxt and channel.jpegs is not None:
+                        channel.jpegs.skip(self.name, nxt, seq)
+
+                    # the camera may be waiting on us
+                    if self.policy == LAG_BLOCK:
+                        channel.cond.notify_all()
+
+                    return seq
+
+                if not channel.cond.wait(timeout):
+                    return None
+
+    def get(self, timeout=None):
+        """
+        Claims the next frame and maps it.
+
+        :param timeout: seconds to wait, None to wait forever
+        :return: tuple of (seq, read-only view, capture datetime), or None on timeout
+        """
+
+        deadline = None
+        if timeout is not None:
+            deadline = monotonic() + timeout
+
+        while True:
+            wait_time = None
+            if deadline is not None:
+                wait_time = max(0, deadline - monotonic())
+
+            seq = self.claim(wait_time)
+            if seq is None:
+                return None
+
+            frame = self.channel.frames.frame(seq)
+            if frame is not None:
+                return (seq,) + frame
+
+            # overwritten between the claim and the read
+            with self.channel.cond:
+                self._delivered.value -= 1
+                self._dropped.value += 1
+
+            if self.channel.jpegs is not None:
+                self.channel.jpegs.skip(self.name, seq, seq + 1)
+
+            log.warning('{}: frame {} was overwritten before it was read'.format(self.name, seq))
+
+
+class FrameChannel(object):
+    """
+    Tells consumers when there is a new frame in a :class:`FrameRingBuffer`.
+
+    Frames are identified by their sequence number. Each consumer has its own cursor, so a slow uploader
+    only affects itself. How a consumer that falls behind is handled depends on its lag policy:
+
+     - ``latest``: skip ahead to the newest frame
+     - ``backlog``: keep up to ``backlog`` frames, skip anything older
+     - ``block``: the camera waits, up to ``block_timeout`` seconds, before overwriting a frame the consumer
+       hasn't finished with. A consumer is finished with a frame once it claims the next one, so only
+       one process can read from a ``block`` cursor.
+
+    Consumers must be added before the processes are started.
+    """
+
+    def __init__(self, frames: FrameRingBuffer, block_timeout=5.0):
+        """
+        :param frames: the shared frames
+        :param block_timeout: the longest the camera will wait on a ``block`` consumer, in seconds
+        """
+
+        self.frames = frames
+        self.block_timeout = block_timeout
+
+        self.cond = multiprocessing.Condition()
+        self._head = multiprocessing.RawValue('q', -1)
+
+        self.cursors = {}
+
+        # encoded copies of the frames, shared by the backends. See ``JpegCache``.
+        self.jpegs = None
+
+    @property
+    def head(self):
+        """
+        The last sequence number published, -1 if there hasn't been one.
+        """
+        return self._head.value
+
+    def add_consumer(self, name, policy=LAG_LATEST, backlog=1):
+        """
+        Adds a consumer with its own cursor.
+
+        :param name: consumer name, typically the backend
+        :param policy: one of ``LAG_POLICIES``
+        :param backlog: the number of frames kept for ``backlog`` consumers. Limited by the number of frame slots.
+        :return: the ``FrameCursor``
+        """
+
+        if policy not in LAG_POLICIES:
+            raise ValueError('Unknown lag policy {} for {}'.format(policy, name))
+
+        # the slot being written can't be read
+        max_backlog = self.frames.slots - 1
+        backlog = int(backlog)
+
+        if backlog > max_backlog:
+            log.warning('{}: backlog of {} is more than the {} frame slots allow. Using {}.'.format(
+                name, backlog, self.frames.slots, max_backlog))
+            backlog = max_backlog
+
+        backlog = max(1, backlog)
+
+        cursor = FrameCursor(self, name, policy, backlog)
+        self.cursors[name] = cursor
+
+        log.info('Added frame consumer {} ({}, backlog {})'.format(name, policy, backlog))
+
+        return cursor
+
+    def _writable(self, seq):
+        # a block consumer is done with a frame once it has claimed the one after it
+        overwritten = seq - self.frames.slots
+        if overwritten < 0:
+            return True
+
+        for cursor in self.cursors.values():
+            if cursor.policy == LAG_BLOCK and cursor.next_seq <= overwritten + 1:
+                return False
+
+        return True
+
+    def put(self, cv_image, captured: datetime, meta: dict = None):
+        """
+        Stores the frame, and notifies the consumers. Only the producer (camera, or motion detection)
+        should call this.
+
+        :param cv_image: CV image
+        :param captured: capture datetime
+        :param meta: optional metadata, see :func:`FrameRingBuffer.write`
+        :return: the sequence number of the frame
+        """
+
+        seq = self.frames.head + 1
+
+        with self.cond:
+            if not self.cond.wait_for(lambda: self._writable(seq), self.block_timeout):
+                log.warning('Timed out waiting on blocking consumers, overwriting frame {}'.format(
+                    seq - self.frames.slots))
+
+        self.frames.write(cv_image, captured, meta)
+
+        with self.cond:
+            self._head.value = seq
+            self.cond.notify_all()
+
+        return seq
+
+    def stats(self):
+        """
+        Per-consumer counters.
+
+        :return: dict of consumer name to a dict of ``delivered``, ``dropped``, and ``lag``
+        """
+
+        ret = {}
+
+        with self.cond:
+            head = self.head
+            for name, cursor in self.cursors.items():
+                ret[name] = {
+                    'delivered': cursor.delivered,
+                    'dropped': cursor.dropped,
+                    'lag': max(0, head - cursor.next_seq + 1)
+                }
+
+        return ret
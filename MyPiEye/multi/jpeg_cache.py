@@ -0,0 +1,288 @@
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from MyPiEye.encoder import JpegEncoder
+
+log = logging.getLogger(__name__)
+
+# slot states
+_FREE = 0
+_ENCODING = 1
+_READY = 2
+
+# per-slot header fields
+_SEQ = 0
+_PROFILE = 1
+_STATE = 2
+_LENGTH = 3
+_PENDING = 4
+_FIELDS = 5
+
+
+class JpegCache(object):
+    """
+    Encoded JPEGs of the frames in a :class:`FrameChannel`, shared by all of the storage backends.
+
+    The first backend to ask for a frame in a given profile encodes it, the rest get a read-only view of the same bytes.
+    Each profile has a set of subscribers. An entry is released once every subscriber has called :func:`ack`,
+    or skipped the frame (see :func:`skip`). Subscribers whose cursor had already passed the frame when it was
+    encoded aren't waited on, unless they ask for it. Until then the slot is never reused, since a subscriber may
+    still be reading its view. If every slot is in use, frames are encoded without caching.
+
+    A frame is checked against the frame buffer after it's encoded, so a frame the camera overwrote
+    part way through is never cached or returned.
+
+    Layout of the shared block:
+     - header: int64[slots, 5], the seq, profile index, state, length, and bitmask of pending subscribers
+     - data: uint8[slots, max_bytes]
+
+    Like :class:`FrameChannel`, it's passed to the processes when they're started, and re-attached by name.
+    """
+
+    def __init__(self, channel, encoder: JpegEncoder, subscribers: dict, slots=None, max_bytes=None):
+        """
+        :param channel: the ``FrameChannel`` the frames come from
+        :param encoder: the encoder, with the profiles
+        :param subscribers: dict of profile name to a list of consumer names
+        :param slots: the number of encoded frames kept. Defaults to the frame slots times the number of profiles used.
+        :param max_bytes: the largest JPEG a slot can hold. Defaults to half the size of the raw frame, plus headers.
+        """
+
+        self.channel = channel
+        self.encoder = encoder
+        self._profile_names = sorted(encoder.profiles.keys())
+
+        # a bit for each consumer
+        consumers = sorted(set(name for names in subscribers.values() for name in names))
+        self._bits = {name: 1 << x for x, name in enumerate(consumers)}
+
+        self._masks = {}
+        for profile, names in subscribers.items():
+            if profile not in encoder.profiles:
+                raise ValueError('Unknown JPEG profile {}'.format(profile))
+            self._masks[profile] = sum(self._bits[name] for name in set(names))
+
+        frames = channel.frames
+
+        if slots is None:
+            slots = frames.slots * max(1, len(subscribers))
+        self.slots = int(slots)
+
+        if max_bytes is None:
+            # JPEGs are much smaller than the raw frame. Anything larger is encoded without caching.
+            max_bytes = frames.frame_size // 2 + 65536
+        self.max_bytes = int(max_bytes)
+
+        self.cond = multiprocessing.Condition()
+
+        self._shm = shared_memory.SharedMemory(
+            create=True,
+            size=self.slots * (_FIELDS * 8 + self.max_bytes))
+        self._owner = True
+
+        self._attach()
+        self._header[:] = -1
+        self._header[:, _STATE] = _FREE
+
+        log.info('Created {} slot JPEG cache {} for {}'.format(self.slots, self._shm.name, consumers))
+
+    def _attach(self):
+        self._header = np.ndarray((self.slots, _FIELDS), dtype=np.int64, buffer=self._shm.buf)
+        self._data = np.ndarray(
+            (self.slots, self.max_bytes),
+            dtype=np.uint8,
+            buffer=self._shm.buf,
+            offset=self.slots * _FIELDS * 8)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = self._shm.name
+        state['_owner'] = False
+        del state['_header']
+        del state['_data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=state['_shm'])
+        self._attach()
+
+    def _find(self, seq, profile_idx):
+        hits = np.nonzero(
+            (self._header[:, _SEQ] == seq) &
+            (self._header[:, _PROFILE] == profile_idx) &
+            (self._header[:, _STATE] != _FREE))[0]
+
+        if len(hits) == 0:
+            return None
+
+        return int(hits[0])
+
+    def _claim(self):
+        """
+        Picks a slot to encode into. Must hold ``cond``.
+        """
+
+        states = self._header[:, _STATE]
+
+        free = np.nonzero(states == _FREE)[0]
+        if len(free) > 0:
+            return int(free[0])
+
+        # nobody is waiting on these, e.g. a profile without subscribers
+        unused = np.nonzero((states == _READY) & (self._header[:, _PENDING] == 0))[0]
+        if len(unused) > 0:
+            return int(unused[np.argmin(self._header[unused, _SEQ])])
+
+        # the rest may still be being read
+        log.warning('JPEG cache is full, encoding frame without caching')
+
+        return None
+
+    def _mask(self, seq, profile, consumer):
+        """
+        The subscribers a new entry waits on. Must hold ``cond``.
+        """
+
+        mask = self._masks.get(profile, 0)
+
+        # they moved past it without asking for it, so they'll never ack it
+        for name, cursor in self.channel.cursors.items():
+            if name != consumer and cursor.next_seq > seq:
+                mask &= ~self._bits.get(name, 0)
+
+        return mask
+
+    def _view(self, slot):
+        view = self._data[slot, :self._header[slot, _LENGTH]].view()
+        view.flags.writeable = False
+        return view
+
+    def get(self, seq, cv_image, profile, consumer=None):
+        """
+        The frame as a JPEG. It's encoded if nobody has asked for it yet. Call :func:`ack` once it's been used.
+
+        :param seq: frame sequence number
+        :param cv_image: the frame, from the channel
+        :param profile: profile name
+        :param consumer: the consumer asking, so the entry is kept until it acks
+        :return: read-only uint8 array of the JPEG, or None if encoding failed or the frame was overwritten
+        """
+
+        profile_idx = self._profile_names.index(profile)
+
+        # only if it's subscribed to the profile
+        bit = self._bits.get(consumer, 0) & self._masks.get(profile, 0)
+
+        with self.cond:
+            while True:
+                slot = self._find(seq, profile_idx)
+
+                if slot is None:
+                    slot = self._claim()
+                    if slot is None:
+                        # everything is in use, don't wait on it
+                        break
+
+                    self._header[slot] = (seq, profile_idx, _ENCODING, 0, self._mask(seq, profile, consumer))
+                    break
+
+                if self._header[slot, _STATE] == _READY:
+                    # left out when it was encoded if another process for this consumer had claimed a later frame
+                    self._header[slot, _PENDING] |= bit
+                    return self._view(slot)
+
+                self.cond.wait()
+
+        jpg = self.encoder.encode(cv_image, profile)
+
+        # the camera may have overwritten it while it was being encoded
+        if jpg is not None and not self.channel.frames.valid(seq):
+            log.warning('Frame {} was overwritten while it was encoded, dropping it'.format(seq))
+            jpg = None
+
+        if slot is None:
+            return jpg
+
+        with self.cond:
+            if jpg is None or len(jpg) > self.max_bytes:
+                if jpg is not None:
+                    log.warning('JPEG of frame {} is {} bytes, too large to cache'.format(seq, len(jpg)))
+                self._header[slot, _STATE] = _FREE
+                self.cond.notify_all()
+                return jpg
+
+            self._data[slot, :len(jpg)] = jpg
+            self._header[slot, _LENGTH] = len(jpg)
+            self._header[slot, _STATE] = _READY
+            self.cond.notify_all()
+
+            return self._view(slot)
+
+    def ack(self, seq, profile, consumer):
+        """
+        Marks the JPEG as used by ``consumer``. Once every subscriber has, the slot is released.
+
+        :param seq: frame sequence number
+        :param profile: profile name
+        :param consumer: consumer name
+        :return: None
+        """
+
+        profile_idx = self._profile_names.index(profile)
+
+        with self.cond:
+            slot = self._find(seq, profile_idx)
+            if slot is None or self._header[slot, _STATE] != _READY:
+                return
+
+            self._header[slot, _PENDING] &= ~self._bits.get(consumer, 0)
+
+            if self._header[slot, _PENDING] == 0:
+                self._header[slot, _STATE] = _FREE
+
+    def skip(self, consumer, first, last):
+        """
+        Acks every JPEG from ``first`` up to, but not including, ``last``, in all profiles.
+        Called by the frame cursor when the consumer skips frames.
+
+        :param consumer: consumer name
+        :param first: first skipped sequence number
+        :param last: the sequence number after the last one skipped
+        :return: None
+        """
+
+        bit = self._bits.get(consumer, 0)
+        if bit == 0:
+            return
+
+        with self.cond:
+            seqs = self._header[:, _SEQ]
+            states = self._header[:, _STATE]
+
+            # including those still being encoded, or they'd never be released
+            skipped = (seqs >= first) & (seqs < last) & (states != _FREE)
+            if not skipped.any():
+                return
+
+            self._header[skipped, _PENDING] &= ~bit
+            self._header[skipped & (states == _READY) & (self._header[:, _PENDING] == 0), _STATE] = _FREE
+
+    def close(self):
+        """
+        Detaches from the shared block.
+        """
+        self._header = None
+        self._data = None
+        self._shm.close()
+
+    def unlink(self):
+        """
+        Releases the shared block. Only the creator should call this.
+        """
+        if self._owner:
+            log.info('Releasing JPEG cache {}'.format(self._shm.name))
+            self._shm.unlink()
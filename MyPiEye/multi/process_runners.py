@@ -1,5 +1,6 @@
 import multiprocessing
 import logging
+from functools import partial
 
 from time import sleep
 from datetime import datetime
@@ -8,8 +9,14 @@ import MyPiEye.CeleryTasks
 
 import redis
 import cv2
+import numpy as np
 
 from MyPiEye.usbcamera import UsbCamera
+from MyPiEye.motion_detect import MotionDetect
+from MyPiEye.detect_scheduler import DetectScheduler
+from MyPiEye.multi.frame_channel import FrameChannel
+from MyPiEye.multi.upload_engine import UploadEngine
+from MyPiEye.encoder import JpegEncoder, ARCHIVE
 from MyPiEye.Storage.azure_blob import AzureBlobStorage
 from MyPiEye.Storage.minio_storage import MinioStorage
 from MyPiEye.Storage.local_storage import LocalStorage
@@ -21,12 +28,47 @@ log = logging.getLogger(__name__)
 # log.setLevel(logging.DEBUG)
 
 
-def camera_start(config, shared_obj, shared_lock, msg_queues: dict):
+def frame_jpeg(config, channel: FrameChannel, seq, imgbuf, consumer=None, profile=ARCHIVE):
+    """
+    The frame as a JPEG, from the shared cache if there is one. Pass it to :func:`frame_done` when finished.
+
+    :param config: the global config, for the encoder settings if there's no cache
+    :param channel: the frame channel
+    :param seq: frame sequence number
+    :param imgbuf: the frame
+    :param consumer: the consumer name, see :func:`JpegCache.get`
+    :param profile: the JPEG profile
+    :return: uint8 array of the JPEG, or None if encoding failed or the frame was overwritten
+    """
+
+    if channel.jpegs is not None:
+        return channel.jpegs.get(seq, imgbuf, profile, consumer)
+
+    jpg = JpegEncoder(config).encode(imgbuf, profile)
+
+    # the camera may have overwritten it while it was being encoded
+    if not channel.frames.valid(seq):
+        log.warning('Frame {} was overwritten while it was encoded, dropping it'.format(seq))
+        return None
+
+    return jpg
+
+
+def frame_done(channel: FrameChannel, seq, consumer, profile=ARCHIVE):
+    """
+    Lets the shared cache know ``consumer`` is done with the frame's JPEG.
+    """
+
+    if channel.jpegs is not None:
+        channel.jpegs.ack(seq, profile, consumer)
+
+
+def camera_start(config, shared_obj, channel: FrameChannel):
     """
 
     :param config: The global config
-    :param shared_obj: Where to store the pics and metadata
-    :param msg_queues: Queues to notify when a picture is ready
+    :param shared_obj: Shared locks and such
+    :param channel: Where to store the pics, and notify when they're ready
     :return:
     """
 
@@ -46,7 +88,16 @@ def camera_start(config, shared_obj, shared_lock, msg_queues: dict):
         return
 
     time_delay = cam_config.get('time_delay', '0')
-    time_delay = int(time_delay)
+    time_delay = float(time_delay)
+
+    frames = channel.frames
+
+    # (width, height), for cv2.resize
+    frame_size = (frames.shape[1], frames.shape[0])
+    size_warned = False
+
+    # when the last frame published was grabbed
+    last_dt = None
 
     try:
         camera = UsbCamera(config)
@@ -56,30 +107,35 @@ def camera_start(config, shared_obj, shared_lock, msg_queues: dict):
         while ok:
 
             log.debug('capturing {}'.format(datetime.utcnow()))
-            img = camera.get_image()
 
-            if img is not None:
-                dtsrt = datetime.now()
+            # stamped when it was grabbed, not when we got to it
+            img, dtsrt = camera.get_frame()
 
-                # with shared_obj['lock']:
+            if img is not None and dtsrt == last_dt:
+                # nothing new within grab_timeout, the camera counts it in its duplicates
+                log.debug('No new frame since {}'.format(dtsrt))
+
+            elif img is not None:
                 log.debug('captured {}'.format(dtsrt))
 
                 if log.level == logging.DEBUG:
                     # so it stands out
                     print('\ncaptured {}\n'.format(dtsrt))
 
-                with shared_lock:
-                    shared_obj['imgbuf'] = img.copy()
-                    shared_obj['img_captured'] = dtsrt
+                # the camera doesn't always honor the requested resolution
+                if img.shape != frames.shape:
+                    if not size_warned:
+                        log.warning('Camera returned {}, resizing to {}'.format(img.shape, frames.shape))
+                        size_warned = True
+                    img = cv2.resize(img, frame_size)
+
+                seq = channel.put(img, dtsrt)
+                last_dt = dtsrt
 
-                for val in msg_queues.values():
-                    try:
-                        val.put({'dt': dtsrt}, False)
-                    except Exception as e:
-                        log.warning('Skipping frame for queue')
-                        continue
+                log.info('captured image {} at {}'.format(seq, dtsrt))
 
-                log.info('captured image at {}'.format(dtsrt))
+                if seq > 0 and seq % 1000 == 0:
+                    log.info('Camera grab stats: {}'.format(camera.stats()))
             else:
                 log.error('Failed to get image')
 
@@ -90,18 +146,93 @@ def camera_start(config, shared_obj, shared_lock, msg_queues: dict):
         if camera is not None:
             camera.close_camera()
 
-def celery_start(config, shared_obj, shared_lock, storage_queues: dict):
+
+def motion_start(config, shared_obj, channel: FrameChannel, motion_channel: FrameChannel):
+    """
+    Watches the camera frames for motion. Frames with motion are copied to ``motion_channel``,
+    along with their ``ImageCapture`` metadata. Everything else is dropped.
+
+    Quiet scenes are checked less often, see :class:`DetectScheduler`. Frames skipped in between
+    are counted as dropped by the cursor.
+
+    :param config: The global config
+    :param shared_obj: Shared locks and such
+    :param channel: The camera frames
+    :param motion_channel: Where to put the frames with motion
+    :return:
+    """
+
+    lvl = get_config_value(config, 'global', 'loglevel', 'LOG_LEVEL')
+    fmt = get_config_value(config, 'global', 'log_format', 'LOG_FORMAT')
+    enable_log(fmt=fmt)
+    set_loglevel(lvl)
+
+    cursor = channel.cursors.get('motion')
+    if cursor is None:
+        log.error('No frame cursor for motion detection')
+        sleep(1)
+        return
+
+    camid = get_config_value(config, 'camera', 'camera_id', 'CAMERA_ID', 'unknown/unknown')
+
+    motion_detect = MotionDetect(config)
+    scheduler = DetectScheduler(config)
+
+    log.info('Starting motion detection loop')
+
+    while True:
+
+        delay = scheduler.delay()
+        if delay > 0:
+            sleep(delay)
+
+        # blocks until a frame is ready
+        seq, imgbuf, curdt = cursor.get()
+        scheduler.frame(seq, curdt)
+
+        started = scheduler.start()
+        img_capture = motion_detect.motions(imgbuf)
+        scheduler.finish(started, img_capture is not None)
+
+        if img_capture is None:
+            continue
+
+        # copied before it's checked, putting it may wait on a blocking consumer
+        img = imgbuf.copy()
+
+        # the camera may have lapped the buffer while it was being checked
+        if not channel.frames.valid(seq):
+            log.warning('Frame {} was overwritten during motion detection, dropping it'.format(seq))
+            continue
+
+        # use the camera time, not the comparison time
+        img_capture.capture_dt = curdt
+        img_capture.cam_id = camid
+
+        log.info('Motion detected in frame {} at {}: {} boxes'.format(
+            seq, curdt, len(img_capture.motions)))
+
+        try:
+            motion_channel.put(img, curdt, img_capture.to_meta())
+        except ValueError as e:
+            # too many boxes to fit
+            log.warning(e)
+            img_capture.motions = np.sort(img_capture.motions, order='size')[::-1][:100]
+            motion_channel.put(img, curdt, img_capture.to_meta())
+
+
+def celery_start(config, shared_obj, channel: FrameChannel):
 
     MyPiEye.CeleryTasks.app_config = config
 
     celery_storage = CeleryStorage(config)
-    celery_storage.start(shared_obj, shared_lock, storage_queues)
+    celery_storage.start(channel)
 
 
-def minio_start(config, shared_obj, storage_queues: dict):
-    pri_storage_queue = storage_queues.get('minio')
-    if pri_storage_queue is None:
-        log.error('No message queue for minio')
+def minio_start(config, shared_obj, channel: FrameChannel):
+    cursor = channel.cursors.get('minio')
+    if cursor is None:
+        log.error('No frame cursor for minio')
         sleep(1)
         return
 
@@ -115,27 +246,23 @@ def minio_start(config, shared_obj, storage_queues: dict):
 
     while True:
 
-        # blocks until a message is ready
-        dt_pic = pri_storage_queue.get()
-        with shared_obj['lock']:
-            curdt: datetime = shared_obj['img_captured']
-            imgbuf = shared_obj['imgbuf']
-
-        # if the current image datetime doesn't match the message
-        # then this message is stale. We can skip it and pull the next.
-        if curdt != dt_pic['dt']:
-            continue
+        # blocks until a frame is ready
+        seq, imgbuf, curdt = cursor.get()
 
         log.debug('Storing image on minio: {}'.format(curdt.isoformat()))
 
-        mio.upload(imgbuf, curdt, camid)
+        jpg = frame_jpeg(config, channel, seq, imgbuf, 'minio')
+        if jpg is not None:
+            mio.upload_jpeg(jpg, curdt, camid)
+
+        frame_done(channel, seq, 'minio')
 
         sleep(.01)
 
-def local_start(config, shared_obj, storage_queues: dict):
-    storage_q = storage_queues.get('local')
-    if storage_q is None:
-        log.error('No queue found for local storage')
+def local_start(config, shared_obj, channel: FrameChannel):
+    cursor = channel.cursors.get('local')
+    if cursor is None:
+        log.error('No frame cursor for local storage')
         sleep(1)
         return
 
@@ -145,46 +272,44 @@ def local_start(config, shared_obj, storage_queues: dict):
 
     while True:
 
-        # blocks until a message is ready
-        dt_pic = storage_q.get()
-        with shared_obj['lock']:
-            curdt: datetime = shared_obj['img_captured']
-            imgbuf = shared_obj['imgbuf']
-
-        # if the current image datetime doesn't match the message
-        # then this message is stale. We can skip it and pull the next.
-        if curdt != dt_pic['dt']:
-            continue
+        # blocks until a frame is ready
+        seq, imgbuf, curdt = cursor.get()
 
         log.debug('Storing image {}'.format(curdt.isoformat()))
 
-        local_storage.upload(imgbuf, curdt, camid)
+        jpg = frame_jpeg(config, channel, seq, imgbuf, 'local')
+        if jpg is not None:
+            local_storage.upload_jpeg(jpg, curdt, camid)
 
+        frame_done(channel, seq, 'local')
 
 
 
 
-def azblob_start(config, shared_obj, **kwargs):
+
+def azblob_start(config, shared_obj, channel: FrameChannel):
     """
     Saves the current image to an Azure blob.
     The config should have a ``azure_blob`` section.
     set [multi] key ``azure_blob`` to ``True`` to enable.
 
-    This one just goes as fast as it can. It doesn't use a queue.
-
     :param config:
     :param shared_obj:
-    :param kwargs: Ignored.
+    :param channel: Shared camera frames
     :return:
     """
 
+    cursor = channel.cursors.get('azure')
+    if cursor is None:
+        log.error('No frame cursor for Azure Blob')
+        sleep(1)
+        return
+
     azblob = AzureBlobStorage(config)
     if not azblob.check():
         log.error('Failed to intialize Azure Blob storage')
         return
 
-    last_captime: datetime = shared_obj['img_captured']
-
     camconfig = config.get('camera', None)
     if camconfig is None:
         log.error('No camera config')
@@ -194,30 +319,33 @@ def azblob_start(config, shared_obj, **kwargs):
 
     while True:
 
-        curdt: datetime = shared_obj['img_captured']
-        if curdt != last_captime:
-            with shared_obj['lock']:
-                imgbuf = shared_obj['imgbuf']
-
-            (ok, jpg) = cv2.imencode('.jpg', imgbuf)
+        # blocks until a frame is ready
+        seq, imgbuf, curdt = cursor.get()
 
-            if ok:
-                azblob.upload(jpg, curdt, camid)
+        jpg = frame_jpeg(config, channel, seq, imgbuf, 'azure')
 
-            last_captime = curdt
+        if jpg is not None:
+            azblob.upload(jpg, curdt, camid)
 
-        sleep(.1)
+        frame_done(channel, seq, 'azure')
 
 
-def redis_start(config, shared_obj, storage_queues: dict):
+def redis_start(config, shared_obj, channel: FrameChannel):
     """
     Saves the current image to a file, for a webserver
     :param config: Global config
-    :param shared_obj: Shared current image
+    :param shared_obj: Shared locks
+    :param channel: Shared camera frames
     :return:
     """
     try:
         log.info('running redis')
+        cursor = channel.cursors.get('redis')
+        if cursor is None:
+            log.error('No frame cursor for redis')
+            sleep(1)
+            return
+
         rconfig = config.get('redis', None)
 
         if not rconfig:
@@ -232,25 +360,115 @@ def redis_start(config, shared_obj, storage_queues: dict):
 
         rds = redis.Redis(host=rconfig['server_name'])
         print(rds.get('foo'))
-        last_captime: datetime = shared_obj['img_captured']
 
         while True:
-            curdt: datetime = shared_obj['img_captured']
-            if curdt != last_captime:
-                with shared_obj['lock']:
-                    imgbuf = shared_obj['imgbuf']
-
-                (ok, jpg) = cv2.imencode('.jpg', imgbuf)
-
-                if ok:
-                    camid = config.get('camera_id', 'unknown/unknown')
-                    dtstamp = last_captime.strftime('%Y%m%d/%H%M%S.%f')
-                    rkey = 'raw/{}/{}'.format(camid, dtstamp)
-
-                    with shared_obj['netlock']:
-                        log.info('Sending data to redis')
-                        rds.set(rkey, jpg.tostring())
-            sleep(.05)
+            # blocks until a frame is ready
+            seq, imgbuf, curdt = cursor.get()
+
+            jpg = frame_jpeg(config, channel, seq, imgbuf, 'redis')
+
+            if jpg is not None:
+                camid = config.get('camera_id', 'unknown/unknown')
+                dtstamp = curdt.strftime('%Y%m%d/%H%M%S.%f')
+                rkey = 'raw/{}/{}'.format(camid, dtstamp)
+
+                with shared_obj['netlock']:
+                    log.info('Sending data to redis')
+                    rds.set(rkey, jpg.tobytes())
+
+            frame_done(channel, seq, 'redis')
     except Exception as e:
         log.critical('Critical failure in imgsave')
         log.critical(e)
+
+
+def async_upload_start(config, shared_obj, channel: FrameChannel, backends):
+    """
+    Uploads to several backends from one process, see :class:`UploadEngine`.
+    Used instead of the per-backend processes when ``[multi] upload_engine`` is ``async``.
+
+    Each backend's ``max_concurrency`` setting limits how many of its uploads run at once.
+
+    :param config: Global config
+    :param shared_obj: Shared locks
+    :param channel: Shared camera frames
+    :param backends: consumer names: ``minio``, ``local``, ``azure``, or ``redis``
+    :return:
+    """
+
+    lvl = get_config_value(config, 'global', 'loglevel', 'LOG_LEVEL')
+    fmt = get_config_value(config, 'global', 'log_format', 'LOG_FORMAT')
+    enable_log(fmt=fmt)
+    set_loglevel(lvl)
+
+    camid = get_config_value(config, 'camera', 'camera_id', 'CAMERA_ID', 'unknown/unknown')
+
+    # consumer name: config section, environment variable prefix
+    sections = {
+        'minio': ('minio', 'MINIO'),
+        'local': ('local', 'LOCAL'),
+        'azure': ('azure_blob', 'AZBLOB'),
+        'redis': ('redis', 'REDIS')
+    }
+
+    uploaders = {}
+    limits = {}
+
+    for name in backends:
+        section, env_prefix = sections[name]
+
+        if name == 'minio':
+            mio = MinioStorage(config)
+            if not mio.check():
+                log.error('Failed to initialize minio storage')
+                continue
+
+            uploaders[name] = partial(upload_with, mio.upload_jpeg, camid)
+
+        elif name == 'local':
+            uploaders[name] = partial(upload_with, LocalStorage(config).upload_jpeg, camid)
+
+        elif name == 'azure':
+            azblob = AzureBlobStorage(config)
+            if not azblob.check():
+                log.error('Failed to intialize Azure Blob storage')
+                continue
+
+            uploaders[name] = partial(upload_with, azblob.upload, camid)
+
+        elif name == 'redis':
+            rconfig = config.get('redis', {})
+            if rconfig.get('server_name', None) is None:
+                log.error('Missing server_name in [redis] section')
+                continue
+
+            # thread safe, each upload thread gets its own connection from the pool
+            rds = redis.Redis(host=rconfig['server_name'])
+
+            uploaders[name] = partial(redis_upload, rds, shared_obj['netlock'], camid)
+
+        limits[name] = get_config_value(
+            config, section, 'max_concurrency', '{}_MAX_CONCURRENCY'.format(env_prefix), 4)
+
+    if not uploaders:
+        log.error('No upload backends')
+        sleep(1)
+        return
+
+    UploadEngine(config, channel, uploaders, limits).start()
+
+
+def upload_with(upload_jpeg, camid, jpg, curdt):
+    """
+    Adapts a backend's ``upload_jpeg(jpg, dt, camid)`` to :class:`UploadEngine`.
+    """
+    return upload_jpeg(jpg, curdt, camid)
+
+
+def redis_upload(rds, netlock, camid, jpg, curdt):
+    dtstamp = curdt.strftime('%Y%m%d/%H%M%S.%f')
+    rkey = 'raw/{}/{}'.format(camid, dtstamp)
+
+    with netlock:
+        log.info('Sending data to redis')
+        rds.set(rkey, jpg.tobytes())
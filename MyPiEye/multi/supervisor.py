@@ -8,15 +8,21 @@ import multiprocessing
 from multiprocessing import Process, Manager
 from multiprocessing.connection import wait
 
-from MyPiEye.motion_detect import MotionDetect
+from MyPiEye.usbcamera import UsbCamera
+from MyPiEye.multi.frame_buffer import FrameRingBuffer
+from MyPiEye.multi.frame_channel import FrameChannel, LAG_LATEST, LAG_BLOCK
+from MyPiEye.multi.jpeg_cache import JpegCache
+from MyPiEye.encoder import JpegEncoder, ARCHIVE
 
 from MyPiEye.multi.process_runners import \
     local_start, \
     camera_start, \
+    motion_start, \
     redis_start, \
     azblob_start, \
     minio_start, \
-    celery_start
+    celery_start, \
+    async_upload_start
 
 from MyPiEye.CLI import get_self_config_value, get_config_value, enable_log, set_loglevel
 
@@ -40,6 +46,20 @@ class Supervisor(object):
 
         self.process_infos = {}
 
+        # shared camera frames, created in ``start``
+        self.frames = None
+        self.channel = None
+
+        # frames with motion, when watching for motion
+        self.motion_frames = None
+        self.motion_channel = None
+
+        # encoded frames shared by the backends
+        self.jpegs = None
+
+        # the last reported dropped frame counts
+        self.dropped_frames = {}
+
     def main_loop(self):
         running = True
 
@@ -70,6 +90,8 @@ class Supervisor(object):
 
             wait(sents, 5)
 
+            self.log_frame_stats()
+
             sbrunning = len([v for v in self.process_infos.keys() if self.process_infos[v]['run_process']])
             isrunning = len([v for v in self.process_infos.keys() if
                              self.process_infos[v]['run_process'] and self.process_infos[v]['process'].is_alive()])
@@ -92,134 +114,268 @@ class Supervisor(object):
             self.config, 'multi', key_name, env_name, False) \
                in [True, 'True']
 
+    def log_frame_stats(self):
+        """
+        Logs consumers that have dropped frames since the last check.
+        """
+        for channel in [self.channel, self.motion_channel]:
+            if channel is None:
+                continue
+
+            for name, stats in channel.stats().items():
+                dropped = stats['dropped']
+                if dropped != self.dropped_frames.get(name, 0):
+                    log.warning('{} has dropped {} of {} frames, {} behind'.format(
+                        name, dropped, dropped + stats['delivered'], stats['lag']))
+                    self.dropped_frames[name] = dropped
+
+    def add_consumer(self, channel: FrameChannel, consumer_name, section_name, env_prefix, num_processes=1):
+        """
+        Adds a frame cursor for a backend. ``lag_policy`` and ``max_backlog`` are read from the
+        backend's section, falling back to the ``[multi]`` values.
+
+        :param channel: the camera frame channel
+        :param consumer_name: the name backends use to look up their cursor
+        :param section_name: the backend's config section
+        :param env_prefix: environment variable prefix, e.g. ``MINIO`` for ``MINIO_LAG_POLICY``
+        :param num_processes: the processes sharing the cursor
+        :return: the ``FrameCursor``
+        """
+
+        policy = None
+        backlog = None
+
+        if section_name in self.config:
+            policy = get_config_value(
+                self.config, section_name, 'lag_policy', '{}_LAG_POLICY'.format(env_prefix))
+            backlog = get_config_value(
+                self.config, section_name, 'max_backlog', '{}_MAX_BACKLOG'.format(env_prefix))
+
+        if policy is None:
+            policy = self.cfg('lag_policy', 'MULTI_LAG_POLICY', LAG_LATEST)
+
+        if backlog is None:
+            backlog = self.cfg('max_backlog', 'MULTI_MAX_BACKLOG', 1)
+
+        # the camera only waits until the next frame is claimed, which another process can do
+        # while the first is still reading its frame
+        if policy == LAG_BLOCK and num_processes > 1:
+            raise ValueError('lag_policy = {} needs a single process for {}, it has {}. '
+                             'Set num_processes = 1 in [{}], or use another lag_policy.'.format(
+                                 LAG_BLOCK, consumer_name, num_processes, section_name))
+
+        return channel.add_consumer(consumer_name, policy, int(backlog))
+
+    def init_jpeg_cache(self, channel: FrameChannel):
+        """
+        Sets up the shared JPEG cache for the backends that upload JPEGs, so each frame is only encoded once.
+
+        :param channel: the channel the backends read from
+        :return: the ``JpegCache``, or None if no backends need it or ``jpeg_cache_slots`` is 0
+        """
+
+        consumers = [name for name in ['minio', 'local', 'azure', 'redis', 'celery'] if name in channel.cursors]
+        if not consumers:
+            return None
+
+        # empty for the default, see ``JpegCache``
+        slots = self.cfg('jpeg_cache_slots', 'MULTI_JPEG_CACHE_SLOTS')
+        if slots in [None, '']:
+            slots = None
+        elif int(slots) <= 0:
+            log.info('JPEG cache is off, each backend encodes its own frames')
+            return None
+
+        channel.jpegs = JpegCache(channel, JpegEncoder(self.config), {ARCHIVE: consumers}, slots=slots)
+
+        return channel.jpegs
+
+    @property
+    def watch_for_motion(self):
+        return get_config_value(
+            self.config, 'camera', 'watch_for_motion', 'CAMERA_WATCH_FOR_MOTION', False) \
+               in [True, 'True']
+
     def init_process_infos(self,
                            shared_obj: multiprocessing.Manager,
-                           shared_lock: multiprocessing.Lock):
-
-        storage_queues = {}
+                           channel: FrameChannel,
+                           motion_channel: FrameChannel = None):
+        """
+        Sets up the processes. Backends read from ``motion_channel`` when it's set,
+        otherwise they get every frame from the camera.
+
+        :param shared_obj: Shared locks and such
+        :param channel: The camera frames
+        :param motion_channel: Frames with motion
+        :return:
+        """
+
+        backend_channel = channel
+        if motion_channel is not None:
+            backend_channel = motion_channel
+
+        def init_proc(proc_name: str, proc_func, run=True, args=None):
+            if args is None:
+                args = (self.config, shared_obj, backend_channel)
 
-        def init_proc(proc_name: str, proc_func, run=True):
             self.process_infos[proc_name] = {
                 'process': None,
                 'process_args': {
                     'name': proc_name,
                     'target': proc_func,
-                    'args': (self.config, shared_obj, shared_lock, storage_queues)
+                    'args': args
                 },
                 'run_process': run
             }
 
         if self.cfg('enable_camera', 'MULTI_ENABLE_CAMERA', False):
-            init_proc('camera', camera_start, True)
+            init_proc('camera', camera_start, True, (self.config, shared_obj, channel))
+
+        if motion_channel is not None:
+            self.add_consumer(channel, 'motion', 'camera', 'CAMERA')
+            init_proc('motion', motion_start, True, (self.config, shared_obj, channel, motion_channel))
 
         storage_proc_count = self.config['multi'].get('backend_processes', '1')
         storage_proc_count = int(storage_proc_count)
 
-        if self.is_enabled('enable_redis', 'MULTI_REDIS'):
-            storage_queues['redis'] = multiprocessing.Queue(maxsize=1)
+        # one process for all of the network backends, instead of processes for each
+        upload_engine = self.cfg('upload_engine', 'MULTI_UPLOAD_ENGINE', 'process')
+        if upload_engine == 'async':
+            async_backends = []
+
+            for name, key, env_name, section_name, env_prefix in [
+                ('redis', 'enable_redis', 'MULTI_REDIS', 'redis', 'REDIS'),
+                ('azure', 'enable_azure_blob', 'MULTI_AZBLOB', 'azure_blob', 'AZBLOB'),
+                ('minio', 'enable_minio', 'MULTI_MINIO', 'minio', 'MINIO'),
+                ('local', 'enable_local', 'MULTI_LOCAL', 'local', 'LOCAL')
+            ]:
+                if self.is_enabled(key, env_name):
+                    self.add_consumer(backend_channel, name, section_name, env_prefix)
+                    async_backends.append(name)
+
+            if async_backends:
+                log.info('Starting async uploads to {}'.format(', '.join(async_backends)))
+                init_proc('uploads', async_upload_start, True,
+                          (self.config, shared_obj, backend_channel, async_backends))
+
+        elif upload_engine != 'process':
+            log.error('Unknown upload_engine {}, should be process or async'.format(upload_engine))
+
+        # otherwise, processes for each backend
+        per_backend = upload_engine != 'async'
+
+        if per_backend and self.is_enabled('enable_redis', 'MULTI_REDIS'):
             pc = get_config_value(
                 self.config,
                 'redis',
                 'num_processes',
                 'REDIS_PROCS',
                 storage_proc_count)
+            pc = int(pc)
+
+            self.add_consumer(backend_channel, 'redis', 'redis', 'REDIS', pc)
 
             for x in range(1, pc + 1):
                 init_proc('redis_{}'.format(x), redis_start, True)
 
-        if self.is_enabled('enable_azure_blob', 'MULTI_AZBLOB'):
-            storage_queues['azure'] = multiprocessing.Queue(maxsize=1)
+        if per_backend and self.is_enabled('enable_azure_blob', 'MULTI_AZBLOB'):
             pc = get_config_value(
                 self.config,
                 'azure_blob',
                 'num_processes',
                 'AZBLOB_PROCS',
                 storage_proc_count)
+            pc = int(pc)
+
+            self.add_consumer(backend_channel, 'azure', 'azure_blob', 'AZBLOB', pc)
 
             for x in range(1, pc + 1):
                 init_proc('azblob_{}'.format(x), azblob_start, True)
 
-        if self.is_enabled('enable_minio', 'MULTI_MINIO'):
+        if per_backend and self.is_enabled('enable_minio', 'MULTI_MINIO'):
             log.info('Starting minio backend')
-            storage_queues['minio'] = multiprocessing.Queue(maxsize=1)
             pc = get_config_value(
                 self.config,
                 'minio',
                 'num_processes',
                 'MINIO_PROCS',
                 storage_proc_count)
+            pc = int(pc)
+
+            self.add_consumer(backend_channel, 'minio', 'minio', 'MINIO', pc)
 
             for x in range(1, pc + 1):
                 init_proc('minio_{}'.format(x), minio_start, True)
 
-        if self.is_enabled('enable_local', 'MULTI_LOCAL'):
+        if per_backend and self.is_enabled('enable_local', 'MULTI_LOCAL'):
             log.info('Starting local backend')
-            storage_queues['local'] = multiprocessing.Queue(maxsize=1)
             pc = get_config_value(
                 self.config,
                 'local',
                 'num_processes',
                 'LOCAL_PROCS',
                 storage_proc_count)
+            pc = int(pc)
+
+            self.add_consumer(backend_channel, 'local', 'local', 'LOCAL', pc)
 
             for x in range(1, pc + 1):
                 init_proc('local_{}'.format(x), local_start, True)
 
         if self.is_enabled('enable_celery', 'MULTI_CELERY'):
             log.info('Starting Celery backend')
-            storage_queues['celery'] = multiprocessing.Queue(maxsize=1)
             pc = get_config_value(
                 self.config,
                 'celery',
                 'num_processes',
                 'CELERY_PROCS',
                 storage_proc_count)
-
             pc = int(pc)
 
+            self.add_consumer(backend_channel, 'celery', 'celery', 'CELERY', pc)
+
             for x in range(1, pc + 1):
                 init_proc('celery_{}'.format(x), celery_start, True)
 
     def start(self):
         log.info('Starting camera supervisor')
         Supervisor.manager = Manager()
-        msgqueues = {}
 
         shared_obj = Supervisor.manager.dict()
-        # stores the current cv image as a list
-        shared_obj['imgbuf'] = Supervisor.manager.list()
-
-        # so the camera can write in peace.
-        # shared_obj['lock'] = Supervisor.manager.Lock()
-        shared_lock = Supervisor.manager.Lock()
 
         # used by services copying to local networks
         # so that the network interface isn't swamped
         # WAN-bound services don't need it.
         shared_obj['netlock'] = Supervisor.manager.Lock()
 
-        # a datetime object of the last capture, UTC
-        shared_obj['img_captured'] = datetime.utcnow()
+        # the camera writes frames here, backends map them without copying
+        frame_shape = UsbCamera(self.config).frame_shape
+        if frame_shape is None:
+            raise Exception('[camera] resolution is not set')
+
+        frame_slots = int(self.cfg('frame_slots', 'MULTI_FRAME_SLOTS', 4))
+        self.frames = FrameRingBuffer(frame_shape, frame_slots)
 
-        self.init_process_infos(shared_obj, shared_lock);
+        block_timeout = float(self.cfg('block_timeout', 'MULTI_BLOCK_TIMEOUT', 5))
+        self.channel = FrameChannel(self.frames, block_timeout)
 
-        # compares images
+        try:
+            if self.watch_for_motion:
+                log.info('Watching for motion, only frames with motion will be stored')
+                motion_slots = get_config_value(
+                    self.config, 'camera', 'motion_slots', 'CAMERA_MOTION_SLOTS', frame_slots)
 
-        # motion_queue = Supervisor.manager.Queue()
-        # motion_detect_proc = Process(
-        #     name='imgcompare',
-        #     target=Supervisor.motion_detect_proc,
-        #     args=(self.config, shared_obj, motion_queue)
-        #  )
+                # room for the motion boxes
+                self.motion_frames = FrameRingBuffer(frame_shape, int(motion_slots), meta_size=16384)
+                self.motion_channel = FrameChannel(self.motion_frames, block_timeout)
 
-        self.main_loop()
+            self.init_process_infos(shared_obj, self.channel, self.motion_channel)
 
-    @staticmethod
-    def motion_detect_proc(config):
-        motion_detect = MotionDetect(config)
-        while True:
-            sleep(1)
+            self.jpegs = self.init_jpeg_cache(self.motion_channel or self.channel)
 
-            # motion = motion_detect.motions(imgobj['imgbuf'])
-            # if motion is not None:
-            #     pass
+            self.main_loop()
+        finally:
+            for shared in [self.jpegs, self.frames, self.motion_frames]:
+                if shared is not None:
+                    shared.close()
+                    shared.unlink()
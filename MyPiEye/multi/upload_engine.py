@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from MyPiEye.multi.frame_channel import FrameChannel
+from MyPiEye.encoder import JpegEncoder, ARCHIVE
+
+log = logging.getLogger(__name__)
+
+# how often a waiting backend checks whether it should stop, in seconds
+POLL_INTERVAL = 1.0
+
+
+class UploadEngine(object):
+    """
+    Uploads the frames in a :class:`FrameChannel` to several backends from one process.
+
+    Each backend gets one reader, which takes frames from the backend's cursor and encodes them
+    (through the channel's JPEG cache, when there is one), and up to ``max_concurrency`` uploads at once.
+    Each upload gets its own copy of the JPEG, and the cache entry is released before it starts, so slow
+    uploads don't hold cache slots.
+    A backend with that many uploads running stops reading until one finishes, so its cursor's lag policy
+    still applies.
+
+    The storage clients all block, so the uploads themselves run on a thread pool shared by every backend,
+    sized to the total of the limits. The event loop only schedules them.
+    """
+
+    def __init__(self, config, channel: FrameChannel, uploaders: dict, limits: dict = None):
+        """
+        :param config: the global config, for the encoder when there's no JPEG cache
+        :param channel: the frames to upload
+        :param uploaders: dict of consumer name to a function taking ``(jpg, capture datetime)``
+        :param limits: dict of consumer name to the most uploads it can have running, 4 if not set
+        """
+
+        self.config = config
+        self.channel = channel
+        self.uploaders = uploaders
+
+        if limits is None:
+            limits = {}
+        self.limits = {name: max(1, int(limits.get(name, 4))) for name in uploaders}
+
+        # per backend: uploaded, failed, and the most running at once
+        self.stats = {name: {'uploaded': 0, 'failed': 0, 'peak': 0} for name in uploaders}
+
+        self._running = {name: 0 for name in uploaders}
+        self._stopping = False
+        self._encoder = None
+        self._executor = None
+
+    def _jpeg(self, name, seq, imgbuf):
+        if self.channel.jpegs is not None:
+            return self.channel.jpegs.get(seq, imgbuf, ARCHIVE, name)
+
+        if self._encoder is None:
+            self._encoder = JpegEncoder(self.config)
+
+        jpg = self._encoder.encode(imgbuf, ARCHIVE)
+
+        # the camera may have overwritten it while it was being encoded
+        if not self.channel.frames.valid(seq):
+            log.warning('Frame {} was overwritten while it was encoded, dropping it'.format(seq))
+            return None
+
+        return jpg
+
+    def _done(self, seq, name):
+        if self.channel.jpegs is not None:
+            self.channel.jpegs.ack(seq, ARCHIVE, name)
+
+    async def _upload(self, name, seq, jpg, curdt, slots: asyncio.Semaphore):
+        loop = asyncio.get_event_loop()
+
+        try:
+            await loop.run_in_executor(self._executor, self.uploaders[name], jpg, curdt)
+            self.stats[name]['uploaded'] += 1
+        except Exception as e:
+            self.stats[name]['failed'] += 1
+            log.error('{}: failed to upload frame {}: {}'.format(name, seq, e))
+        finally:
+            self._running[name] -= 1
+            slots.release()
+
+    async def _consume(self, name):
+        loop = asyncio.get_event_loop()
+
+        cursor = self.channel.cursors.get(name)
+        if cursor is None:
+            log.error('No frame cursor for {}'.format(name))
+            return
+
+        slots = asyncio.Semaphore(self.limits[name])
+        uploads = set()
+
+        while not self._stopping:
+            # wait for room before taking the next frame, so a slow backend falls behind on its cursor
+            await slots.acquire()
+
+            frame = None
+            while frame is None and not self._stopping:
+                frame = await loop.run_in_executor(self._executor, cursor.get, POLL_INTERVAL)
+
+            if frame is None:
+                slots.release()
+                break
+
+            seq, imgbuf, curdt = frame
+
+            # encoded before the next frame is claimed, the view is only good until then
+            jpg = await loop.run_in_executor(self._executor, self._jpeg, name, seq, imgbuf)
+            if jpg is None:
+                self._done(seq, name)
+                slots.release()
+                continue
+
+            # the cache's view can be reused once it's acked, the upload reads its own copy
+            if self.channel.jpegs is not None:
+                jpg = jpg.copy()
+                self._done(seq, name)
+
+            self._running[name] += 1
+            self.stats[name]['peak'] = max(self.stats[name]['peak'], self._running[name])
+
+            task = asyncio.ensure_future(self._upload(name, seq, jpg, curdt, slots))
+            uploads.add(task)
+            task.add_done_callback(uploads.discard)
+
+        if uploads:
+            await asyncio.wait(uploads)
+
+    async def run(self):
+        """
+        Uploads until :func:`stop` is called.
+        """
+
+        # a reader and the uploads for each backend
+        threads = sum(self.limits.values()) + len(self.uploaders)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='upload')
+
+        log.info('Starting uploads to {}, {} threads'.format(', '.join(sorted(self.uploaders)), threads))
+
+        try:
+            await asyncio.gather(*[self._consume(name) for name in self.uploaders])
+        finally:
+            self._executor.shutdown()
+            self.log_stats()
+
+    def start(self):
+        """
+        Runs the event loop, blocks until :func:`stop` is called.
+        """
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.run())
+        finally:
+            loop.close()
+
+    def stop(self):
+        """
+        Finishes the running uploads, and stops. Safe to call from another thread.
+        """
+        self._stopping = True
+
+    def log_stats(self):
+        for name, stats in sorted(self.stats.items()):
+            log.info('{}: {} uploaded, {} failed, {} at once at most'.format(
+                name, stats['uploaded'], stats['failed'], stats['peak']))
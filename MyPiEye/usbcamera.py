@@ -1,12 +1,24 @@
 import cv2
 import logging
+import threading
 from time import sleep
+from datetime import datetime
 from ast import literal_eval
 
+from MyPiEye.encoder import JpegEncoder, ARCHIVE
+
 log = logging.getLogger(__name__)
 
 
 class UsbCamera(object):
+    """
+    Reads frames from an OpenCV capture device.
+
+    With ``threaded_grab``, a background thread reads frames as fast as the camera produces them,
+    and keeps only the newest one. The driver buffer doesn't fill up with stale frames while the caller is busy,
+    and :func:`get_image` always returns the freshest frame.
+    """
+
     def __init__(self, config):
         self.config = config
         self.cam_config = config.get('camera', None)
@@ -17,6 +29,9 @@ class UsbCamera(object):
         self.camera_instance = None
         self.is_open = False
 
+        # for save_image, created when first needed
+        self.encoder = None
+
         resolution = self.cam_config['resolution']
 
         # the size of the raw image array
@@ -34,6 +49,44 @@ class UsbCamera(object):
         if self.resolution is not None:
             self.img_size = self.resolution[0] * self.resolution[1]
 
+        # read frames on a background thread
+        self.threaded_grab = self.cam_config.get('threaded_grab', 'True') in [True, 'True']
+
+        # how long get_image waits for a new frame, in seconds
+        self.grab_timeout = float(self.cam_config.get('grab_timeout', '1'))
+
+        self._grab_thread = None
+        self._grab_stop = threading.Event()
+        self._grab_cond = threading.Condition()
+
+        # guarded by _grab_cond
+        self._frame = None
+        self._frame_dt = None
+        self._frame_seq = 0
+        self._read_seq = 0
+        self._grab_ok = False
+
+        # frames read from the camera
+        self.grabbed = 0
+
+        # frames replaced before anyone read them
+        self.dropped = 0
+
+        # frames returned more than once, because a new one wasn't ready in time
+        self.duplicates = 0
+
+    @property
+    def frame_shape(self):
+        """
+        The shape of the images from :func:`get_image`, as (height, width, channels).
+
+        :return: None if the resolution isn't set
+        """
+        if self.resolution is None:
+            return None
+
+        return self.resolution[1], self.resolution[0], 3
+
     def check(self):
         ret = True
 
@@ -71,6 +124,9 @@ class UsbCamera(object):
         if retry >= 3:
             return False
 
+        if self.threaded_grab:
+            self._start_grab()
+
         return True
 
     def _init_camera(self, orig=True):
@@ -107,13 +163,121 @@ class UsbCamera(object):
             return True
 
     def close_camera(self):
-        if not hasattr(self, 'camera'):
-            return
+        self._stop_grab()
 
         if self.camera_id is not None and self.camera_instance is not None:
             log.warning('Shutting down video capture')
             self.camera_instance.release()
-            del self.camera_instance
+            self.camera_instance = None
+            self.is_open = False
+
+    def _start_grab(self):
+        if self._grab_thread is not None:
+            return
+
+        self._grab_stop.clear()
+        self._grab_thread = threading.Thread(target=self._grab_loop, name='camera-grab', daemon=True)
+        self._grab_thread.start()
+
+        log.info('Started camera grab thread')
+
+    def _stop_grab(self):
+        if self._grab_thread is None:
+            return
+
+        self._grab_stop.set()
+        self._grab_thread.join(self.grab_timeout + 5)
+        self._grab_thread = None
+
+        with self._grab_cond:
+            self._frame = None
+            self._grab_cond.notify_all()
+
+    def _grab_loop(self):
+        """
+        Reads frames until :func:`close_camera`. Only this thread touches the capture device while it's running.
+        """
+
+        camera = self.camera_instance
+
+        while not self._grab_stop.is_set():
+            ok = camera.grab()
+
+            # as close to the exposure as we can get
+            grab_dt = datetime.now()
+
+            if ok:
+                ok, img = camera.retrieve()
+
+            if not ok:
+                with self._grab_cond:
+                    if self._grab_ok:
+                        log.error('Failed to get camera image')
+                    self._grab_ok = False
+                    self._grab_cond.notify_all()
+
+                sleep(.1)
+                continue
+
+            with self._grab_cond:
+                # the last one was never read
+                if self._frame is not None and self._read_seq < self._frame_seq:
+                    self.dropped += 1
+
+                self._frame = img
+                self._frame_dt = grab_dt
+                self._frame_seq += 1
+                self._grab_ok = True
+                self.grabbed += 1
+
+                self._grab_cond.notify_all()
+
+    def get_frame(self, timeout=None):
+        """
+        Gets the newest frame, along with when it was grabbed.
+
+        If the grab thread is running, waits up to ``timeout`` seconds for a frame that hasn't been returned yet.
+        If there isn't one, the last frame is returned again, as long as the camera is still working.
+
+        :param timeout: seconds to wait for a new frame, ``grab_timeout`` if None
+        :return: tuple of (CV image, grab datetime), or (None, None) on failure
+        """
+
+        if self._grab_thread is None:
+            img = self._read_image()
+            if img is None:
+                return None, None
+            return img, datetime.now()
+
+        if timeout is None:
+            timeout = self.grab_timeout
+
+        with self._grab_cond:
+            self._grab_cond.wait_for(lambda: self._frame_seq > self._read_seq, timeout)
+
+            if self._frame is None or not self._grab_ok:
+                log.error('Failed to get camera image')
+                return None, None
+
+            if self._frame_seq == self._read_seq:
+                self.duplicates += 1
+            self._read_seq = self._frame_seq
+
+            return self._frame, self._frame_dt
+
+    def stats(self):
+        """
+        Grab thread counters.
+
+        :return: dict of ``grabbed``, ``dropped``, and ``duplicates``
+        """
+
+        with self._grab_cond:
+            return {
+                'grabbed': self.grabbed,
+                'dropped': self.dropped,
+                'duplicates': self.duplicates
+            }
 
     def get_image(self):
         """
@@ -121,6 +285,10 @@ class UsbCamera(object):
         :return:
         """
 
+        img, _ = self.get_frame()
+        return img
+
+    def _read_image(self):
         if self.camera_instance is not None:
             # log.debug('Reading from camera {}'.format(self.camera.isOpened()))
             ret, img = self.camera_instance.read()
@@ -132,13 +300,16 @@ class UsbCamera(object):
             log.error('Camera not initialized')
             return None
 
-    @staticmethod
-    def save_image(cv_image, filename):
+    def save_image(self, cv_image, filename, profile=ARCHIVE):
         """
         Write the OpenCV image as a file.
 
         :param cv_image: an OpenCV image array
         :param filename:
-        :return:
+        :param profile: the JPEG profile, see :class:`JpegEncoder`
+        :return: True on success
         """
-        cv2.imwrite(filename, cv_image)
+        if self.encoder is None:
+            self.encoder = JpegEncoder(self.config)
+
+        return self.encoder.save(cv_image, filename, profile)
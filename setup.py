@@ -57,6 +57,7 @@ setup(
         'MarkupSafe==1.1.0',
         'minio==4.0.10',
         'monotonic==1.5',
+        'msgpack==0.6.2',
         'more-itertools==7.2.0',
         'multidict==4.5.1',
         'numpy==1.22.0',
@@ -86,5 +87,10 @@ setup(
         'Werkzeug==0.15.3',
         'yarl==1.2.6',
         'zipp==0.6.0'
-    ]
+    ],
+
+    extras_require={
+        # faster JPEG encoding
+        'turbojpeg': ['PyTurboJPEG']
+    }
 )
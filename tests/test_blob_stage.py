@@ -0,0 +1,72 @@
+import os
+import unittest
+import tempfile
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import numpy as np
+
+from MyPiEye.CeleryTasks.blob_stage import FileBlobStage, RedisBlobStage, blob_key, blob_stage
+from MyPiEye.CeleryTasks.payload import pack_capture, unpack_capture, KIND_REF
+
+
+class BlobStageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.captured = datetime(2019, 9, 7, 23, 15, 49, 220779)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_file_stage(self):
+        stage = FileBlobStage(self.folder.name, ttl=60)
+        key = blob_key('server/cam0', self.captured)
+        self.assertEqual('server/cam0/20190907.231549.220779', key)
+
+        stage.put(key, np.arange(10, dtype=np.uint8))
+        self.assertEqual(bytes(range(10)), stage.get(key))
+
+        stage.delete(key)
+        self.assertIsNone(stage.get(key))
+
+        # already gone
+        stage.delete(key)
+
+    def test_file_sweep(self):
+        stage = FileBlobStage(self.folder.name, ttl=60)
+
+        stage.put('old', b'old')
+        stage.put('new', b'new')
+        os.utime(stage.path('old'), (0, 0))
+
+        stage.sweep()
+        self.assertIsNone(stage.get('old'))
+        self.assertEqual(b'new', stage.get('new'))
+
+    def test_redis_stage(self):
+        rds = MagicMock()
+        stage = RedisBlobStage(rds, 'blob', ttl=30)
+
+        stage.put('cam/1', b'jpeg')
+        rds.set.assert_called_with('blob/cam/1', b'jpeg', ex=30)
+
+        stage.delete('cam/1')
+        rds.delete.assert_called_with('blob/cam/1')
+
+    def test_config(self):
+        self.assertIsNone(blob_stage({'celery': {}}))
+
+        stage = blob_stage({'celery': {'claim_check': 'file', 'blob_dir': self.folder.name}})
+        self.assertIsInstance(stage, FileBlobStage)
+
+    def test_ref_payload(self):
+        key = blob_key('cam', self.captured)
+
+        kind, dt_stamp, cam_id, body = unpack_capture(pack_capture(key, self.captured, 'cam', KIND_REF))
+        self.assertEqual(KIND_REF, kind)
+        self.assertEqual(key, body.tobytes().decode('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import json
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from MyPiEye.CeleryTasks.capture_index import CaptureIndex, capture_score
+
+
+class CaptureIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rds = MagicMock()
+        self.pipe = self.rds.pipeline.return_value
+
+    def test_flush(self):
+        index = CaptureIndex(self.rds, 'captures', 'US/Central')
+
+        first = datetime(2019, 9, 7, 23, 15, 49, 220779)
+        second = datetime(2019, 9, 7, 23, 15, 50)
+
+        index.add(first, 'server/cam0')
+        index.add(second, 'server/cam0')
+        index.add(second, 'server/cam1')
+
+        # buffered
+        self.rds.pipeline.assert_not_called()
+
+        self.assertEqual(3, index.flush())
+        self.pipe.execute.assert_called_once_with()
+        self.assertEqual(3, self.pipe.set.call_count)
+
+        key = 'captures/server/cam0/20190907/23/15/2019.09.07.23.15.49.220779'
+        val = json.loads(self.pipe.set.call_args_list[0][0][1])
+        self.assertEqual(key, self.pipe.set.call_args_list[0][0][0])
+        # captures are stamped in local time
+        self.assertEqual('2019-09-08T04:15:49.220779', val['utc_time'])
+        self.assertEqual('2019-09-07T23:15:49.220779-05:00', val['local_time'])
+
+        # one sorted set update per camera
+        self.assertEqual(2, self.pipe.zadd.call_count)
+        name, members = self.pipe.zadd.call_args_list[0][0]
+        self.assertEqual('captures/index/server/cam0', name)
+        self.assertEqual(capture_score(datetime(2019, 9, 8, 4, 15, 49, 220779)), members[key])
+        self.assertEqual(2, len(members))
+
+        self.pipe.sadd.assert_called_once_with('captures/cameras', 'server/cam0', 'server/cam1')
+
+        # nothing left
+        self.assertEqual(0, index.flush())
+
+    def test_batch_size(self):
+        index = CaptureIndex(self.rds, 'captures', batch_size=2)
+
+        index.add(datetime(2019, 9, 7), 'cam')
+        index.add(datetime(2019, 9, 8), 'cam')
+        self.pipe.execute.assert_called_once_with()
+
+    def test_rebuild(self):
+        self.rds.scan_iter.return_value = [
+            b'captures/cam/20190907/23/15/2019.09.07.23.15.49.220779',
+            b'captures/cam/not-a-capture'
+        ]
+
+        index = CaptureIndex(self.rds, 'captures', 'US/Central')
+        self.assertEqual(1, index.rebuild('cam'))
+
+        self.pipe.zadd.assert_called_once_with('captures/index/cam', {
+            'captures/cam/20190907/23/15/2019.09.07.23.15.49.220779':
+                capture_score(datetime(2019, 9, 8, 4, 15, 49, 220779))
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
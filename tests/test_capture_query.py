@@ -0,0 +1,74 @@
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from MyPiEye.CeleryTasks.capture_index import CaptureIndex, capture_score
+from MyPiEye.CeleryTasks.capture_query import CaptureQuery, HOUR, DAY
+
+
+class CaptureQueryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rds = MagicMock()
+        self.query = CaptureQuery(self.rds, 'captures', 'US/Central')
+        self.captured = datetime(2019, 9, 7, 23, 15, 49, 220779)
+        self.key = b'captures/cam/20190907/23/15/2019.09.07.23.15.49.220779'
+
+    def test_between(self):
+        self.rds.zrangebyscore.return_value = [(self.key, capture_score(self.captured))]
+
+        found = self.query.between('cam', datetime(2019, 9, 7), datetime(2019, 9, 8), offset=100, limit=50)
+
+        self.rds.zrangebyscore.assert_called_once_with(
+            'captures/index/cam', capture_score(datetime(2019, 9, 7)), '({}'.format(capture_score(datetime(2019, 9, 8))),
+            start=100, num=50, withscores=True)
+
+        self.assertEqual([{
+            'key': self.key.decode('utf-8'),
+            'name': 'cam/20190907/23/15/2019.09.07.23.15.49.220779',
+            'utc_time': self.captured
+        }], found)
+
+    def test_latest(self):
+        self.rds.zrevrange.return_value = [(self.key, capture_score(self.captured))]
+
+        found = self.query.latest('cam', 10, 20)
+        self.rds.zrevrange.assert_called_once_with('captures/index/cam', 20, 29, withscores=True)
+        self.assertEqual(self.captured, found[0]['utc_time'])
+
+    def test_local_time(self):
+        # the index converts the camera's local time, the query converts it back
+        utc = CaptureIndex(self.rds, 'captures', 'US/Central').utc_time(self.captured)
+        self.assertEqual(datetime(2019, 9, 8, 4, 15, 49, 220779), utc)
+        self.assertEqual(utc, self.query.to_utc(self.captured))
+        self.assertEqual(self.captured, self.query.local_time(utc).replace(tzinfo=None))
+
+    def test_buckets(self):
+        # 2019-11-03 01:00 happens twice in US/Central
+        hours = self.query.buckets(datetime(2019, 11, 3, 5, 30), datetime(2019, 11, 3, 8), HOUR)
+        self.assertEqual([
+            datetime(2019, 11, 3, 5),
+            datetime(2019, 11, 3, 7),
+            datetime(2019, 11, 3, 8)
+        ], hours)
+
+        # local midnight
+        days = self.query.buckets(datetime(2019, 9, 7, 12), datetime(2019, 9, 8, 12), DAY)
+        self.assertEqual([
+            datetime(2019, 9, 7, 5),
+            datetime(2019, 9, 8, 5),
+            datetime(2019, 9, 9, 5)
+        ], days)
+
+    def test_counts(self):
+        pipe = self.rds.pipeline.return_value
+        pipe.execute.return_value = [3, 4]
+
+        counts = self.query.counts('cam', datetime(2019, 9, 7, 12), datetime(2019, 9, 8, 12), DAY)
+
+        self.assertEqual([(datetime(2019, 9, 7, 5), 3), (datetime(2019, 9, 8, 5), 4)], counts[:2])
+        self.assertEqual(2, pipe.zcount.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
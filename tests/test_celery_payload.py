@@ -0,0 +1,35 @@
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from MyPiEye.CeleryTasks.payload import pack_capture, unpack_capture, PayloadError, KIND_JPEG
+
+
+class CeleryPayloadTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        jpg = np.arange(200, dtype=np.uint8)
+        captured = datetime(2019, 9, 7, 23, 15, 49, 220779)
+
+        payload = pack_capture(jpg, captured, 'server/cam0')
+
+        # just the header and camera id on top of the JPEG
+        self.assertLess(len(payload), len(jpg) + 40)
+
+        kind, dt_stamp, cam_id, body = unpack_capture(payload)
+        self.assertEqual(KIND_JPEG, kind)
+        self.assertEqual(captured, dt_stamp)
+        self.assertEqual('server/cam0', cam_id)
+        self.assertEqual(jpg.tobytes(), body.tobytes())
+
+    def test_bad_payloads(self):
+        payload = pack_capture(b'jpeg', datetime(2019, 9, 7), 'cam')
+
+        self.assertRaises(PayloadError, unpack_capture, payload[:10])
+        self.assertRaises(PayloadError, unpack_capture, payload[:-1])
+        self.assertRaises(PayloadError, unpack_capture, b'XXXX' + payload[4:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+from time import sleep
+from unittest.mock import MagicMock
+
+from MyPiEye.Storage.db_writer import DynamoDbWriter
+
+
+class DbWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.image_table = MagicMock()
+        self.camera_table = MagicMock()
+        self.batch = self.image_table.batch_writer.return_value.__enter__.return_value
+
+    def test_batch_size(self):
+        writer = DynamoDbWriter(self.image_table, None, batch_size=3, flush_interval=60)
+
+        for x in range(7):
+            writer.add_image({'s3key': str(x)})
+
+        self.assertEqual(2, self.image_table.batch_writer.call_count)
+        self.assertEqual(6, self.batch.put_item.call_count)
+
+        writer.close()
+        self.assertEqual(3, self.image_table.batch_writer.call_count)
+        self.assertEqual(7, self.batch.put_item.call_count)
+        self.assertEqual(7, writer.stats['image_rows'])
+
+    def test_flush_interval(self):
+        writer = DynamoDbWriter(self.image_table, None, batch_size=25, flush_interval=.05)
+
+        writer.add_image({'s3key': '1'})
+        writer.add_image({'s3key': '2'})
+        self.assertEqual(0, self.batch.put_item.call_count)
+
+        # written by the timer
+        sleep(.3)
+        self.assertEqual(1, self.image_table.batch_writer.call_count)
+        self.assertEqual(2, self.batch.put_item.call_count)
+
+        writer.close()
+
+    def test_sooner(self):
+        writer = DynamoDbWriter(self.image_table, self.camera_table, flush_interval=.05, camera_interval=60)
+
+        # the timer is set for the camera, a minute out
+        writer.update_camera('cam0', {'cam_id': 'cam0', 'filename': '1'})
+        writer.update_camera('cam0', {'cam_id': 'cam0', 'filename': '2'})
+
+        # due sooner, so it's moved up
+        writer.add_image({'s3key': '1'})
+
+        sleep(.3)
+        self.assertEqual(1, self.batch.put_item.call_count)
+
+        writer.close()
+
+    def test_camera_coalesced(self):
+        writer = DynamoDbWriter(None, self.camera_table, camera_interval=60)
+
+        for x in range(5):
+            writer.update_camera('cam0', {'cam_id': 'cam0', 'filename': str(x)})
+        writer.update_camera('cam1', {'cam_id': 'cam1', 'filename': 'a'})
+
+        # the first for each camera, the rest wait
+        self.assertEqual(2, self.camera_table.put_item.call_count)
+
+        writer.close()
+
+        # only the latest
+        self.assertEqual(3, self.camera_table.put_item.call_count)
+        self.camera_table.put_item.assert_called_with(Item={'cam_id': 'cam0', 'filename': '4'})
+        self.assertEqual(6, writer.stats['camera_rows'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from datetime import datetime, timedelta
+
+from MyPiEye.detect_scheduler import DetectScheduler
+
+
+def scheduler_config(**motion):
+    defaults = {
+        'idle_interval': '1',
+        'active_interval': '0',
+        'hold_time': '10',
+        'max_interval': '5'
+    }
+    defaults.update(motion)
+
+    return {'motion': defaults}
+
+
+class DetectSchedulerTests(unittest.TestCase):
+
+    def test_idle(self):
+        sched = DetectScheduler(scheduler_config())
+
+        # nothing checked yet
+        self.assertEqual(0, sched.delay(100))
+
+        started = sched.start(100)
+        sched.finish(started, False, 100.1)
+
+        self.assertFalse(sched.active(100.1))
+        self.assertAlmostEqual(0.9, sched.delay(100.1))
+        self.assertEqual(0, sched.delay(101.5))
+
+    def test_hold(self):
+        sched = DetectScheduler(scheduler_config())
+
+        started = sched.start(100)
+        sched.finish(started, True, 100)
+
+        # every frame, until the hold time is up
+        self.assertTrue(sched.active(105))
+        self.assertEqual(0, sched.delay(100))
+
+        self.assertFalse(sched.active(110))
+        sched.start(110)
+        self.assertAlmostEqual(1, sched.delay(110))
+
+    def test_backoff(self):
+        sched = DetectScheduler(scheduler_config(idle_interval='0.1', max_interval='2'))
+
+        now = 100.0
+        for _ in range(50):
+            started = sched.start(now)
+            now += 1.5
+            sched.finish(started, False, now)
+
+        self.assertAlmostEqual(1.5, sched.interval(now), places=2)
+
+        # idle time after the check, not counted from its start
+        self.assertAlmostEqual(1.5, sched.delay(now), places=2)
+        self.assertAlmostEqual(0.5, sched.delay(now + 1), places=2)
+        self.assertEqual(0, sched.delay(now + 2))
+
+        # capped
+        for _ in range(50):
+            started = sched.start(now)
+            now += 4
+            sched.finish(started, False, now)
+
+        self.assertEqual(2, sched.interval(now))
+
+        # and recovers
+        for _ in range(100):
+            started = sched.start(now)
+            now += .01
+            sched.finish(started, False, now)
+
+        self.assertEqual(0.1, sched.interval(now))
+
+    def test_every_frame(self):
+        sched = DetectScheduler(scheduler_config())
+
+        # 10 frames a second, with the ones in between skipped
+        captured = datetime(2019, 9, 7, 23, 15)
+        for seq in range(0, 40, 4):
+            sched.frame(seq, captured + timedelta(seconds=seq / 10))
+        self.assertAlmostEqual(.1, sched.frame_period)
+
+        # keeping up with the camera
+        now = 100.0
+        started = sched.start(now)
+        now += .05
+        sched.finish(started, True, now)
+
+        self.assertEqual(0, sched.interval(now))
+        self.assertEqual(0, sched.delay(now))
+
+        # slower than the camera
+        for _ in range(50):
+            started = sched.start(now)
+            now += 3
+            sched.finish(started, True, now)
+
+        self.assertAlmostEqual(3, sched.interval(now), places=2)
+        self.assertAlmostEqual(3, sched.delay(now), places=2)
+
+    def test_every_frame_unknown_period(self):
+        sched = DetectScheduler(scheduler_config())
+
+        # no frames seen, so there's nothing to compare against
+        started = sched.start(100)
+        sched.finish(started, True, 103)
+
+        self.assertEqual(0, sched.interval(103))
+        self.assertEqual(0, sched.delay(103))
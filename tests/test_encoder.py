@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+
+from MyPiEye.encoder import JpegEncoder, ARCHIVE, THUMBNAIL, PREVIEW
+
+
+class JpegEncoderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.img = np.zeros((480, 640, 3), dtype=np.uint8)
+        cv2.rectangle(self.img, (100, 100), (300, 200), (0, 128, 255), -1)
+
+    def test_profiles(self):
+        encoder = JpegEncoder({'encoder': {'engine': 'opencv', 'thumbnail_quality': '50', 'tiny_quality': '40',
+                                           'tiny_max_width': '64'}})
+
+        self.assertEqual(50, encoder.profiles[THUMBNAIL]['quality'])
+        self.assertEqual(320, encoder.profiles[THUMBNAIL]['max_width'])
+        self.assertTrue(encoder.profiles[PREVIEW]['progressive'])
+
+        # unknown profiles start from the archive settings
+        self.assertEqual(40, encoder.profiles['tiny']['quality'])
+        self.assertEqual('444', encoder.profiles['tiny']['subsampling'])
+
+    def test_encode(self):
+        encoder = JpegEncoder({'encoder': {'engine': 'opencv'}})
+
+        archive = encoder.encode(self.img, ARCHIVE)
+        thumb = encoder.encode(self.img, THUMBNAIL)
+
+        self.assertEqual((480, 640, 3), cv2.imdecode(archive, cv2.IMREAD_COLOR).shape)
+        self.assertEqual((240, 320, 3), cv2.imdecode(thumb, cv2.IMREAD_COLOR).shape)
+        self.assertLess(len(thumb), len(archive))
+
+        self.assertEqual(1, encoder.stats[ARCHIVE]['count'])
+        self.assertEqual(len(archive), encoder.stats[ARCHIVE]['bytes'])
+        self.assertGreater(encoder.stats[ARCHIVE]['seconds'], 0)
+
+        self.assertIsNone(encoder.encode(self.img, 'nope'))
+
+    def test_no_turbojpeg(self):
+        encoder = JpegEncoder({'encoder': {'engine': 'turbojpeg'}})
+
+        with mock.patch('MyPiEye.encoder.turbojpeg', None):
+            jpg = encoder.encode(self.img)
+
+        self.assertIsNotNone(cv2.imdecode(jpg, cv2.IMREAD_COLOR))
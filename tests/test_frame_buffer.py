@@ -0,0 +1,86 @@
+import pickle
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from MyPiEye.multi.frame_buffer import FrameRingBuffer
+
+
+class FrameRingBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = FrameRingBuffer((4, 6, 3), slots=3)
+
+    def tearDown(self):
+        self.frames.close()
+        self.frames.unlink()
+
+    def test_write_read(self):
+        self.assertEqual(-1, self.frames.head)
+        self.assertIsNone(self.frames.latest())
+
+        img = np.full((4, 6, 3), 7, dtype=np.uint8)
+        captured = datetime(2019, 9, 7, 23, 15, 49, 220779)
+
+        seq = self.frames.write(img, captured)
+        self.assertEqual(0, seq)
+        self.assertEqual(0, self.frames.head)
+
+        view, dt_stamp = self.frames.frame(seq)
+        self.assertEqual(captured, dt_stamp)
+        self.assertTrue(np.array_equal(img, view))
+
+        # views are read-only
+        with self.assertRaises(ValueError):
+            view[0, 0, 0] = 1
+
+    def test_overwrite(self):
+        img = np.zeros((4, 6, 3), dtype=np.uint8)
+
+        for x in range(4):
+            img[:] = x
+            self.frames.write(img, datetime.now())
+
+        # the first frame has been replaced by the fourth
+        self.assertFalse(self.frames.valid(0))
+        self.assertIsNone(self.frames.frame(0))
+
+        seq, view, _ = self.frames.latest()
+        self.assertEqual(3, seq)
+        self.assertEqual(3, view[0, 0, 0])
+
+    def test_bad_shape(self):
+        with self.assertRaises(ValueError):
+            self.frames.write(np.zeros((2, 2, 3), dtype=np.uint8), datetime.now())
+
+    def test_attach(self):
+        img = np.full((4, 6, 3), 9, dtype=np.uint8)
+        self.frames.write(img, datetime.now())
+
+        attached = pickle.loads(pickle.dumps(self.frames))
+        try:
+            self.assertEqual(self.frames.name, attached.name)
+            seq, view, _ = attached.latest()
+            self.assertEqual(0, seq)
+            self.assertTrue(np.array_equal(img, view))
+        finally:
+            attached.close()
+
+    def test_meta(self):
+        img = np.zeros((4, 6, 3), dtype=np.uint8)
+
+        # no room for metadata
+        with self.assertRaises(ValueError):
+            self.frames.write(img, datetime.now(), {'motions': []})
+
+        with_meta = FrameRingBuffer((4, 6, 3), slots=2, meta_size=128)
+        try:
+            seq = with_meta.write(img, datetime.now(), {'motions': [{'rect': [1, 2, 3, 4], 'size': 12}]})
+            self.assertDictEqual({'motions': [{'rect': [1, 2, 3, 4], 'size': 12}]}, with_meta.meta(seq))
+
+            seq = with_meta.write(img, datetime.now())
+            self.assertDictEqual({}, with_meta.meta(seq))
+        finally:
+            with_meta.close()
+            with_meta.unlink()
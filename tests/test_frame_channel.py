@@ -0,0 +1,82 @@
+import unittest
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from MyPiEye.multi.frame_buffer import FrameRingBuffer
+from MyPiEye.multi.frame_channel import FrameChannel, LAG_LATEST, LAG_BACKLOG, LAG_BLOCK
+
+
+class FrameChannelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = FrameRingBuffer((2, 2, 3), slots=4)
+        self.channel = FrameChannel(self.frames, block_timeout=.1)
+        self.img = np.zeros((2, 2, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        self.frames.close()
+        self.frames.unlink()
+
+    def put_frames(self, count):
+        for x in range(count):
+            self.img[:] = x
+            self.channel.put(self.img, datetime.now())
+
+    def test_latest(self):
+        cursor = self.channel.add_consumer('latest', LAG_LATEST)
+
+        self.assertIsNone(cursor.get(timeout=0))
+
+        self.put_frames(3)
+
+        seq, view, _ = cursor.get(timeout=0)
+        self.assertEqual(2, seq)
+        self.assertEqual(2, view[0, 0, 0])
+        self.assertEqual(2, cursor.dropped)
+        self.assertEqual(1, cursor.delivered)
+
+        # nothing new
+        self.assertIsNone(cursor.get(timeout=0))
+
+    def test_backlog(self):
+        cursor = self.channel.add_consumer('backlog', LAG_BACKLOG, 2)
+
+        self.put_frames(5)
+
+        self.assertEqual(3, cursor.claim(0))
+        self.assertEqual(4, cursor.claim(0))
+        self.assertIsNone(cursor.claim(0))
+        self.assertEqual(3, cursor.dropped)
+
+        stats = self.channel.stats()
+        self.assertDictEqual({'delivered': 2, 'dropped': 3, 'lag': 0}, stats['backlog'])
+
+    def test_backlog_limit(self):
+        cursor = self.channel.add_consumer('big', LAG_BACKLOG, 10)
+        self.assertEqual(3, cursor.backlog)
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            self.channel.add_consumer('bogus', 'bogus')
+
+    def test_block(self):
+        cursor = self.channel.add_consumer('block', LAG_BLOCK)
+        self.channel.block_timeout = None
+
+        # fills the slots, the next put has to wait for the consumer
+        self.put_frames(4)
+
+        producer = threading.Thread(target=self.put_frames, args=(2,))
+        producer.start()
+
+        seen = []
+        while len(seen) < 6:
+            seen.append(cursor.claim(1))
+
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+
+        self.assertListEqual([0, 1, 2, 3, 4, 5], seen)
+        self.assertEqual(0, cursor.dropped)
@@ -0,0 +1,189 @@
+import unittest
+import tempfile
+from concurrent.futures import Future
+from datetime import datetime
+from unittest import mock
+
+import cv2
+import numpy as np
+
+from MyPiEye.Storage.image_storage import ImageStorage
+from MyPiEye.motion_detect import ImageCapture, CaptureTask, FULL, THUMB
+
+
+class StubExecutor(object):
+    """
+    Keeps the jobs instead of running them. Tests start and finish them.
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        fut = Future()
+        self.jobs.append((fut, args))
+        return fut
+
+    def shutdown(self):
+        pass
+
+
+class ImageStorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+        self.unlink = mock.patch.object(CaptureTask, 'unlink', autospec=True, side_effect=CaptureTask.unlink)
+        self.unlinked = self.unlink.start()
+
+        self.storages = []
+
+    def tearDown(self):
+        for storage in self.storages:
+            # so the shared memory is released
+            for fut, _ in storage.executor.jobs:
+                if not fut.done() and not fut.cancel():
+                    fut.set_result(0)
+
+        self.unlink.stop()
+        self.folder.cleanup()
+
+    def storage(self, **backends):
+        config = {'savedir': self.folder.name}
+        config.update(backends)
+
+        storage = ImageStorage(config)
+        storage.executor.shutdown()
+        storage.executor = StubExecutor()
+
+        self.storages.append(storage)
+
+        return storage
+
+    def capture(self, jpg=None):
+        capture = ImageCapture({})
+        capture.capture_dt = datetime(2019, 9, 7, 23, 15, 49, 220779)
+
+        if jpg is None:
+            jpg = cv2.imencode('.jpg', np.zeros((480, 640, 3), dtype=np.uint8))[1].tobytes()
+        capture.jpgs[FULL] = jpg
+
+        return capture
+
+    def test_drop_oldest(self):
+        storage = self.storage(local={'max_in_flight': '2', 'drop_policy': 'oldest'})
+
+        storage.save_files(self.capture())
+        storage.save_files(self.capture())
+
+        # the first one is uploading, so the second is dropped for the new one
+        first, second = [fut for fut, _ in storage.executor.jobs]
+        first.set_running_or_notify_cancel()
+
+        storage.save_files(self.capture())
+
+        self.assertTrue(second.cancelled())
+        self.assertFalse(first.cancelled())
+
+        stats = storage.stats()['local']
+        self.assertEqual(1, stats['dropped'])
+        self.assertEqual(3, stats['submitted'])
+        self.assertEqual(2, stats['depth'])
+
+    def test_drop_newest(self):
+        storage = self.storage(local={'max_in_flight': '1', 'drop_policy': 'newest'})
+
+        storage.save_files(self.capture())
+        storage.save_files(self.capture())
+
+        self.assertEqual(1, len(storage.executor.jobs))
+
+        stats = storage.stats()['local']
+        self.assertEqual(1, stats['dropped'])
+        self.assertEqual(1, stats['submitted'])
+
+    def test_thumbnail(self):
+        storage = self.storage(local={'max_in_flight': '1', 'drop_policy': 'thumbnail'})
+
+        storage.save_files(self.capture())
+
+        # behind, so the next one is a thumbnail, made then
+        capture = self.capture()
+        storage.save_files(capture)
+
+        self.assertEqual(THUMB, storage.executor.jobs[1][1][2])
+        thumb = cv2.imdecode(np.frombuffer(capture.jpg(THUMB), dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual(320, thumb.shape[1])
+
+        # up to max_in_flight thumbnails, then dropped
+        storage.save_files(self.capture())
+        self.assertEqual(2, len(storage.executor.jobs))
+
+        stats = storage.stats()['local']
+        self.assertEqual(1, stats['degraded'])
+        self.assertEqual(1, stats['dropped'])
+
+    def test_thumbnail_failed(self):
+        storage = self.storage(local={'max_in_flight': '1', 'drop_policy': 'thumbnail'})
+
+        storage.save_files(self.capture())
+
+        # can't be decoded
+        capture = self.capture(b'not a jpeg')
+        storage.save_files(capture)
+
+        self.assertIsNone(capture.jpg(THUMB))
+        self.assertEqual(1, len(storage.executor.jobs))
+
+        stats = storage.stats()['local']
+        self.assertEqual(0, stats['degraded'])
+        self.assertEqual(1, stats['dropped'])
+
+    def test_only_thumbnails(self):
+        storage = self.storage(local={'max_in_flight': '1', 'drop_policy': 'thumbnail'})
+
+        # no variant made, so nothing is left to send
+        storage.save_files(self.capture())
+        capture = self.capture()
+        capture.jpgs = {}
+        storage.save_files(capture)
+
+        self.assertEqual(1, len(storage.executor.jobs))
+        self.assertEqual(1, storage.stats()['local']['dropped'])
+
+    def test_unlink_once(self):
+        storage = self.storage(local={}, s3={})
+
+        storage.save_files(self.capture())
+        (local, local_args), (s3, s3_args) = storage.executor.jobs
+
+        # one block for both jobs
+        self.assertIs(local_args[0], s3_args[0])
+
+        local.set_running_or_notify_cancel()
+        local.set_result(.1)
+        self.unlinked.assert_not_called()
+
+        s3.set_running_or_notify_cancel()
+        s3.set_exception(IOError('nope'))
+        self.unlinked.assert_called_once_with(local_args[0])
+
+        stats = storage.stats()
+        self.assertEqual(1, stats['local']['completed'])
+        self.assertEqual(0, stats['s3']['completed'])
+        self.assertEqual(0, stats['s3']['depth'])
+
+    def test_unlink_cancelled(self):
+        storage = self.storage(local={'max_in_flight': '1', 'drop_policy': 'oldest'})
+
+        storage.save_files(self.capture())
+        storage.save_files(self.capture())
+
+        # the first was never started, so it was cancelled and released for the second
+        first, second = storage.executor.jobs
+        self.assertTrue(first[0].cancelled())
+        self.unlinked.assert_called_once_with(first[1][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import multiprocessing
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import cv2
+import numpy as np
+
+from MyPiEye.multi.frame_buffer import FrameRingBuffer
+from MyPiEye.multi.frame_channel import FrameChannel, LAG_LATEST, LAG_BACKLOG
+from MyPiEye.multi.jpeg_cache import JpegCache
+from MyPiEye.encoder import JpegEncoder, ARCHIVE
+
+
+def read_jpeg(channel, results):
+    # already encoded, so no image is needed
+    results.put(channel.jpegs.get(0, None, ARCHIVE).tobytes())
+
+
+class JpegCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = FrameRingBuffer((16, 16, 3), slots=4)
+        self.channel = FrameChannel(self.frames)
+        self.channel.add_consumer('minio', LAG_BACKLOG, 3)
+        self.channel.add_consumer('azure', LAG_LATEST)
+
+        self.jpegs = JpegCache(
+            self.channel,
+            JpegEncoder({}),
+            {ARCHIVE: ['minio', 'azure']},
+            slots=2)
+        self.channel.jpegs = self.jpegs
+
+        self.img = np.zeros((16, 16, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        self.jpegs.close()
+        self.jpegs.unlink()
+        self.frames.close()
+        self.frames.unlink()
+
+    def put_frames(self, count):
+        for x in range(count):
+            self.img[:] = x * 10
+            self.channel.put(self.img, datetime.now())
+
+    def test_encode_once(self):
+        self.put_frames(1)
+
+        with mock.patch('cv2.imencode', wraps=cv2.imencode) as imencode:
+            seq, view, _ = self.channel.cursors['minio'].get(0)
+            jpg1 = self.jpegs.get(seq, view, ARCHIVE)
+
+            seq, view, _ = self.channel.cursors['azure'].get(0)
+            jpg2 = self.jpegs.get(seq, view, ARCHIVE)
+
+            self.assertEqual(1, imencode.call_count)
+
+        self.assertEqual(jpg1.tobytes(), jpg2.tobytes())
+        self.assertFalse(jpg1.flags.writeable)
+
+        decoded = cv2.imdecode(jpg1, cv2.IMREAD_COLOR)
+        self.assertEqual((16, 16, 3), decoded.shape)
+
+    def test_ack(self):
+        self.put_frames(1)
+        self.jpegs.get(0, self.img, ARCHIVE)
+
+        self.jpegs.ack(0, ARCHIVE, 'minio')
+        self.assertIsNotNone(self.jpegs._find(0, 0))
+
+        self.jpegs.ack(0, ARCHIVE, 'azure')
+        self.assertIsNone(self.jpegs._find(0, 0))
+
+    def test_skip(self):
+        self.put_frames(2)
+        self.jpegs.get(0, self.img, ARCHIVE)
+        self.jpegs.ack(0, ARCHIVE, 'minio')
+
+        # azure jumps straight to frame 1
+        self.assertEqual(1, self.channel.cursors['azure'].claim(0))
+        self.assertIsNone(self.jpegs._find(0, 0))
+
+    def test_skipped_first(self):
+        self.put_frames(2)
+
+        # azure skips frame 0 before anyone has encoded it
+        self.assertEqual(1, self.channel.cursors['azure'].claim(0))
+
+        seq, view, _ = self.channel.cursors['minio'].get(0)
+        self.assertEqual(0, seq)
+        self.jpegs.get(seq, view, ARCHIVE, 'minio')
+
+        # not waiting on azure
+        self.jpegs.ack(seq, ARCHIVE, 'minio')
+        self.assertIsNone(self.jpegs._find(0, 0))
+
+    def test_skipped_while_encoding(self):
+        self.put_frames(2)
+        seq, view, _ = self.channel.cursors['minio'].get(0)
+
+        encode = self.jpegs.encoder.encode
+
+        def skip(cv_image, profile):
+            # azure skips it while minio is encoding it
+            self.assertEqual(1, self.channel.cursors['azure'].claim(0))
+            return encode(cv_image, profile)
+
+        with mock.patch.object(self.jpegs.encoder, 'encode', side_effect=skip):
+            self.assertIsNotNone(self.jpegs.get(seq, view, ARCHIVE, 'minio'))
+
+        self.jpegs.ack(seq, ARCHIVE, 'minio')
+        self.assertIsNone(self.jpegs._find(0, 0))
+
+        # the slots are reused
+        for seq in range(1, 4):
+            self.put_frames(1)
+            self.jpegs.get(seq, self.img, ARCHIVE, 'minio')
+            self.assertIsNotNone(self.jpegs._find(seq, 0))
+            self.jpegs.ack(seq, ARCHIVE, 'minio')
+            self.jpegs.ack(seq, ARCHIVE, 'azure')
+
+    def test_full(self):
+        self.put_frames(3)
+
+        held = self.jpegs.get(0, self.img, ARCHIVE)
+        before = held.tobytes()
+        self.assertIsNotNone(self.jpegs.get(1, self.img, ARCHIVE))
+
+        # both slots are waiting on subscribers, so it isn't cached
+        self.img[:] = 255
+        self.assertIsNotNone(self.jpegs.get(2, self.img, ARCHIVE))
+        self.assertIsNone(self.jpegs._find(2, 0))
+
+        # and the view being read is untouched
+        self.assertIsNotNone(self.jpegs._find(0, 0))
+        self.assertEqual(before, held.tobytes())
+
+        # once everyone is done, the slot is reused
+        self.jpegs.ack(0, ARCHIVE, 'minio')
+        self.jpegs.ack(0, ARCHIVE, 'azure')
+        self.jpegs.get(2, self.img, ARCHIVE)
+        self.assertIsNotNone(self.jpegs._find(2, 0))
+
+    def test_overwritten(self):
+        self.put_frames(1)
+
+        def overwrite(cv_image, profile):
+            # the camera laps the buffer mid-encode
+            self.put_frames(4)
+            return np.zeros(10, dtype=np.uint8)
+
+        with mock.patch.object(self.jpegs.encoder, 'encode', side_effect=overwrite):
+            self.assertIsNone(self.jpegs.get(0, self.img, ARCHIVE))
+
+        self.assertIsNone(self.jpegs._find(0, 0))
+
+    def test_other_process(self):
+        self.put_frames(1)
+        jpg = self.jpegs.get(0, self.img, ARCHIVE)
+
+        results = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=read_jpeg, args=(self.channel, results))
+        proc.start()
+        proc.join(10)
+
+        self.assertEqual(jpg.tobytes(), results.get(timeout=1))
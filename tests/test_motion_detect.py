@@ -0,0 +1,248 @@
+import pickle
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from MyPiEye.motion_detect import MotionDetect, ImageCapture, CaptureTask, MOTION_DTYPE, as_motion_array, \
+    motions_to_list, CLEAN, FULL, THUMB
+
+
+def motion_config(**motion):
+    return {
+        'global': {'workdir': '.'},
+        'minsizes': {'minsize': '100', 'min_width': '5', 'min_height': '5'},
+        'ignore': {},
+        'motion': motion
+    }
+
+
+class MotionDetectTests(unittest.TestCase):
+
+    def setUp(self):
+        self.still = np.zeros((240, 320, 3), dtype=np.uint8)
+        self.moved = self.still.copy()
+        self.moved[50:100, 60:120] = 255
+
+    def test_previous_background(self):
+        md = MotionDetect(motion_config(background='previous'))
+
+        # nothing to compare against yet
+        self.assertIsNone(md.motions(self.still))
+        self.assertIsNone(md.motions(self.still))
+
+        capture = md.motions(self.moved)
+        self.assertIsNotNone(capture)
+        self.assertEqual(1, len(capture.motions))
+
+        # the moved image is the background now
+        self.assertIsNone(md.motions(self.moved))
+
+    def test_average_background(self):
+        md = MotionDetect(motion_config(background='average', average_weight='0.5'))
+
+        self.assertIsNone(md.motions(self.still))
+        self.assertEqual(np.float32, md.backgrounds[(0, 0, 320, 240)].dtype)
+
+        capture = md.motions(self.moved)
+        self.assertIsNotNone(capture)
+
+        # still blending in
+        self.assertIsNotNone(md.motions(self.moved))
+
+    def test_resolution_change(self):
+        md = MotionDetect(motion_config())
+
+        md.motions(self.still)
+        self.assertIsNone(md.motions(np.zeros((120, 160, 3), dtype=np.uint8)))
+        self.assertEqual((120, 160), md.backgrounds[(0, 0, 160, 120)].shape)
+
+    def test_detect_scale(self):
+        md = MotionDetect(motion_config(detect_scale='0.5'))
+        self.assertEqual(11, md.blur_size)
+
+        md.motions(self.still)
+        self.assertEqual((120, 160), md.backgrounds[(0, 0, 320, 240)].shape)
+
+        full = MotionDetect(motion_config())
+        full.motions(self.still)
+
+        small_box = md.motions(self.moved).motions[0]
+        full_box = full.motions(self.moved).motions[0]
+
+        # full resolution units, within the precision of the smaller image
+        for key in ['x', 'y', 'w', 'h']:
+            self.assertAlmostEqual(full_box[key], small_box[key], delta=12)
+
+        self.assertAlmostEqual(full_box['size'], small_box['size'], delta=full_box['size'] * .25)
+
+    def test_pyramid(self):
+        md = MotionDetect(motion_config(detect_scale='0.3', scale_method='pyramid'))
+        self.assertEqual(2, md.pyramid_levels)
+        self.assertEqual(.25, md.detect_scale)
+
+        md.motions(self.still)
+        self.assertEqual((60, 80), md.backgrounds[(0, 0, 320, 240)].shape)
+        self.assertIsNotNone(md.motions(self.moved))
+
+    def test_parse_ignore(self):
+        regions = MotionDetect.parse_ignore({
+            'box': '(10, 20, 30, 40)',
+            'poly': '[(0, 0), (50, 0), (0, 50)]',
+            'bogus': '50'
+        })
+
+        self.assertEqual(2, len(regions))
+        self.assertListEqual([[10, 20], [39, 20], [39, 59], [10, 59]], regions[0].tolist())
+        self.assertListEqual([[0, 0], [50, 0], [0, 50]], regions[1].tolist())
+
+    def test_ignore_mask(self):
+        config = motion_config(detect_scale='0.5')
+
+        # covers the change
+        config['ignore'] = {'box': '(40, 30, 100, 100)'}
+        md = MotionDetect(config)
+        md.motions(self.still)
+        self.assertIsNone(md.motions(self.moved))
+
+        mask = md.detect_mask((240, 320, 3), (120, 160))
+        self.assertEqual((120, 160), mask.shape)
+        self.assertEqual(0, mask[40, 40])
+        self.assertEqual(255, mask[0, 0])
+
+        # partly covered, only the rest is reported
+        md.set_ignore({'left': '[(0, 0), (90, 0), (90, 240), (0, 240)]'})
+        md.motions(self.still)
+        capture = md.motions(self.moved)
+        self.assertIsNotNone(capture)
+        x, _, w, _, _ = capture.motions[0].tolist()
+        self.assertGreaterEqual(x, 86)
+        self.assertLessEqual(x + w, 130)
+
+    def test_filter_blobs(self):
+        md = MotionDetect(motion_config())
+
+        # x, y, w, h, area
+        stats = np.array([
+            [0, 0, 20, 20, 400],
+            [10, 10, 4, 40, 160],
+            [10, 10, 40, 4, 160],
+            [30, 30, 9, 9, 81]
+        ], dtype=np.int32)
+
+        movements = md.filter_blobs(stats, (1.0, 1.0))
+        self.assertEqual(MOTION_DTYPE, movements.dtype)
+        self.assertListEqual([(0, 0, 20, 20, 400.0)], movements.tolist())
+
+        # found at quarter size
+        movements = md.filter_blobs(stats, (.25, .25))
+        self.assertListEqual([
+            (0, 0, 80, 80, 6400.0),
+            (40, 40, 16, 160, 2560.0),
+            (40, 40, 160, 16, 2560.0),
+            (120, 120, 36, 36, 1296.0)
+        ], movements.tolist())
+
+    def test_motion_meta(self):
+        motions = as_motion_array([{'rect': (1, 2, 3, 4), 'size': 5}])
+        self.assertEqual(MOTION_DTYPE, motions.dtype)
+        self.assertListEqual([{'rect': [1, 2, 3, 4], 'size': 5.0}], motions_to_list(motions))
+
+        capture = ImageCapture({})
+        capture.motions = motions
+        capture.cam_id = 'server/cam0'
+
+        restored = ImageCapture.from_meta({}, capture.to_meta(), None)
+        self.assertEqual('server/cam0', restored.cam_id)
+        self.assertTrue(np.array_equal(motions, restored.motions))
+
+    def test_draw_in_place(self):
+        boxes = [{'rect': (10, 10, 50, 40), 'size': 2000.0}]
+
+        expected = MotionDetect.add_motion_boxes(MotionDetect.add_timestamp(self.still, '19/09/07'), boxes)
+
+        working = self.still.copy()
+        MotionDetect.draw_timestamp(working, '19/09/07')
+        MotionDetect.draw_motion_boxes(working, boxes)
+
+        self.assertTrue(np.array_equal(expected, working))
+        self.assertFalse(np.array_equal(self.still, working))
+
+    def test_capture_images(self):
+        capture = ImageCapture({})
+        capture.capture_dt = datetime(2019, 9, 7, 23, 15, 49, 220779)
+        capture.jpgs[FULL] = b'jpeg'
+
+        self.assertEqual('190907.231549.220779.box.jpg', capture.filename(FULL))
+        self.assertEqual('190907.231549.220779.thumb.jpg', capture.filename(THUMB))
+        self.assertEqual(b'jpeg', capture.jpg(FULL))
+        self.assertIsNone(capture.jpg('clean'))
+        self.assertRaises(ValueError, capture.jpg, 'nope')
+
+        # a copy for another process has its own reference
+        copied = pickle.loads(pickle.dumps(capture.retain()))
+        self.assertTrue(copied.release())
+        self.assertEqual(b'jpeg', capture.jpg(FULL))
+
+        self.assertFalse(capture.release())
+        self.assertEqual(b'jpeg', capture.jpg(FULL))
+        self.assertTrue(capture.release())
+        self.assertIsNone(capture.jpg(FULL))
+
+    def test_capture_task(self):
+        capture = ImageCapture({})
+        capture.capture_dt = datetime(2019, 9, 7, 23, 15, 49, 220779)
+        capture.cam_id = 'server/cam0'
+        capture.motions = as_motion_array([{'rect': (1, 2, 3, 4), 'size': 5}])
+        capture.jpgs[CLEAN] = b'clean'
+        capture.jpgs[FULL] = b'boxes'
+
+        task = CaptureTask(capture)
+        try:
+            # just the handle
+            pickled = pickle.dumps(task)
+            self.assertLess(len(pickled), 1024)
+
+            loaded = pickle.loads(pickled).load({})
+            self.assertEqual(b'clean', loaded.jpg(CLEAN))
+            self.assertEqual(b'boxes', loaded.jpg(FULL))
+            self.assertEqual('server/cam0', loaded.cam_id)
+            self.assertEqual(capture.capture_dt, loaded.capture_dt)
+            self.assertTrue(np.array_equal(capture.motions, loaded.motions))
+
+            # just the one a backend needs
+            loaded = pickle.loads(pickled).load({}, [FULL])
+            self.assertEqual(b'boxes', loaded.jpg(FULL))
+            self.assertIsNone(loaded.jpg(CLEAN))
+        finally:
+            task.unlink()
+
+    def test_roi(self):
+        config = motion_config()
+        config['roi'] = {
+            'door': '(40, 30, 100, 100)',
+            'edge': '(300, 200, 100, 100)',
+            'outside': '(400, 400, 10, 10)'
+        }
+
+        md = MotionDetect(config)
+        self.assertListEqual([(40, 30, 100, 100), (300, 200, 20, 40)], md.regions((240, 320, 3)))
+
+        md.motions(self.still)
+        self.assertEqual((100, 100), md.backgrounds[(40, 30, 100, 100)].shape)
+
+        # frame co-ordinates, clipped to the region
+        capture = md.motions(self.moved)
+        self.assertIsNotNone(capture)
+        x, y, w, h, _ = capture.motions[0].tolist()
+        self.assertGreaterEqual(x, 40)
+        self.assertGreaterEqual(y, 30)
+        self.assertLessEqual(x + w, 140)
+        self.assertLessEqual(y + h, 130)
+
+        # change outside of the regions
+        md.set_ignore({})
+        md.motions(self.still)
+        outside = self.still.copy()
+        outside[150:200, 200:280] = 255
+        self.assertIsNone(md.motions(outside))
@@ -0,0 +1,61 @@
+import io
+import unittest
+
+import numpy as np
+
+from MyPiEye.Storage.transfer import TransferSettings, BufferReader, MB, MIN_PART_SIZE
+
+
+class TransferTests(unittest.TestCase):
+
+    def test_settings(self):
+        config = {
+            'transfer': {'part_size': str(16 * MB), 'part_concurrency': '2'},
+            'minio': {'part_size': '1024', 'multipart_threshold': str(32 * MB)}
+        }
+
+        settings = TransferSettings(config)
+        self.assertEqual(16 * MB, settings.part_size)
+        self.assertEqual(2, settings.part_concurrency)
+        self.assertEqual(8 * MB, settings.multipart_threshold)
+
+        # the backend's section first, and too small a part
+        minio = TransferSettings(config, 'minio')
+        self.assertEqual(MIN_PART_SIZE, minio.part_size)
+        self.assertEqual(32 * MB, minio.multipart_threshold)
+        self.assertEqual(2, minio.part_concurrency)
+
+        # small objects go in one request
+        self.assertEqual(20 * MB, minio.minio_part_size(20 * MB))
+        self.assertEqual(MIN_PART_SIZE, minio.minio_part_size(40 * MB))
+
+    def test_buffer_reader(self):
+        jpg = np.arange(100, dtype=np.uint8)
+
+        reader = BufferReader(jpg)
+        self.assertEqual(100, len(reader))
+        self.assertEqual(bytes(range(10)), reader.read(10))
+        self.assertEqual(10, reader.tell())
+
+        buf = bytearray(5)
+        self.assertEqual(5, reader.readinto(buf))
+        self.assertEqual(bytes(range(10, 15)), bytes(buf))
+
+        reader.seek(-5, io.SEEK_END)
+        self.assertEqual(bytes(range(95, 100)), reader.read())
+        self.assertEqual(b'', reader.read(10))
+
+        reader.seek(0)
+        self.assertEqual(jpg.tobytes(), reader.read())
+
+        # it's a view, not a copy
+        jpg[0] = 200
+        reader.seek(0)
+        self.assertEqual(200, reader.read(1)[0])
+
+        reader.close()
+        self.assertTrue(reader.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
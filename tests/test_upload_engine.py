@@ -0,0 +1,120 @@
+import unittest
+import threading
+from time import sleep
+from datetime import datetime
+
+import numpy as np
+
+from MyPiEye.multi.frame_buffer import FrameRingBuffer
+from MyPiEye.multi.frame_channel import FrameChannel, LAG_BLOCK
+from MyPiEye.multi.jpeg_cache import JpegCache
+from MyPiEye.multi.upload_engine import UploadEngine
+from MyPiEye.encoder import JpegEncoder, ARCHIVE
+
+
+class SlowUploader(object):
+
+    def __init__(self, delay=.05, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.uploaded = []
+        self.jpgs = []
+
+    def __call__(self, jpg, curdt):
+        self.jpgs.append(jpg)
+
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+
+        sleep(self.delay)
+
+        with self.lock:
+            self.running -= 1
+            self.uploaded.append(curdt)
+
+        if self.fail:
+            raise IOError('nope')
+
+
+class UploadEngineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = FrameRingBuffer((16, 16, 3), slots=8)
+        self.channel = FrameChannel(self.frames, block_timeout=5)
+        self.img = np.zeros((16, 16, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        self.frames.close()
+        self.frames.unlink()
+
+    def run_engine(self, engine, count):
+        thread = threading.Thread(target=engine.start)
+        thread.start()
+
+        try:
+            for x in range(count):
+                self.img[:] = x
+                self.channel.put(self.img, datetime.now())
+
+            for name in engine.uploaders:
+                while engine.uploaders[name].running or len(engine.uploaders[name].uploaded) < count:
+                    sleep(.01)
+        finally:
+            engine.stop()
+            thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+
+    def test_concurrency_limits(self):
+        self.channel.add_consumer('fast', LAG_BLOCK)
+        self.channel.add_consumer('slow', LAG_BLOCK)
+
+        fast = SlowUploader(.01)
+        slow = SlowUploader(.1)
+
+        engine = UploadEngine({}, self.channel, {'fast': fast, 'slow': slow}, {'fast': 4, 'slow': 2})
+        self.run_engine(engine, 12)
+
+        self.assertEqual(12, len(fast.uploaded))
+        self.assertEqual(12, len(slow.uploaded))
+        self.assertLessEqual(slow.peak, 2)
+        self.assertEqual(2, engine.stats['slow']['peak'])
+        self.assertLessEqual(fast.peak, 4)
+        self.assertEqual(12, engine.stats['slow']['uploaded'])
+
+    def test_failures(self):
+        self.channel.add_consumer('broken', LAG_BLOCK)
+
+        broken = SlowUploader(0, fail=True)
+
+        engine = UploadEngine({}, self.channel, {'broken': broken})
+        self.run_engine(engine, 3)
+
+        self.assertEqual(3, engine.stats['broken']['failed'])
+        self.assertEqual(0, engine.stats['broken']['uploaded'])
+
+    def test_cached(self):
+        self.channel.add_consumer('slow', LAG_BLOCK)
+        self.channel.jpegs = JpegCache(self.channel, JpegEncoder({}), {ARCHIVE: ['slow']}, slots=2)
+
+        slow = SlowUploader(.05)
+
+        try:
+            engine = UploadEngine({}, self.channel, {'slow': slow}, {'slow': 4})
+            self.run_engine(engine, 6)
+
+            # each upload has its own copy, so nothing is left pinned in the cache
+            self.assertEqual(6, len(slow.uploaded))
+            self.assertTrue(all(jpg.flags.owndata for jpg in slow.jpgs))
+            self.assertEqual(0, engine.stats['slow']['failed'])
+        finally:
+            self.channel.jpegs.close()
+            self.channel.jpegs.unlink()
+
+
+if __name__ == '__main__':
+    unittest.main()
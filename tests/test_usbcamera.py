@@ -0,0 +1,105 @@
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from MyPiEye.usbcamera import UsbCamera
+
+config = {
+    'camera': {
+        'camera': '0',
+        'resolution': 'small',
+        'threaded_grab': 'True',
+        'grab_timeout': '0.5'
+    }
+}
+
+
+class FakeCapture(object):
+    """
+    Hands out numbered frames, one each time ``release_frame`` is set.
+    """
+
+    def __init__(self, *args):
+        self.count = 0
+        self.release_frame = threading.Event()
+
+    def set(self, *args):
+        return True
+
+    def get(self, *args):
+        return 0
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        if not self.release_frame.wait(1):
+            return False
+        self.release_frame.clear()
+        self.count += 1
+        return True
+
+    def retrieve(self):
+        return True, np.full((480, 640, 3), self.count, dtype=np.uint8)
+
+    def read(self):
+        self.count += 1
+        return True, np.full((480, 640, 3), self.count, dtype=np.uint8)
+
+    def release(self):
+        pass
+
+
+class UsbCameraTests(unittest.TestCase):
+
+    def test_unthreaded(self):
+        cam_config = dict(config['camera'], threaded_grab='False')
+
+        with mock.patch('cv2.VideoCapture', FakeCapture):
+            camera = UsbCamera({'camera': cam_config})
+            self.assertTrue(camera.init_camera())
+
+            img, grab_dt = camera.get_frame()
+            self.assertEqual(1, img[0, 0, 0])
+            self.assertIsNotNone(grab_dt)
+
+            camera.close_camera()
+
+    def test_threaded(self):
+        with mock.patch('cv2.VideoCapture', FakeCapture):
+            camera = UsbCamera(config)
+            self.assertTrue(camera.init_camera())
+            fake = camera.camera_instance
+
+            try:
+                # the camera has stalled
+                img, grab_dt = camera.get_frame(.1)
+                self.assertIsNone(img)
+
+                fake.release_frame.set()
+                img, grab_dt = camera.get_frame()
+                self.assertEqual(1, img[0, 0, 0])
+
+                # nothing new, so the same one again
+                fake.release_frame.clear()
+                img, _ = camera.get_frame(.1)
+                self.assertEqual(1, img[0, 0, 0])
+
+                # two arrive, only the newest is kept
+                fake.release_frame.set()
+                while camera.grabbed < 2:
+                    threading.Event().wait(.01)
+                fake.release_frame.set()
+                while camera.grabbed < 3:
+                    threading.Event().wait(.01)
+
+                img = camera.get_image()
+                self.assertEqual(3, img[0, 0, 0])
+
+                self.assertDictEqual({'grabbed': 3, 'dropped': 1, 'duplicates': 1}, camera.stats())
+            finally:
+                camera.close_camera()
+
+            self.assertIsNone(camera.camera_instance)